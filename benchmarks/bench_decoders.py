@@ -0,0 +1,97 @@
+'''
+    Decode throughput of every available backend of data.decoders, per dataset and kind of file.
+    Files are read into memory first, so only decoding is timed. Every backend's output is checked
+    against PIL's. For hdf5 labels, HDF5LabelReader (which also resizes and crops to --image_size)
+    is timed against decode_h5py followed by the PIL resize and crop it replaces.
+
+    Run from the repository root:
+        python -m benchmarks.bench_decoders \
+            --roots taskonomy=/datasets/taskonomy replica=/scratch/ainaz/replica-taskonomized \
+                    hypersim=/scratch/ainaz/hypersim-dataset2/evermotion/scenes \
+            --num_files 200
+'''
+import argparse
+from   collections import defaultdict
+import os
+import random
+from   time import perf_counter
+import numpy as np
+import PIL
+from   PIL import Image
+from   torchvision import transforms
+
+from data.decoders import DECODERS, HDF5LabelReader, available_decoders, file_kind, get_decoder
+
+
+def sample_files(root, num_files, seed=0):
+    ''' Up to num_files files of each kind, from the first directories os.walk finds '''
+    candidates = defaultdict(list)
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(('.png', '.jpg', '.jpeg', '.hdf5')):
+                continue
+            path = os.path.join(dirpath, name)
+            if name.endswith('.hdf5'):
+                kind = 'hdf5'
+            else:
+                with open(path, 'rb') as f:
+                    kind = file_kind(path, f.read(32))
+            candidates[kind].append(path)
+        if all(len(paths) >= 4 * num_files for paths in candidates.values()) and len(candidates) > 0:
+            break
+    rng = random.Random(seed)
+    return {kind: rng.sample(paths, min(num_files, len(paths))) for kind, paths in candidates.items()}
+
+
+def benchmark(backend, files):
+    decode = DECODERS[backend]
+    start = perf_counter()
+    for path, data in files:
+        decode(path, data)
+    return perf_counter() - start
+
+
+def benchmark_hdf5_labels(name, paths, image_size):
+    resize_crop = transforms.Compose([transforms.Resize(image_size, Image.NEAREST), transforms.CenterCrop(image_size)])
+    reader = HDF5LabelReader()
+    for path in paths[:8]:
+        assert np.array_equal(np.asarray(resize_crop(DECODERS['h5py'](path)))[:, :, 0], reader.read(path, image_size))
+    start = perf_counter()
+    for path in paths:
+        np.asarray(resize_crop(DECODERS['h5py'](path)))
+    t_pil = perf_counter() - start
+    start = perf_counter()
+    for path in paths:
+        reader.read(path, image_size)
+    t_direct = perf_counter() - start
+    print(f'{name:>10} {"hdf5":>6} {"h5py+PIL":>10}  {len(paths) / t_pil:8.1f} images/s | '
+          f'direct {len(paths) / t_direct:8.1f} images/s | {t_pil / t_direct:5.1f}x (resized to {image_size})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--roots', type=str, nargs='+', required=True, help='name=path of each dataset')
+    parser.add_argument('--num_files', type=int, default=200, help='Files per dataset and kind (default: 200)')
+    parser.add_argument('--image_size', type=int, default=512, help='Size hdf5 labels are resized to (default: 512)')
+    args = parser.parse_args()
+
+    print(f'pillow {PIL.__version__}, backends: {sorted(DECODERS)}')
+    for entry in args.roots:
+        name, root = entry.split('=', 1)
+        for kind, paths in sorted(sample_files(root, args.num_files).items()):
+            if kind == 'hdf5':
+                benchmark_hdf5_labels(name, paths, args.image_size)
+            files = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    files.append((path, f.read()))
+            megabytes = sum(len(data) for _, data in files) / 2 ** 20
+            backends = available_decoders(kind) if kind in ('png8', 'png16', 'jpeg', 'hdf5') else ['pil']
+            reference = [np.asarray(DECODERS[backends[-1]](path, data)) for path, data in files[:8]]
+            for backend in backends:
+                outputs = [np.asarray(DECODERS[backend](path, data)) for path, data in files[:8]]
+                same = all(np.array_equal(a, b) and a.dtype == b.dtype for a, b in zip(outputs, reference))
+                seconds = benchmark(backend, files)
+                selected = '*' if backend == get_decoder(kind) else ' '
+                print(f'{name:>10} {kind:>6} {backend:>10}{selected} {len(files) / seconds:8.1f} images/s '
+                      f'{megabytes / seconds:8.1f} MB/s   {"same as" if same else "DIFFERS from"} {backends[-1]}')
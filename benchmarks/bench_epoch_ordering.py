@@ -0,0 +1,80 @@
+'''
+    Loading throughput of TaskonomyReplicaGsoDataset with a fully shuffled sample order versus the
+    block shuffle of data.samplers.block_shuffle, on a cold and on a warm page cache.
+
+    "cold" evicts the files of the measured samples with posix_fadvise(DONTNEED) before the run
+    (no root needed, but on NFS / Lustre the servers' caches stay warm); "warm" reads them once
+    before measuring.
+
+    Run from the repository root:
+        python -m benchmarks.bench_epoch_ordering --datasets taskonomy replica \
+            --tasks rgb normal depth_zbuffer mask_valid --image_size 256 \
+            --num_samples 4000 --num_workers 8 --block_window 256
+'''
+import argparse
+import os
+from   time import perf_counter
+from   torch.utils.data import DataLoader, Subset
+
+from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset
+
+
+def evict(paths):
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def touched_files(dataset, indices):
+    return [dataset.index.url(task, dataset.sample_order[i]) for i in indices for task in dataset.tasks]
+
+
+def measure(dataset, indices, batch_size, num_workers):
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    start = perf_counter()
+    for _ in loader:
+        pass
+    return len(indices) / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+    defaults = TaskonomyReplicaGsoDataset.Options()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=str, nargs='+', default=['rgb', 'normal', 'depth_zbuffer', 'mask_valid'])
+    parser.add_argument('--datasets', type=str, nargs='+', default=defaults.datasets)
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--taskonomy_root', type=str, default=defaults.taskonomy_data_path)
+    parser.add_argument('--replica_root', type=str, default=defaults.replica_data_path)
+    parser.add_argument('--gso_root', type=str, default=defaults.gso_data_path)
+    parser.add_argument('--hypersim_root', type=str, default=defaults.hypersim_data_path)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--num_samples', type=int, default=4000, help='Samples read per measurement (default: 4000)')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--block_window', type=int, default=256)
+    args = parser.parse_args()
+
+    results = {}
+    for order in ['shuffle', 'block']:
+        dataset = TaskonomyReplicaGsoDataset(TaskonomyReplicaGsoDataset.Options(
+            taskonomy_data_path=args.taskonomy_root, replica_data_path=args.replica_root,
+            gso_data_path=args.gso_root, hypersim_data_path=args.hypersim_root,
+            split=args.split, tasks=args.tasks, datasets=args.datasets, image_size=args.image_size,
+            order=order, block_window=args.block_window))
+        dataset.randomize_order(seed=0)
+        indices = list(range(min(args.num_samples, len(dataset))))
+        files = touched_files(dataset, indices)
+
+        evict(files)
+        cold = measure(dataset, indices, args.batch_size, args.num_workers)
+        measure(dataset, indices, args.batch_size, args.num_workers)
+        warm = measure(dataset, indices, args.batch_size, args.num_workers)
+        buildings = len({dataset.index.building[dataset.sample_order[i]] for i in indices})
+        results[order] = (cold, warm)
+        print(f'{order:>8}: cold {cold:8.1f} images/s | warm {warm:8.1f} images/s | {buildings} buildings in {len(indices)} samples')
+
+    print(f'block / shuffle: cold {results["block"][0] / results["shuffle"][0]:.2f}x | '
+          f'warm {results["block"][1] / results["shuffle"][1]:.2f}x')
@@ -0,0 +1,54 @@
+'''
+    Compares the per-label mask loop that used to remap replica / hypersim semantic labels
+    against the lookup-table gather (data.segment_instance.remap_labels).
+
+    Run from the repository root:
+        python -m benchmarks.bench_label_remap --size 512 --iters 50
+'''
+import argparse
+from   time import perf_counter
+import torch
+
+from data.segment_instance import HYPERSIM_LABEL_TRANSFORM, REPLICA_LABEL_TRANSFORM, \
+    HYPERSIM_LABEL_LUT, REPLICA_LABEL_LUT, remap_labels
+
+
+def remap_labels_loop(res, label_transform):
+    res2 = res.clone()
+    labels = torch.unique(res)
+    for old_label in labels:
+        if old_label == -1 or old_label == 255: continue
+        res[res2 == old_label] = label_transform[old_label]
+    return res
+
+
+def make_label_map(size, num_labels, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    labels = torch.randint(0, num_labels, (size, size, 3), generator=g)
+    labels[:size // 8] = 255
+    labels[-size // 8:] = -1
+    return labels
+
+
+def benchmark(fn, iters):
+    fn()
+    start = perf_counter()
+    for _ in range(iters):
+        fn()
+    return (perf_counter() - start) / iters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512, help='Label map size (default: 512)')
+    parser.add_argument('--iters', type=int, default=50, help='Iterations per measurement (default: 50)')
+    args = parser.parse_args()
+
+    for name, label_transform, lut in [
+            ('replica', REPLICA_LABEL_TRANSFORM, REPLICA_LABEL_LUT),
+            ('hypersim', HYPERSIM_LABEL_TRANSFORM, HYPERSIM_LABEL_LUT)]:
+        labels = make_label_map(args.size, len(label_transform))
+        assert torch.equal(remap_labels_loop(labels.clone(), label_transform), remap_labels(labels, lut))
+        t_loop = benchmark(lambda: remap_labels_loop(labels.clone(), label_transform), args.iters)
+        t_lut = benchmark(lambda: remap_labels(labels, lut), args.iters)
+        print(f'{name:>8} {args.size}x{args.size}x3: loop {1000 * t_loop:8.2f} ms | lut {1000 * t_lut:6.2f} ms | {t_loop / t_lut:6.1f}x')
@@ -0,0 +1,83 @@
+'''
+    CPU time of data.masks.make_valid_mask (eager and compiled) against the make_valid_mask the
+    LightningModules used to define, and of build_mask with its cached kernel against rebuilding
+    the kernel on every call. Outputs are checked to be identical.
+
+    Run from the repository root:
+        python -m benchmarks.bench_masks --batch_size 16 --num_positive 1 --image_size 256
+'''
+import argparse
+from   time import perf_counter
+import torch
+import torch.nn.functional as F
+
+from data.masks import build_mask, make_valid_mask, DEFAULT_MASK_EXTRA_RADIUS
+
+
+def legacy_make_valid_mask(mask_float, image_size, max_pool_size=4):
+    if len(mask_float.shape) == 3:
+        mask_float = mask_float.unsqueeze(axis=0)
+    reshape_temp = len(mask_float.shape) == 5
+    if reshape_temp:
+        num_positive = mask_float.shape[1]
+        mask_float = mask_float.flatten(0, 1)
+    mask_float = 1 - mask_float
+    mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
+    mask_float = F.interpolate(mask_float, (image_size, image_size), mode='nearest')
+    mask_valid = mask_float == 0
+    if reshape_temp:
+        mask_valid = mask_valid.unflatten(0, (-1, num_positive))
+    return mask_valid
+
+
+def legacy_build_mask(target, val=0.0, tol=1e-3, mask_extra_radius=DEFAULT_MASK_EXTRA_RADIUS):
+    mask = ((target >= val - tol) & (target <= val + tol))
+    mask = (0 != F.conv2d(mask.float(),
+                          torch.ones(1, 1, mask_extra_radius, mask_extra_radius, device=mask.device),
+                          padding=(mask_extra_radius // 2)))
+    return (~mask).expand_as(target)
+
+
+def timed(fn, repeats):
+    fn()  # warm up (and compile)
+    start = perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (perf_counter() - start) / repeats * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_positive', type=int, default=1)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads (default: torch default)')
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    shape = (args.batch_size, 1, args.image_size, args.image_size)
+    if args.num_positive > 1:
+        shape = (args.batch_size, args.num_positive) + shape[1:]
+    mask = (torch.rand(shape) > 0.01).float()
+    reference = legacy_make_valid_mask(mask, args.image_size)
+    for name, fn in [('eager', lambda: make_valid_mask(mask, args.image_size)),
+                     ('eager uint8', lambda: make_valid_mask(mask, args.image_size, dtype=torch.uint8)),
+                     ('compiled', lambda: make_valid_mask(mask, args.image_size, compiled=True))]:
+        assert torch.equal(fn().bool(), reference), name
+    legacy = timed(lambda: legacy_make_valid_mask(mask, args.image_size), args.repeats)
+    print(f'make_valid_mask {list(shape)}, {torch.get_num_threads()} threads')
+    print(f'{"legacy":>14}: {legacy:8.3f} ms')
+    for name, fn in [('eager', lambda: make_valid_mask(mask, args.image_size)),
+                     ('eager uint8', lambda: make_valid_mask(mask, args.image_size, dtype=torch.uint8)),
+                     ('compiled', lambda: make_valid_mask(mask, args.image_size, compiled=True))]:
+        t = timed(fn, args.repeats)
+        print(f'{name:>14}: {t:8.3f} ms  {legacy / t:5.2f}x')
+
+    depth = torch.rand((args.batch_size, 1, args.image_size, args.image_size))
+    depth[depth < 0.05] = 0
+    assert torch.equal(build_mask(depth), legacy_build_mask(depth))
+    legacy = timed(lambda: legacy_build_mask(depth), args.repeats)
+    cached = timed(lambda: build_mask(depth), args.repeats)
+    print(f'build_mask: kernel per call {legacy:8.3f} ms | cached kernel {cached:8.3f} ms  {legacy / cached:5.2f}x')
@@ -0,0 +1,100 @@
+'''
+    Batch collation and host to device transfer for the {'positive': {task: tensor, 'building': ...,
+    'point': ...}} batches of the datasets in this directory.
+
+        RingCollate:        collate_fn for DataLoaders with workers. Each worker stacks its batches
+                            into a ring of shared memory buffers that are allocated once, instead of
+                            a new shared memory segment per batch (what default_collate does).
+        SideStreamTransfer: copies a batch to the GPU on a separate CUDA stream, so that the copy of
+                            the next batch overlaps with the kernels of the current step. Needs
+                            pinned host memory (pin_memory=True) to be asynchronous.
+
+    In a LightningModule:
+
+        train_dataloader:           DataLoader(..., collate_fn=RingCollate(pin_memory=True), pin_memory=True)
+        transfer_batch_to_device:   return self.batch_transfer(batch, device)
+'''
+import functools
+import os
+import torch
+from   torch.utils.data import get_worker_info
+from   torch.utils.data.dataloader import default_collate
+
+
+class RingCollate:
+    '''
+        A worker reuses the buffers of a batch num_slots batches later. That is only safe because the
+        pin memory thread copies every batch into pinned memory as soon as it arrives, and a worker
+        gets at most prefetch_factor (< num_slots) batches ahead of it. So the ring is only used in
+        workers of a DataLoader with pin_memory=True (pass the same pin_memory to both) on a machine
+        with CUDA; otherwise (and without workers) this is default_collate.
+    '''
+    def __init__(self, pin_memory: bool = False, num_slots: int = 6):
+        # The DataLoader only starts its pin memory thread with CUDA available
+        self.use_ring = pin_memory and torch.cuda.is_available()
+        self.num_slots = num_slots
+        self._buffers = {}
+        self._next_slot = 0
+        self._pid = None
+
+    def __call__(self, samples):
+        if not self.use_ring or get_worker_info() is None:
+            return default_collate(samples)
+        if self._pid != os.getpid():
+            self._buffers, self._next_slot, self._pid = {}, 0, os.getpid()
+        slot = self._next_slot
+        self._next_slot = (self._next_slot + 1) % self.num_slots
+        return self._collate(samples, (), slot)
+
+    def _collate(self, samples, key, slot):
+        elem = samples[0]
+        if isinstance(elem, dict):
+            return {k: self._collate([sample[k] for sample in samples], key + (k,), slot) for k in elem}
+        if isinstance(elem, torch.Tensor):
+            return self._stack(samples, key, slot)
+        return default_collate(samples)
+
+    def _stack(self, samples, key, slot):
+        elem = samples[0]
+        # What torch.stack (and default_collate) promotes mixed dtypes to
+        dtype = functools.reduce(torch.promote_types, [sample.dtype for sample in samples])
+        buffers = self._buffers.setdefault(key, [None] * self.num_slots)
+        buffer = buffers[slot]
+        if buffer is None or buffer.shape[1:] != elem.shape or buffer.dtype != dtype or len(buffer) < len(samples):
+            buffer = torch.empty((len(samples),) + tuple(elem.shape), dtype=dtype).share_memory_()
+            buffers[slot] = buffer
+        return torch.stack(samples, out=buffer[:len(samples)])
+
+
+def _map_tensors(batch, fn):
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, dict):
+        return {k: _map_tensors(v, fn) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_map_tensors(v, fn) for v in batch)
+    return batch
+
+
+class SideStreamTransfer:
+    ''' Moves the tensors of a (nested) batch to device, on a side stream for CUDA devices '''
+    def __init__(self):
+        self._streams = {}
+
+    def __call__(self, batch, device):
+        device = torch.device(device)
+        if device.type != 'cuda':
+            return _map_tensors(batch, lambda x: x.to(device))
+        stream = self._streams.get(device)
+        if stream is None:
+            stream = self._streams[device] = torch.cuda.Stream(device)
+        current = torch.cuda.current_stream(device)
+        with torch.cuda.stream(stream):
+            batch = _map_tensors(batch, lambda x: x.to(device, non_blocking=True))
+        current.wait_stream(stream)
+
+        # The tensors were allocated on the side stream but are used (and freed) on the current one
+        def record(x):
+            x.record_stream(current)
+            return x
+        return _map_tensors(batch, record)
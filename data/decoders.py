@@ -0,0 +1,230 @@
+'''
+    Image decoders used by transforms.default_loader, picked per kind of file:
+
+        png8        8-bit grayscale / RGB / RGBA png (rgb, normal, mask_valid, semantic labels, ...)
+        png16       16-bit grayscale png (depth, edges, keypoints, ...)
+        jpeg
+        hdf5        hypersim semantic labels
+        other       anything else (palette pngs, ...), always decoded by PIL
+
+    Every backend returns what PIL would (mode and values), so the transforms do not depend on the
+    backend; decode_cv2 hands the pngs it cannot match (and data it fails to decode) to decode_pil. For each kind the first available backend of DECODER_PREFERENCES is used. The order can
+    be changed with set_decoder(kind, backend) or the environment variable
+    OMNIDATA_DECODERS="png8=pil,png16=cv2"; see benchmarks/bench_decoders.py for what is fastest on a
+    given machine. The PIL backend profits from pillow-simd when it is installed instead of pillow.
+'''
+from   collections import OrderedDict
+import io
+import os
+import threading
+import numpy as np
+import h5py
+from   PIL import Image
+from   typing import Callable, Dict, List, Optional
+
+try:
+    import cv2
+    cv2.setNumThreads(0)  # DataLoader workers already decode in parallel
+except ImportError:
+    cv2 = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+except (ImportError, RuntimeError): # RuntimeError: libturbojpeg not found
+    _turbojpeg = None
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_JPEG_SIGNATURE = b'\xff\xd8'
+
+DECODER_PREFERENCES = {
+    'png8': ['cv2', 'pil'],
+    'png16': ['cv2', 'pil'],
+    'jpeg': ['turbojpeg', 'cv2', 'pil'],
+    'hdf5': ['h5py'],
+    'other': ['pil'],
+}
+
+
+def file_kind(path: str, data: bytes) -> str:
+    if path.endswith('.hdf5'):
+        return 'hdf5'
+    if data[:8] == _PNG_SIGNATURE:
+        # IHDR chunk: bit depth at byte 24, color type at byte 25 (0: gray, 2: RGB, 3: palette, 4: gray + alpha, 6: RGBA)
+        bit_depth, color_type = data[24], data[25]
+        if bit_depth == 8 and color_type in (0, 2, 6):
+            return 'png8'
+        if bit_depth == 16 and color_type == 0:
+            return 'png16'
+        return 'other'
+    if data[:2] == _JPEG_SIGNATURE:
+        return 'jpeg'
+    return 'other'
+
+
+def decode_pil(path, data):
+    img = Image.open(io.BytesIO(data))
+    img.load()  # decodes without the copy img.convert(img.mode) used to make
+    return img
+
+
+def _cv2_differs_from_pil(data):
+    ''' pngs cv2 does not decode like PIL: palette (expanded to BGR), gray + alpha, 16-bit color, < 8 bits '''
+    if data[:8] != _PNG_SIGNATURE:
+        return False
+    bit_depth, color_type = data[24], data[25]
+    return color_type in (3, 4) or bit_depth < 8 or (bit_depth == 16 and color_type != 0)
+
+
+def decode_cv2(path, data):
+    if _cv2_differs_from_pil(data):
+        return decode_pil(path, data)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        # Truncated or corrupt file: PIL decodes what it can (LOAD_TRUNCATED_IMAGES) or raises a proper error
+        return decode_pil(path, data)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA if img.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+    return Image.fromarray(img)
+
+
+def decode_turbojpeg(path, data):
+    return Image.fromarray(_turbojpeg.decode(data, pixel_format=TJPF_RGB))
+
+
+def decode_h5py(path, data=None):
+    with h5py.File(io.BytesIO(data) if data is not None else path, 'r') as f:
+        labels = f['dataset'][:]
+    return Image.fromarray(np.uint8(np.repeat(np.expand_dims(labels, axis=2), 3, axis=2)))
+
+
+DECODERS: Dict[str, Callable] = {'pil': decode_pil, 'h5py': decode_h5py}
+if cv2 is not None:
+    DECODERS['cv2'] = decode_cv2
+if _turbojpeg is not None:
+    DECODERS['turbojpeg'] = decode_turbojpeg
+
+
+def _selected_decoders():
+    selected = {}
+    for kind, backends in DECODER_PREFERENCES.items():
+        selected[kind] = next(backend for backend in backends + ['pil'] if backend in DECODERS)
+    for entry in filter(None, os.environ.get('OMNIDATA_DECODERS', '').split(',')):
+        kind, backend = entry.split('=')
+        if backend not in DECODERS:
+            raise ValueError(f'Decoder backend {backend} (from OMNIDATA_DECODERS) is not available, choose from {sorted(DECODERS)}.')
+        selected[kind] = backend
+    return selected
+
+
+_selected = _selected_decoders()
+
+
+def set_decoder(kind: str, backend: str):
+    if backend not in DECODERS:
+        raise ValueError(f'Decoder backend {backend} is not available, choose from {sorted(DECODERS)}.')
+    _selected[kind] = backend
+
+
+def get_decoder(kind: str) -> str:
+    return _selected[kind]
+
+
+def available_decoders(kind: str) -> List[str]:
+    return [backend for backend in DECODER_PREFERENCES[kind] if backend in DECODERS]
+
+
+def decode_file(path: str, backend: str = None, data: Optional[bytes] = None):
+    '''
+        Reads the file once (unless its contents are given, e.g. by prefetch.PrefetchingReader) and
+        decodes it with the selected (or the given) backend
+    '''
+    if path.endswith('.hdf5'):
+        return DECODERS[backend or _selected['hdf5']](path, data)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    if backend is None:
+        backend = _selected[file_kind(path, data)]
+    return DECODERS[backend](path, data)
+
+
+class HDF5LabelReader:
+    '''
+        Reads hypersim semantic labels (int16[H, W] 'dataset' in .hdf5 files) directly into numpy,
+        without decode_h5py's 3 channel uint8 PIL image. Files stay open (up to max_open per process)
+        and are read with read_direct into a reused buffer.
+
+        read(path, size) returns what decode_h5py followed by PIL Resize(size, NEAREST) and
+        CenterCrop(size) gives for channel 0: uint8[size, size] (-1 wraps to 255, as np.uint8 does).
+    '''
+    def __init__(self, max_open: int = 64):
+        self.max_open = max_open
+        self._files = OrderedDict()
+        self._buffers = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _dataset(self, path):
+        if self._pid != os.getpid():
+            # h5py handles must not be shared with forked DataLoader workers
+            self._files, self._buffers, self._pid = OrderedDict(), {}, os.getpid()
+        f = self._files.get(path)
+        if f is None:
+            f = h5py.File(path, 'r')
+            self._files[path] = f
+            if len(self._files) > self.max_open:
+                self._files.popitem(last=False)[1].close()
+        else:
+            self._files.move_to_end(path)
+        return f['dataset']
+
+    def read(self, path: str, size: Optional[int] = None, data: Optional[bytes] = None) -> np.ndarray:
+        ''' data: contents of the file (e.g. from a packed view), which is then not opened '''
+        if data is not None:
+            with h5py.File(io.BytesIO(data), 'r') as f:
+                labels = f['dataset'][:]
+            return (labels if size is None else resize_crop_nearest(labels, size)).astype(np.uint8)
+        # h5py serializes reads anyway; the lock also protects the open files and the buffers
+        with self._lock:
+            dataset = self._dataset(path)
+            buffer = self._buffers.get(dataset.shape)
+            if buffer is None:
+                buffer = self._buffers[dataset.shape] = np.empty(dataset.shape, dtype=np.int16)
+            dataset.read_direct(buffer)
+            if size is None:
+                return buffer.astype(np.uint8)
+            return resize_crop_nearest(buffer, size).astype(np.uint8)
+
+    def __getstate__(self):
+        return {'max_open': self.max_open, '_files': OrderedDict(), '_buffers': {}, '_pid': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def resize_crop_nearest(image: np.ndarray, size: int) -> np.ndarray:
+    '''
+        PIL Resize(size, NEAREST) (shorter side to size) followed by CenterCrop(size) for a [H, W, ...]
+        array, computed by indexing only the rows and columns that survive the crop.
+    '''
+    h, w = image.shape[:2]
+    if h <= w:
+        new_h, new_w = size, int(size * w / h)
+    else:
+        new_h, new_w = int(size * h / w), size
+    top, left = int(round((new_h - size) / 2.0)), int(round((new_w - size) / 2.0))
+    rows = _nearest_source_indices(h, new_h)[top:top + size]
+    cols = _nearest_source_indices(w, new_w)[left:left + size]
+    return image[rows[:, None], cols[None, :]]
+
+
+def _nearest_source_indices(src, dst):
+    # PIL samples the source pixel under the center of each output pixel, stepping through the
+    # source coordinates by repeated double additions (which round differently than (x + 0.5) * scale)
+    scale = src / dst
+    steps = np.full(dst, scale)
+    steps[0] = scale * 0.5
+    return np.add.accumulate(steps).astype(np.int64)
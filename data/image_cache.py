@@ -0,0 +1,186 @@
+'''
+    Caches of decoded images, so that files which are read every epoch are only decoded once.
+
+        DecodedImageCache:  LRU cache with a byte budget, private to each DataLoader worker.
+        SharedImageCache:   Fixed set of slots (e.g. one per (task, sample)) in one shared memory
+                            buffer that all workers fill. Nothing is evicted, so a validation set
+                            that fits into the budget is fully resident after the first epoch.
+
+    Both are created in the main process before the DataLoader forks its workers and count hits and
+    misses in shared memory, so stats() in the main process covers all workers. The counters are
+    not locked and may drop a few updates under contention.
+
+    Images are stored as numpy arrays: PIL images with an array mode are converted on insertion and
+    rebuilt (cheaply) on every hit. Anything else a loader returns (e.g. json) is passed through.
+'''
+from   collections import OrderedDict
+import mmap
+import multiprocessing as mp
+import numpy as np
+from   PIL import Image
+import threading
+from   typing import Any, Callable, Hashable
+
+
+# Modes that survive a round trip through np.asarray / Image.fromarray
+_ARRAY_MODES = ['1', 'L', 'LA', 'RGB', 'RGBA', 'I', 'I;16', 'F']
+# dtypes storable in a SharedImageCache (index = dtype id)
+_DTYPES = [np.dtype(d) for d in ['bool', 'uint8', 'uint16', 'int16', 'int32', 'int64', 'float32', 'float64']]
+_MAX_DIMS = 3
+
+_HITS, _MISSES, _EVICTIONS, _UNCACHED = range(4)
+
+
+def _to_array(value):
+    ''' Returns (array, is_image), or (None, False) if value cannot be cached as an array '''
+    if isinstance(value, np.ndarray):
+        return value, False
+    if isinstance(value, Image.Image) and value.mode in _ARRAY_MODES:
+        return np.asarray(value), True
+    return None, False
+
+
+def _from_array(array, is_image):
+    return Image.fromarray(array) if is_image else array.copy()
+
+
+class _SharedCounters:
+    def __init__(self, n):
+        self._buffer = mmap.mmap(-1, 8 * n)
+        self.values = np.frombuffer(self._buffer, dtype=np.int64)
+
+    def add(self, i, n=1):
+        self.values[i] += n
+
+
+class DecodedImageCache:
+    '''
+        LRU cache of decoded images holding at most max_bytes per process:
+
+            image = cache.get(path, lambda: default_loader(path))
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._counters = _SharedCounters(4)
+        self._lock = threading.Lock()  # the dataset may load the files of a sample from several threads
+
+    def get(self, key: Hashable, load: Callable[[], Any]):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            self._counters.add(_HITS)
+            return _from_array(*entry)
+
+        self._counters.add(_MISSES)
+        value = load()
+        array, is_image = _to_array(value)
+        if array is None or array.nbytes > self.max_bytes:
+            self._counters.add(_UNCACHED)
+            return value
+        with self._lock:
+            if key in self._entries:
+                return value
+            while self.num_bytes + array.nbytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self._counters.add(_EVICTIONS)
+            self._entries[key] = (array, is_image)
+            self.num_bytes += array.nbytes
+        return value
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def stats(self):
+        hits, misses, evictions, uncached = (int(v) for v in self._counters.values)
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'uncached': uncached,
+                'hit_rate': hits / max(hits + misses, 1)}
+
+
+class SharedImageCache:
+    '''
+        Cache of decoded images in one shared memory buffer of max_bytes, with one slot per key in
+        range(num_slots). Slots are filled on their first miss while there is space left and are never
+        evicted. The buffer is an anonymous shared mapping, so the DataLoader workers have to be forked
+        (the default on Linux) and pages are only allocated once they are written.
+
+            image = cache.get(slot, lambda: default_loader(path))
+    '''
+    # Per slot: byte offset, dtype id, is_image, ndim, shape[_MAX_DIMS], state (written last):
+    # 0 = empty (what the zero-filled mapping starts with), -1 = being filled, nbytes + 1 = filled
+    _OFFSET, _DTYPE, _IS_IMAGE, _NDIM, _SHAPE = 0, 1, 2, 3, 4
+    _STATE = _SHAPE + _MAX_DIMS
+    _EMPTY, _RESERVED = 0, -1
+
+    def __init__(self, num_slots: int, max_bytes: int):
+        self.num_slots = num_slots
+        self.max_bytes = max_bytes
+        self._data_buffer = mmap.mmap(-1, max(max_bytes, 1))
+        self._data = np.frombuffer(self._data_buffer, dtype=np.uint8)
+        # Not initialized: pages of the mapping are only allocated when slots in them are filled
+        self._slot_buffer = mmap.mmap(-1, 8 * num_slots * (self._STATE + 1))
+        self._slots = np.frombuffer(self._slot_buffer, dtype=np.int64).reshape(num_slots, self._STATE + 1)
+        self._used = _SharedCounters(1)
+        self._counters = _SharedCounters(4)
+        self._lock = mp.Lock()
+
+    def _read(self, slot):
+        meta = self._slots[slot]
+        dtype = _DTYPES[meta[self._DTYPE]]
+        shape = tuple(meta[self._SHAPE:self._SHAPE + meta[self._NDIM]])
+        offset, nbytes = meta[self._OFFSET], meta[self._STATE] - 1
+        array = self._data[offset:offset + nbytes].view(dtype).reshape(shape)
+        return _from_array(array, bool(meta[self._IS_IMAGE]))
+
+    def _is_filled(self, slot):
+        return self._slots[slot, self._STATE] > 0
+
+    def get(self, slot: int, load: Callable[[], Any]):
+        if self._is_filled(slot):
+            self._counters.add(_HITS)
+            return self._read(slot)
+
+        self._counters.add(_MISSES)
+        value = load()
+        array, is_image = _to_array(value)
+        if array is None or array.dtype not in _DTYPES or array.ndim > _MAX_DIMS:
+            self._counters.add(_UNCACHED)
+            return value
+
+        with self._lock:
+            offset = int(self._used.values[0])
+            # Filled, or being filled by another worker that missed it at the same time
+            if self._slots[slot, self._STATE] != self._EMPTY:
+                return value
+            if offset + array.nbytes > self.max_bytes:
+                self._counters.add(_UNCACHED)
+                return value
+            self._used.add(0, array.nbytes)
+            self._slots[slot, self._STATE] = self._RESERVED
+        self._data[offset:offset + array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        meta = self._slots[slot]
+        meta[self._OFFSET] = offset
+        meta[self._DTYPE] = _DTYPES.index(array.dtype)
+        meta[self._IS_IMAGE] = is_image
+        meta[self._NDIM] = array.ndim
+        meta[self._SHAPE:self._SHAPE + array.ndim] = array.shape
+        # Publishes the slot
+        meta[self._STATE] = array.nbytes + 1
+        return value
+
+    def __contains__(self, slot: int):
+        return self._is_filled(slot)
+
+    @property
+    def num_bytes(self):
+        return int(self._used.values[0])
+
+    def stats(self):
+        hits, misses, _, uncached = (int(v) for v in self._counters.values)
+        return {'hits': hits, 'misses': misses, 'uncached': uncached, 'hit_rate': hits / max(hits + misses, 1),
+                'filled_slots': int((self._slots[:, self._STATE] > 0).sum()), 'num_slots': self.num_slots,
+                'num_bytes': self.num_bytes, 'max_bytes': self.max_bytes}
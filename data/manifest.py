@@ -0,0 +1,167 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+import uuid
+from   typing import Any, Callable, Dict, List, Optional
+
+
+# Bump whenever the url discovery code changes in a way that invalidates existing manifests
+MANIFEST_VERSION = 1
+
+# Default for how long the other ranks wait for local rank 0 to build a manifest
+DEFAULT_WAIT_TIMEOUT = 3 * 3600
+
+
+def default_cache_dir():
+    return os.environ.get('OMNIDATA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'omnidata'))
+
+
+def is_builder_rank():
+    ''' Only local rank 0 builds manifests; the other ranks of the node wait for them. '''
+    return int(os.environ.get('LOCAL_RANK', 0)) == 0
+
+
+def run_id():
+    '''
+        Identifies the launch the processes of a node belong to, so that with refresh the other ranks
+        accept exactly the entries local rank 0 rebuilt in this run. Ranks started by a launcher
+        (torchrun, torch.distributed.launch, srun: LOCAL_RANK is set from the start) are children of
+        the same launcher process. Otherwise this is the first process of the run, and the processes
+        it starts later (e.g. the ranks of Lightning's ddp accelerator) inherit the id through
+        OMNIDATA_RUN_ID. Set OMNIDATA_RUN_ID yourself for any other setup.
+    '''
+    if 'OMNIDATA_RUN_ID' not in os.environ:
+        if 'LOCAL_RANK' in os.environ:
+            os.environ['OMNIDATA_RUN_ID'] = f'{socket.gethostname()}-launcher-{os.getppid()}'
+        else:
+            os.environ['OMNIDATA_RUN_ID'] = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    return os.environ['OMNIDATA_RUN_ID']
+
+
+class ManifestStore:
+    '''
+        Directory of cached dataset manifests (url lists, sample indices, ...), keyed by the content
+        they depend on (data root, tasks, split, variant, code version) instead of by name.
+
+        Entries are directories written to a temporary location and renamed into place, so readers
+        never see a partial entry. Builds run under an exclusive file lock on the builder rank while
+        the other ranks wait for the entry to appear and then load (e.g. memory-map) it. Every entry
+        records the run_id() of the run that built it; with refresh, waiting ranks wait for an entry
+        of their own run. Waiting longer than timeout seconds (None: forever) raises TimeoutError.
+    '''
+    def __init__(self, cache_dir: Optional[str] = None, poll_interval: float = 1.0,
+                 timeout: Optional[float] = DEFAULT_WAIT_TIMEOUT):
+        self.cache_dir = default_cache_dir() if cache_dir is None else os.path.expanduser(cache_dir)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def path(self, kind: str, key: Dict[str, Any]) -> str:
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'{kind}-{digest}')
+
+    def get_or_build(self, kind: str, key: Dict[str, Any], build: Callable[[str], None], load: Callable[[str], Any],
+                     refresh: bool = False):
+        '''
+            Returns load(path) of the entry for key, calling build(path) first if the entry does not
+            exist yet (or refresh is set). build must write the entry's files into the given directory.
+        '''
+        path = self.path(kind, key)
+        if is_builder_rank():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f'{path}.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if refresh or not self._is_complete(path):
+                        self._build(path, key, build)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        else:
+            self._wait_for(path, build_id=run_id() if refresh else None)
+        return load(path)
+
+    def _build(self, path, key, build):
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        build(tmp_path)
+        with open(os.path.join(tmp_path, 'build.json'), 'w') as f:
+            json.dump({'run_id': run_id(), 'time': time.time()}, f)
+        # Written last: marks the entry as complete
+        with open(os.path.join(tmp_path, 'key.json'), 'w') as f:
+            json.dump(key, f, sort_keys=True)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _is_complete(path):
+        return os.path.exists(os.path.join(path, 'key.json'))
+
+    @staticmethod
+    def _build_id(path):
+        with open(os.path.join(path, 'build.json')) as f:
+            return json.load(f)['run_id']
+
+    def _is_ready(self, path, build_id):
+        try:
+            return self._is_complete(path) and (build_id is None or self._build_id(path) == build_id)
+        except FileNotFoundError:
+            # The builder is just replacing the entry
+            return False
+
+    def _wait_for(self, path, build_id=None):
+        waited = 0.0
+        while not self._is_ready(path, build_id):
+            if self.timeout is not None and waited > self.timeout:
+                what = 'to be built' if build_id is None else f'to be rebuilt by run {build_id}'
+                raise TimeoutError(f'Timed out after {waited:.0f}s waiting for manifest {path} {what} by local rank 0. '
+                                   'Check whether local rank 0 failed; if the ranks of this node were not started by '
+                                   'one launcher or by local rank 0, give them the same OMNIDATA_RUN_ID.')
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+
+def save_urls(path: str, urls: Dict[str, List[str]], root: str):
+    '''
+        Writes per-task urls relative to root: the directories once, with the number of files
+        and the newline-joined file names that follow each of them.
+    '''
+    root = os.path.normpath(os.path.expanduser(root))
+    encoded = {}
+    for task, task_urls in urls.items():
+        dirs, counts, names = [], [], []
+        for url in task_urls:
+            directory, name = url.rsplit('/', 1)
+            if not dirs or dirs[-1] != directory:
+                dirs.append(directory)
+                counts.append(0)
+            counts[-1] += 1
+            names.append(name)
+        encoded[task] = {
+            'dirs': [os.path.relpath(directory, root) for directory in dirs],
+            'counts': counts,
+            'names': '\n'.join(names),
+        }
+    with open(os.path.join(path, 'urls.json'), 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'tasks': encoded}, f)
+
+
+def load_urls(path: str, root: str) -> Dict[str, List[str]]:
+    root = os.path.normpath(os.path.expanduser(root))
+    with open(os.path.join(path, 'urls.json')) as f:
+        encoded = json.load(f)['tasks']
+    urls = {}
+    for task, entry in encoded.items():
+        names = entry['names'].split('\n') if entry['names'] else []
+        task_urls, start = [], 0
+        for directory, count in zip(entry['dirs'], entry['counts']):
+            prefix = os.path.normpath(os.path.join(root, directory)) + '/'
+            task_urls += [prefix + name for name in names[start:start + count]]
+            start += count
+        urls[task] = task_urls
+    return urls
@@ -2,6 +2,7 @@ import functools, operator
 
 import torch
 import torch.nn.functional as F
+from   typing import Optional, Tuple, Union
 import warnings
 
 from .task_configs import task_parameters as TASK_PARAMETERS
@@ -9,14 +10,19 @@ from .task_configs import task_parameters as TASK_PARAMETERS
 DEFAULT_MASK_EXTRA_RADIUS=5
 
 def make_mask(tensor, task):
-    return build_mask(tensor.unsqueeze(1), val=task_parameters[task]['mask_val'])[0]
+    return build_mask(tensor.unsqueeze(1), val=TASK_PARAMETERS[task]['mask_val'])[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _ones_kernel(size, device):
+    return torch.ones(1, 1, size, size, device=device)
 
 def build_mask(target, val=0.0, tol=1e-3, mask_extra_radius=DEFAULT_MASK_EXTRA_RADIUS):
     if target.shape[1] == 1:
         mask = ((target >= val - tol) & (target <= val + tol))
         #mask = F.conv2d(mask.float(), torch.ones(1, 1, 5, 5, device=mask.device), padding=2) != 0
         mask = (0 != F.conv2d(mask.float(),
-                        torch.ones(1, 1, mask_extra_radius, mask_extra_radius, device=mask.device),
+                        _ones_kernel(mask_extra_radius, mask.device),
                         padding=(mask_extra_radius // 2)) )
         return (~mask).expand_as(target)
 
@@ -25,7 +31,7 @@ def build_mask(target, val=0.0, tol=1e-3, mask_extra_radius=DEFAULT_MASK_EXTRA_R
     masks = [(t >= val - tol) & (t <= val + tol) for t in masks]
     mask = functools.reduce(lambda a,b: a&b, masks).unsqueeze(1)
     mask = (0 != F.conv2d(mask.float(),
-                        torch.ones(1, 1, mask_extra_radius, mask_extra_radius, device=mask.device),
+                        _ones_kernel(mask_extra_radius, mask.device),
                         padding=(mask_extra_radius // 2)) )
 #     mask = F.conv2d(mask.float(), torch.ones(1, 1, 5, 5, device=mask.device), padding=2) != 0
     return (~mask).expand_as(target)
@@ -56,4 +62,59 @@ def make_mask_from_data(tensors, tasks, mask_extra_radius=DEFAULT_MASK_EXTRA_RAD
                               val=TASK_PARAMETERS[task]['mask_val'])
 
     raise ValueError(f'Could not make mask for any task in {tasks}')
-    
\ No newline at end of file
+
+
+def _valid_blocks(mask: torch.Tensor, max_pool_size: int) -> torch.Tensor:
+    ''' [N, C, H // k, W // k] bool: True where every pixel of the k x k block has mask value 1 '''
+    n, c, h, w = mask.shape
+    k = max_pool_size
+    hs, ws = h // k, w // k
+    blocks = mask[:, :, :hs * k, :ws * k].reshape(n, c, hs, k, ws, k)
+    return blocks.amin(dim=5).amin(dim=3) == 1
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_valid_blocks():
+    # torch.compile where available (torch >= 2.0), TorchScript otherwise
+    if hasattr(torch, 'compile'):
+        return torch.compile(_valid_blocks, dynamic=True)
+    return torch.jit.script(_valid_blocks)
+
+
+def make_valid_mask(mask_float: torch.Tensor, image_size: Optional[Union[int, Tuple[int, int]]] = None,
+                    max_pool_size: int = 4, dtype: torch.dtype = torch.bool, compiled: bool = False):
+    '''
+        Creates a mask indicating the valid parts of the image(s): the mask_valid of the dataset with
+        the invalid area enlarged to whole max_pool_size x max_pool_size blocks, resized (nearest) to
+        image_size (an int for square images, or (height, width); default: the size of the input).
+
+        Same result as the former LightningModule.make_valid_mask
+            1 - mask -> max_pool2d(max_pool_size) -> interpolate(image_size, 'nearest') -> == 0
+        but the block minimum is taken on a view of the input and the block grid is expanded
+        directly into the output, so no full size float tensor is allocated.
+
+        Args:
+            mask_float: [C, H, W], [B, C, H, W] or [B, P, C, H, W] (num_positive views) mask
+            dtype: of the output, e.g. torch.uint8 or torch.float for multiplying with losses
+            compiled: run the block reduction through torch.compile (or TorchScript on older torch)
+    '''
+    if mask_float.dim() == 3:
+        mask_float = mask_float.unsqueeze(0)
+    leading = mask_float.shape[:-3]
+    mask = mask_float.reshape((-1,) + tuple(mask_float.shape[-3:]))
+    h, w = mask.shape[-2:]
+    if image_size is None:
+        image_size = (h, w)
+    elif isinstance(image_size, int):
+        image_size = (image_size, image_size)
+
+    valid = (_compiled_valid_blocks() if compiled else _valid_blocks)(mask, max_pool_size)
+    n, c, hs, ws = valid.shape
+    if image_size == (hs * max_pool_size, ws * max_pool_size):
+        k = max_pool_size
+        # Columns first, then whole rows: both copies are contiguous runs (much faster than one 6d expand)
+        valid = valid[..., None].expand(n, c, hs, ws, k).reshape(n, c, hs, 1, ws * k)
+        valid = valid.expand(n, c, hs, k, ws * k).reshape(n, c, hs * k, ws * k)
+    else:
+        valid = F.interpolate(valid.float(), image_size, mode='nearest') > 0.5
+    return valid.to(dtype).reshape(tuple(leading) + valid.shape[1:])
@@ -0,0 +1,133 @@
+'''
+    Keeps the 16-bit single channel tasks (depth, edges, keypoints, ...) of one split as raw uint16
+    arrays in one memory-mapped file per task, so that loading a sample is a page cache read instead
+    of a PNG decode. Build a store with
+
+        python -m data.preprocess --format memmap --datasets taskonomy replica --split train \
+            --tasks rgb normal depth_zbuffer edge_occlusion mask_valid \
+            --image_size 256 --out_dir /scratch/memmap/train-256
+
+    and pass the same dataset options plus memmap_store_dir=/scratch/memmap/train-256 to
+    TaskonomyReplicaGsoDataset. Stored tasks are then returned as int16 views of the file (the same
+    bits ToTensor produces for 16-bit PNGs) and have to be converted to float after collation:
+
+        batch['positive'] = finalize_batch(batch['positive'], dataset.raw_tasks)
+'''
+import json
+import os
+import numpy as np
+import torch
+import torch.utils.data as data
+from   tqdm import tqdm
+from   typing import Dict, List
+
+from .transforms import get_finalize_transform, RAW_16BIT_TASKS
+
+
+MEMMAP_STORE_VERSION = 1
+
+
+class MemmapTaskStore:
+    '''
+        One uint16[N, 1, H, W] .npy file per task, with row i holding row i of the SampleIndex the
+        store was built from.
+
+            store_dir/
+                meta.json           tasks, image size, number of rows, sample index it belongs to
+                depth_zbuffer.npy
+                ...
+
+        The files are opened lazily in each process (copy-on-write, so torch.from_numpy gets a
+        writable view without touching the file), which keeps them out of the dataset's pickle.
+    '''
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != MEMMAP_STORE_VERSION:
+            raise ValueError(f'Memmap store at {store_dir} has version {meta["version"]}, expected {MEMMAP_STORE_VERSION}.')
+        self.tasks = meta['tasks']
+        self.image_size = meta['image_size']
+        self.num_rows = meta['num_rows']
+        self.index_name = meta['index']
+        self._arrays = None
+
+    def check_index(self, index_path: str, num_rows: int):
+        if os.path.basename(index_path) != self.index_name or num_rows != self.num_rows:
+            raise ValueError(f'Memmap store {self.store_dir} was built for sample index {self.index_name} '
+                             f'({self.num_rows} rows), not {os.path.basename(index_path)} ({num_rows} rows). '
+                             'Rebuild it with the same dataset options.')
+
+    def _open(self):
+        self._arrays = {
+            task: np.load(os.path.join(self.store_dir, f'{task}.npy'), mmap_mode='c').view(np.int16)
+            for task in self.tasks
+        }
+
+    def get(self, task: str, row: int) -> torch.Tensor:
+        ''' int16[1, H, W] view of the stored sample, no copy '''
+        if self._arrays is None:
+            self._open()
+        return torch.from_numpy(self._arrays[task][row])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+class _RowLoader(data.Dataset):
+    ''' Loads the raw stored tasks of index rows in index order '''
+    def __init__(self, dataset, tasks):
+        self.dataset = dataset
+        self.tasks = tasks
+
+    def __len__(self):
+        return len(self.dataset.index)
+
+    def __getitem__(self, row):
+        return {task: self.dataset.load_task(task, row) for task in self.tasks}
+
+
+def build_memmap_store(dataset, store_dir: str, tasks: List[str], num_workers: int = 16):
+    '''
+        Writes the given 16-bit tasks of every row of dataset.index into store_dir. The dataset
+        has to use raw transforms (see transforms.get_raw_transform) and a fixed image_size.
+    '''
+    unsupported = [task for task in tasks if task not in RAW_16BIT_TASKS]
+    if unsupported:
+        raise ValueError(f'Only 16-bit single channel tasks can be stored in a memmap store, not {unsupported}.')
+    size = dataset.image_size
+    os.makedirs(store_dir, exist_ok=True)
+    arrays = {
+        task: np.lib.format.open_memmap(os.path.join(store_dir, f'{task}.npy'), mode='w+',
+                                        dtype=np.uint16, shape=(len(dataset.index), 1, size, size))
+        for task in tasks
+    }
+    loader = data.DataLoader(_RowLoader(dataset, tasks), batch_size=None, shuffle=False, num_workers=num_workers)
+    for row, sample in enumerate(tqdm(loader, desc=f'Writing memmap store to {store_dir}')):
+        for task in tasks:
+            arrays[task][row] = sample[task].numpy().view(np.uint16)
+    for array in arrays.values():
+        array.flush()
+    # Written last: marks the store as complete
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': MEMMAP_STORE_VERSION,
+            'tasks': tasks,
+            'image_size': size,
+            'num_rows': len(dataset.index),
+            'index': os.path.basename(dataset.index_path),
+        }, f)
+    print(f'Wrote {len(dataset.index)} samples of {tasks} into {store_dir}.')
+
+
+def finalize_batch(batch: Dict[str, torch.Tensor], tasks: List[str]) -> Dict[str, torch.Tensor]:
+    '''
+        Converts the raw int16 tasks of a collated batch (e.g. already on the GPU) to the float
+        values get_transform would have produced.
+    '''
+    for task in tasks:
+        if task in batch:
+            batch[task] = get_finalize_transform(task)(batch[task])
+    return batch
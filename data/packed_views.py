@@ -0,0 +1,134 @@
+'''
+    Packs the files of all tasks of a (building, point, view) into one file, so that loading a sample
+    costs one open and one read instead of one per task. The files are stored as they are (png, jpg,
+    hdf5 bytes) and decoded exactly like the originals. Build a store with
+
+        python -m data.preprocess --format packed --datasets taskonomy replica hypersim --split train \
+            --tasks rgb normal segment_semantic depth_zbuffer mask_valid \
+            --image_size 256 --out_dir /scratch/packed/train
+
+    and pass the same dataset options plus packed_views_dir=/scratch/packed/train to
+    TaskonomyReplicaGsoDataset.
+
+    Every view file is
+
+        b'OMNIVIEW'                     magic
+        uint32 (little endian)          length of the header
+        header                          json: {task: [offset, length]}, offsets relative to the payload
+        payload                         the original files, back to back
+'''
+import json
+import os
+import struct
+import torch.utils.data as data
+from   tqdm import tqdm
+from   typing import Dict, List
+
+
+PACKED_VIEWS_VERSION = 1
+
+_MAGIC = b'OMNIVIEW'
+_HEADER_LENGTH = struct.Struct('<I')
+# Only these are decoded from bytes; npy / json files stay where they are
+PACKABLE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.hdf5')
+
+
+def packed_view_path(store_dir: str, building: str, point: str, view: str) -> str:
+    return os.path.join(store_dir, building, f'point_{point}_view_{view}.pack')
+
+
+def pack_view(files: Dict[str, bytes]) -> bytes:
+    header, offset = {}, 0
+    for task, contents in files.items():
+        header[task] = [offset, len(contents)]
+        offset += len(contents)
+    header = json.dumps(header).encode()
+    return b''.join([_MAGIC, _HEADER_LENGTH.pack(len(header)), header] + list(files.values()))
+
+
+def unpack_view(packed: bytes) -> Dict[str, memoryview]:
+    ''' {task: contents of its file}, as views of packed '''
+    if packed[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('Not a packed view file.')
+    start = len(_MAGIC) + _HEADER_LENGTH.size
+    header_length, = _HEADER_LENGTH.unpack_from(packed, len(_MAGIC))
+    header = json.loads(bytes(packed[start:start + header_length]))
+    payload = memoryview(packed)[start + header_length:]
+    return {task: payload[offset:offset + length] for task, (offset, length) in header.items()}
+
+
+class PackedViewStore:
+    '''
+        One packed file per row of the SampleIndex the store was built from:
+
+            store_dir/
+                meta.json                           tasks, number of rows, sample index it belongs to
+                <building>/point_<p>_view_<v>.pack
+    '''
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != PACKED_VIEWS_VERSION:
+            raise ValueError(f'Packed view store at {store_dir} has version {meta["version"]}, expected {PACKED_VIEWS_VERSION}.')
+        self.tasks = meta['tasks']
+        self.num_rows = meta['num_rows']
+        self.index_name = meta['index']
+
+    def check_index(self, index_path: str, num_rows: int):
+        if os.path.basename(index_path) != self.index_name or num_rows != self.num_rows:
+            raise ValueError(f'Packed view store {self.store_dir} was built for sample index {self.index_name} '
+                             f'({self.num_rows} rows), not {os.path.basename(index_path)} ({num_rows} rows). '
+                             'Rebuild it with the same dataset options.')
+
+    def path(self, building: str, point: str, view: str) -> str:
+        return packed_view_path(self.store_dir, building, point, view)
+
+    def read(self, building: str, point: str, view: str) -> Dict[str, memoryview]:
+        with open(self.path(building, point, view), 'rb') as f:
+            return unpack_view(f.read())
+
+
+class _RowPacker(data.Dataset):
+    ''' Packs the files of index rows; the workers do the reading and writing '''
+    def __init__(self, index, store_dir, tasks):
+        self.index = index
+        self.store_dir = store_dir
+        self.tasks = tasks
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, row):
+        files = {}
+        for task in self.tasks:
+            with open(self.index.url(task, row), 'rb') as f:
+                files[task] = f.read()
+        path = packed_view_path(self.store_dir, *self.index.bpv(row))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(pack_view(files))
+        os.replace(path + '.tmp', path)
+        return row
+
+
+def build_packed_views(dataset, store_dir: str, tasks: List[str], num_workers: int = 16):
+    ''' Packs the files of the given tasks of every row of dataset.index into store_dir '''
+    index = dataset.index
+    for task in tasks:
+        url = index.url(task, 0)
+        if not url.endswith(PACKABLE_EXTENSIONS):
+            raise ValueError(f'Task {task} has {os.path.splitext(url)[1]} files, only {PACKABLE_EXTENSIONS} can be packed.')
+    os.makedirs(store_dir, exist_ok=True)
+    loader = data.DataLoader(_RowPacker(index, store_dir, tasks), batch_size=None, shuffle=False, num_workers=num_workers)
+    for _ in tqdm(loader, desc=f'Packing views into {store_dir}'):
+        pass
+    # Written last: marks the store as complete
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': PACKED_VIEWS_VERSION,
+            'tasks': tasks,
+            'num_rows': len(index),
+            'index': os.path.basename(dataset.index_path),
+        }, f)
+    print(f'Packed {len(index)} views of {tasks} into {store_dir}.')
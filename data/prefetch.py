@@ -0,0 +1,100 @@
+'''
+    Asynchronous file reads for the DataLoader workers: the files of the next samples are requested
+    together and read by a thread pool while the worker decodes the ones that already arrived. Reads
+    release the GIL, so on network file systems (NFS, Lustre) where every open / read waits for a
+    round trip, up to num_threads requests are in flight per worker instead of one.
+
+        reader = PrefetchingReader(num_threads=16)
+        reader.prefetch(paths)          # returns immediately
+        data = reader.read(paths[0])    # bytes; waits for the prefetch, or reads directly
+
+    A path requested n times (e.g. a view shared by two samples of a batch) is read once and can be
+    read() n times. retain(counts) drops the unread requests except those of e.g. the next batch.
+
+    Only the raw bytes are prefetched; decoding stays with the caller (decoders.decode_file).
+'''
+from   collections import OrderedDict
+from   concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from   typing import Dict, Iterable
+
+from .image_cache import _SharedCounters
+
+
+_PREFETCHED, _WAITED, _DIRECT = range(3)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class PrefetchingReader:
+    '''
+        Reads files on a pool of num_threads threads, created lazily in every process (so that a
+        reader created before the DataLoader forks its workers is safe to use in them). At most
+        max_pending files are outstanding; older requests that were never read are dropped first.
+    '''
+    def __init__(self, num_threads: int = 16, max_pending: int = 1024):
+        self.num_threads = num_threads
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._pool, self._pid = None, None
+        self._lock = threading.Lock()
+        self._counters = _SharedCounters(3)
+
+    def _executor(self):
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pending, self._pid = OrderedDict(), os.getpid()
+        return self._pool
+
+    def prefetch(self, paths: Iterable[str]):
+        with self._lock:
+            pool = self._executor()
+            for path in paths:
+                entry = self._pending.get(path)
+                if entry is not None:
+                    entry[1] += 1
+                    continue
+                self._pending[path] = [pool.submit(read_bytes, path), 1]
+                if len(self._pending) > self.max_pending:
+                    self._pending.popitem(last=False)[1][0].cancel()
+
+    def read(self, path: str) -> bytes:
+        future = None
+        with self._lock:
+            entry = self._pending.get(path) if self._pid == os.getpid() else None
+            if entry is not None:
+                future, entry[1] = entry[0], entry[1] - 1
+                if entry[1] == 0:
+                    del self._pending[path]
+        if future is None or future.cancelled():
+            self._counters.add(_DIRECT)
+            return read_bytes(path)
+        self._counters.add(_PREFETCHED if future.done() else _WAITED)
+        return future.result()
+
+    def retain(self, counts: Dict[str, int]):
+        ''' Cancels the requests that were not read (yet), except those of counts, kept to be read counts[path] times '''
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for path in list(self._pending):
+                if counts.get(path, 0) > 0:
+                    self._pending[path][1] = counts[path]
+                else:
+                    self._pending.pop(path)[0].cancel()
+
+    def clear(self):
+        ''' Cancels the requests that were not read (yet) '''
+        with self._lock:
+            for future, _ in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+
+    def stats(self):
+        ''' How reads were served: already prefetched, waited for a prefetch, or read directly '''
+        prefetched, waited, direct = (int(v) for v in self._counters.values)
+        return {'prefetched': prefetched, 'waited': waited, 'direct': direct}
@@ -0,0 +1,116 @@
+'''
+    Runs the decode / resize / label remapping part of the TaskonomyReplicaGsoDataset pipeline once
+    and writes the resulting uint8 / int16 tensors into shards for ShardedTaskonomyDataset, e.g.
+
+        python -m data.preprocess --datasets taskonomy replica hypersim --split train \
+            --tasks rgb normal segment_semantic depth_zbuffer mask_valid \
+            --image_size 256 --out_dir /scratch/shards/train-256
+
+    With --format memmap, only the 16-bit tasks among --tasks are written, into a MemmapTaskStore
+    that TaskonomyReplicaGsoDataset reads through its memmap_store_dir option. With --format packed,
+    the original files of each view are packed into one file (see packed_views.py) for its
+    packed_views_dir option; --image_size is then ignored.
+'''
+import argparse
+import torch
+from   torch.utils.data import DataLoader
+from   tqdm import tqdm
+
+from .taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset
+from .transforms import get_raw_transform, RAW_LABEL_TASKS, RAW_16BIT_TASKS, RAW_LABEL_DTYPE
+from .sharded_dataset import ShardWriter
+from .memmap_store import build_memmap_store
+from .packed_views import build_packed_views
+
+
+def preprocess(options: TaskonomyReplicaGsoDataset.Options, out_dir, samples_per_shard=256, num_workers=16, seed=0):
+    '''
+        Writes all samples of the dataset described by options into shards in out_dir.
+        Samples are written in a shuffled order, so consecutive records come from different buildings.
+    '''
+    if options.image_size is None:
+        raise ValueError('Shards need a fixed image_size.')
+    options.transform = {task: get_raw_transform(task, options.image_size) for task in options.tasks}
+    options.normalize_rgb = False
+    options.num_positive = 1
+    dataset = TaskonomyReplicaGsoDataset(options)
+    dataset.randomize_order(seed=seed)
+
+    writer = ShardWriter(out_dir, options.tasks, samples_per_shard=samples_per_shard)
+    loader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+    for i, sample in enumerate(tqdm(loader, desc=f'Writing shards to {out_dir}')):
+        sample = sample['positive']
+        for task in RAW_LABEL_TASKS:
+            if task in sample:
+                sample[task] = sample[task].to(RAW_LABEL_DTYPE)
+        building, point, view = dataset.index.bpv(dataset.sample_order[i])
+        writer.write(sample, building, point, view)
+    writer.close()
+    print(f'Wrote {len(writer.index)} samples into {len(writer.shards)} shards.')
+
+
+def preprocess_memmap(options: TaskonomyReplicaGsoDataset.Options, out_dir, num_workers=16):
+    '''
+        Writes the 16-bit tasks of the dataset described by options into a memmap store in out_dir,
+        in sample index order. The other tasks are only needed to select the same samples.
+    '''
+    if options.image_size is None:
+        raise ValueError('A memmap store needs a fixed image_size.')
+    stored_tasks = [task for task in options.tasks if task in RAW_16BIT_TASKS]
+    if not stored_tasks:
+        raise ValueError(f'None of {options.tasks} is a 16-bit task.')
+    options.transform = {task: get_raw_transform(task, options.image_size) for task in options.tasks}
+    options.memmap_store_dir = None
+    dataset = TaskonomyReplicaGsoDataset(options)
+    build_memmap_store(dataset, out_dir, stored_tasks, num_workers=num_workers)
+
+
+def preprocess_packed(options: TaskonomyReplicaGsoDataset.Options, out_dir, num_workers=16):
+    ''' Packs the files of all tasks of each view of the dataset described by options into out_dir '''
+    options.memmap_store_dir = None
+    options.packed_views_dir = None
+    dataset = TaskonomyReplicaGsoDataset(options)
+    build_packed_views(dataset, out_dir, options.tasks, num_workers=num_workers)
+
+
+def main():
+    defaults = TaskonomyReplicaGsoDataset.Options()
+    parser = argparse.ArgumentParser(description='Bake resized and remapped samples into shards or a memmap store.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Output directory for the shards / memmap store.')
+    parser.add_argument('--format', type=str, default='shards', choices=['shards', 'memmap', 'packed'])
+    parser.add_argument('--image_size', type=int, required=True, help='Image size the samples are resized to.')
+    parser.add_argument('--tasks', type=str, nargs='+', default=['rgb', 'normal', 'segment_semantic', 'depth_zbuffer', 'mask_valid'])
+    parser.add_argument('--datasets', type=str, nargs='+', default=defaults.datasets)
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--taskonomy_variant', type=str, default=defaults.taskonomy_variant)
+    parser.add_argument('--taskonomy_root', type=str, default=defaults.taskonomy_data_path)
+    parser.add_argument('--replica_root', type=str, default=defaults.replica_data_path)
+    parser.add_argument('--gso_root', type=str, default=defaults.gso_data_path)
+    parser.add_argument('--hypersim_root', type=str, default=defaults.hypersim_data_path)
+    parser.add_argument('--samples_per_shard', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    options = TaskonomyReplicaGsoDataset.Options(
+        taskonomy_data_path=args.taskonomy_root,
+        replica_data_path=args.replica_root,
+        gso_data_path=args.gso_root,
+        hypersim_data_path=args.hypersim_root,
+        split=args.split,
+        taskonomy_variant=args.taskonomy_variant,
+        tasks=args.tasks,
+        datasets=args.datasets,
+        image_size=args.image_size,
+    )
+    if args.format == 'memmap':
+        preprocess_memmap(options, args.out_dir, num_workers=args.num_workers)
+    elif args.format == 'packed':
+        preprocess_packed(options, args.out_dir, num_workers=args.num_workers)
+    else:
+        preprocess(options, args.out_dir, samples_per_shard=args.samples_per_shard,
+                   num_workers=args.num_workers, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
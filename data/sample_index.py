@@ -0,0 +1,263 @@
+from   collections import Counter
+import json
+import os
+import re
+import numpy as np
+from   typing import Callable, Dict, List, Optional, Iterable, Tuple
+
+
+INDEX_FORMAT_VERSION = 1
+
+_FILENAME_RE = re.compile(r'(?P<prefix>.*?)point_(?P<point>\d+)_view_(?P<view>\d+)(?P<suffix>.*)')
+_LABEL_FILE_RE = re.compile(r'.*point_(?P<point>\d+)_view_(?P<view>\d+)_domain_(?P<domain>\w+)')
+_COLUMNS = ['building', 'point', 'view', 'group', 'group_offsets', 'templates', 'task_dirs']
+
+
+def building_from_url(url: str) -> str:
+    '''
+        Returns the building name of a url, following the directory layout of each dataset:
+            taskonomy:  root/task/building/file
+            replica:    root/building/task/file
+            gso:        root/apartment/seed/task/file           -> apartment-seed
+            hypersim:   root/scene/taskonomized/cam/task/file   -> scene-cam
+    '''
+    parts = url.split('/')
+    if 'replica-taskonomized' in url:
+        return parts[-3]
+    elif 'replica-google-objects' in url: # e.g apartment_0-3, apartment_0-6
+        return parts[-4] + '-' + parts[-3]
+    elif 'hypersim' in url: # e.g ai_001_001-cam_00, ai_001_001-cam_01
+        return parts[-5] + '-' + parts[-3]
+    elif 'taskonomy' in url:
+        return parts[-2]
+    raise NotImplementedError('Dataset path (url) not recognized!')
+
+
+def encode_keys(building, point, view, n_points, n_views):
+    ''' Packs (building, point, view) integer columns into one sortable int64 key '''
+    return (building.astype(np.int64) * n_points + point) * n_views + view
+
+
+def remove_unmatched_urls(urls: Dict[str, List[str]], building_fn: Callable[[str], str] = building_from_url,
+                          max_report: int = 20) -> Tuple[Dict[str, List[str]], int]:
+    '''
+        Filters out (building, point, view) triplets that are not present for all tasks.
+
+        Every url is parsed once into an integer key (building, point and view strings are interned,
+        so e.g. point '01' and '1' stay different, as they are different files); the keys of all tasks
+        are intersected as sorted arrays. The number of dropped urls per building is printed.
+
+        Returns:
+            filtered_urls: Filtered Dict
+            max_length: max([len(urls) for _, urls in filtered_urls.items()])
+    '''
+    n_images_task = [(len(obs), task) for task, obs in urls.items()]
+    if max(n_images_task)[0] == min(n_images_task)[0]:
+        return urls, max(n_images_task)[0]
+    print("Each task must have the same number of images. However, the max != min ({} != {}). Number of images per task is: \n\t{}".format(
+        max(n_images_task)[0], min(n_images_task)[0], "\n\t".join([str(t) for t in n_images_task])))
+
+    building_ids, point_ids, view_ids = {}, {}, {}
+    parsed = {}
+    for task, task_urls in urls.items():
+        b, p, v = np.empty(len(task_urls), np.int64), np.empty(len(task_urls), np.int64), np.empty(len(task_urls), np.int64)
+        for i, url in enumerate(task_urls):
+            m = _LABEL_FILE_RE.match(url.rsplit('/', 1)[-1])
+            if m is None:
+                raise ValueError('Filename "{}" not matched. Must be of form point_XX_view_YY_domain_ZZ.**.'.format(url))
+            b[i] = building_ids.setdefault(building_fn(url), len(building_ids))
+            p[i] = point_ids.setdefault(m.group('point'), len(point_ids))
+            v[i] = view_ids.setdefault(m.group('view'), len(view_ids))
+        parsed[task] = (b, p, v)
+
+    keys, common = {}, None
+    for task, (b, p, v) in parsed.items():
+        keys[task] = encode_keys(b, p, v, max(len(point_ids), 1), max(len(view_ids), 1))
+        common = np.unique(keys[task]) if common is None else np.intersect1d(common, keys[task])
+
+    print('Keeping intersection: ({} images/task)...'.format(len(common)))
+    new_urls, dropped = {}, Counter()
+    buildings = sorted(building_ids, key=building_ids.get)
+    for task, task_urls in urls.items():
+        keep = np.isin(keys[task], common)
+        new_urls[task] = [url for url, k in zip(task_urls, keep) if k]
+        dropped.update(buildings[b] for b in parsed[task][0][~keep])
+    print('Unmatched images per building: {}'.format(
+        ', '.join(f'{building}: {count}' for building, count in dropped.most_common(max_report))
+        + (f', ... ({len(dropped)} buildings)' if len(dropped) > max_report else '')))
+    return new_urls, len(common)
+
+
+class SampleIndex:
+    '''
+        Columnar index of all (building, point, view) samples that are present for every task.
+
+        Rows are sorted by (building, point, view), so all views of a (building, point) form one
+        contiguous group. Strings (buildings, directories, file name templates) live in a small
+        string table; everything else is stored as integer numpy columns that can be memory-mapped:
+
+            building:       int32[N]        id into `buildings`
+            point, view:    int32[N]
+            group:          int32[N]        id of the (building, point) group of the row
+            group_offsets:  int64[G + 1]    rows of group g are group_offsets[g]:group_offsets[g+1]
+            templates:      int32[T, N]     id into `templates` (file name prefix/suffix) per task
+            task_dirs:      int32[T, B]     id into `dirs` holding the files of a building per task
+
+        The url of (task, row) is dirs[task_dirs[t, building[row]]]/<prefix>point_<p>_view_<v><suffix>.
+    '''
+
+    def __init__(self, tasks, buildings, dirs, templates, columns):
+        self.tasks = list(tasks)
+        self.buildings = list(buildings)
+        self.dirs = list(dirs)
+        self.templates = [tuple(t) for t in templates]
+        self.building = columns['building']
+        self.point = columns['point']
+        self.view = columns['view']
+        self.group = columns['group']
+        self.group_offsets = columns['group_offsets']
+        self.template_ids = columns['templates']
+        self.task_dirs = columns['task_dirs']
+        self._task_to_id = {task: i for i, task in enumerate(self.tasks)}
+
+    def __len__(self):
+        return len(self.building)
+
+    @property
+    def num_groups(self):
+        return len(self.group_offsets) - 1
+
+    @property
+    def num_buildings(self):
+        return len(self.buildings)
+
+    def bpv(self, row: int) -> Tuple[str, str, str]:
+        ''' Returns (building, point, view) of a row, as the strings found in the file names '''
+        return self.buildings[self.building[row]], str(self.point[row]), str(self.view[row])
+
+    def url(self, task: str, row: int) -> str:
+        t = self._task_to_id[task]
+        prefix, suffix = self.templates[self.template_ids[t, row]]
+        directory = self.dirs[self.task_dirs[t, self.building[row]]]
+        return f'{directory}/{prefix}point_{self.point[row]}_view_{self.view[row]}{suffix}'
+
+    def group_rows(self, row: int) -> range:
+        ''' All rows (i.e. views) sharing the (building, point) of `row` '''
+        g = self.group[row]
+        return range(int(self.group_offsets[g]), int(self.group_offsets[g + 1]))
+
+    @classmethod
+    def from_urls(cls, urls: Dict[str, List[str]], tasks: Optional[List[str]] = None,
+                  skip_buildings: Iterable[str] = ()) -> 'SampleIndex':
+        '''
+            Builds the index from per-task url lists, keeping only the samples present for all tasks.
+            Each url is parsed exactly once.
+        '''
+        tasks = list(urls.keys()) if tasks is None else list(tasks)
+        skip_buildings = set(skip_buildings)
+        building_ids, dir_ids, template_ids = {}, {}, {}
+
+        parsed = {}
+        for task in tasks:
+            task_urls = urls[task]
+            n = len(task_urls)
+            b, p, v = np.empty(n, np.int32), np.empty(n, np.int32), np.empty(n, np.int32)
+            d, t = np.empty(n, np.int32), np.empty(n, np.int32)
+            keep = np.ones(n, dtype=bool)
+            for i, url in enumerate(task_urls):
+                building = building_from_url(url)
+                if building in skip_buildings:
+                    keep[i] = False
+                    continue
+                directory, file_name = url.rsplit('/', 1)
+                m = _FILENAME_RE.match(file_name)
+                if m is None:
+                    raise ValueError(f'Filename "{file_name}" not matched. Must be of form point_XX_view_YY_**.')
+                point, view = m.group('point'), m.group('view')
+                if str(int(point)) != point or str(int(view)) != view:
+                    raise ValueError(f'Filename "{file_name}" has zero-padded point/view ids, which the index does not support.')
+                b[i] = building_ids.setdefault(building, len(building_ids))
+                p[i], v[i] = int(point), int(view)
+                d[i] = dir_ids.setdefault(directory, len(dir_ids))
+                t[i] = template_ids.setdefault((m.group('prefix'), m.group('suffix')), len(template_ids))
+            parsed[task] = (b[keep], p[keep], v[keep], d[keep], t[keep])
+
+        # Relabel buildings in sorted order so that row order is (building, point, view)
+        names = sorted(building_ids, key=building_ids.get)
+        order = np.argsort(np.array(names, dtype=object)).astype(np.int32) if names else np.zeros(0, np.int32)
+        rank = np.empty(len(names), np.int32)
+        rank[order] = np.arange(len(names), dtype=np.int32)
+        names = [names[i] for i in order]
+
+        n_points = max([int(c[1].max()) + 1 for c in parsed.values() if len(c[1])] + [1])
+        n_views = max([int(c[2].max()) + 1 for c in parsed.values() if len(c[2])] + [1])
+
+        keys, common = {}, None
+        for task, (b, p, v, _, _) in parsed.items():
+            keys[task] = encode_keys(rank[b], p, v, n_points, n_views)
+            common = keys[task] if common is None else np.intersect1d(common, keys[task])
+        common = np.unique(common) if common is not None else np.zeros(0, np.int64)
+
+        building = (common // (n_points * n_views)).astype(np.int32)
+        point = ((common // n_views) % n_points).astype(np.int32)
+        view = (common % n_views).astype(np.int32)
+
+        # Drop buildings without any complete sample
+        used, building = np.unique(building, return_inverse=True)
+        building = building.astype(np.int32)
+        names = [names[i] for i in used]
+
+        template_col = np.empty((len(tasks), len(common)), np.int32)
+        task_dirs = np.full((len(tasks), len(names)), -1, np.int32)
+        for ti, task in enumerate(tasks):
+            task_keys = keys[task]
+            sort = np.argsort(task_keys, kind='stable')
+            rows = sort[np.searchsorted(task_keys, common, sorter=sort)]
+            _, _, _, d, t = parsed[task]
+            template_col[ti] = t[rows]
+            task_dirs[ti, building] = d[rows]
+            if not np.array_equal(task_dirs[ti, building], d[rows]):
+                raise ValueError(f'Files of one building are spread over several directories for task {task}.')
+
+        bp = building.astype(np.int64) * n_points + point
+        boundaries = np.flatnonzero(np.diff(bp)) + 1 if len(bp) else np.zeros(0, np.int64)
+        group_offsets = np.concatenate([[0], boundaries, [len(bp)]]).astype(np.int64)
+        group = np.zeros(len(bp), np.int32)
+        group[boundaries] = 1
+        group = np.cumsum(group, dtype=np.int32)
+
+        columns = {
+            'building': building, 'point': point, 'view': view, 'group': group,
+            'group_offsets': group_offsets, 'templates': template_col, 'task_dirs': task_dirs,
+        }
+        dirs = sorted(dir_ids, key=dir_ids.get)
+        templates = sorted(template_ids, key=template_ids.get)
+        return cls(tasks, names, dirs, templates, columns)
+
+    def save(self, path: str):
+        ''' Writes the index into directory `path` '''
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': INDEX_FORMAT_VERSION,
+                'tasks': self.tasks,
+                'buildings': self.buildings,
+                'dirs': self.dirs,
+                'templates': self.templates,
+            }, f)
+        columns = {
+            'building': self.building, 'point': self.point, 'view': self.view, 'group': self.group,
+            'group_offsets': self.group_offsets, 'templates': self.template_ids, 'task_dirs': self.task_dirs,
+        }
+        for name in _COLUMNS:
+            np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(columns[name]))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'SampleIndex':
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != INDEX_FORMAT_VERSION:
+            raise ValueError(f'Sample index at {path} has version {meta["version"]}, expected {INDEX_FORMAT_VERSION}.')
+        mmap_mode = 'r' if mmap else None
+        columns = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in _COLUMNS}
+        return cls(meta['tasks'], meta['buildings'], meta['dirs'], meta['templates'], columns)
@@ -0,0 +1,217 @@
+from   collections import deque
+import math
+import numpy as np
+import torch
+from   torch.utils.data import BatchSampler, Sampler
+from   typing import List, Optional, Sequence
+
+from .sharded_dataset import get_rank_and_world_size
+
+
+def block_shuffle(boundaries: np.ndarray, rng: np.random.RandomState, window: int = 256) -> np.ndarray:
+    '''
+        Locality-aware permutation of rows boundaries[0]:boundaries[-1]: the units (rows
+        boundaries[u]:boundaries[u+1], e.g. the views of a (building, point)) are shuffled, and the rows
+        of the resulting sequence are then shuffled within consecutive windows of `window` rows.
+        Consecutive samples therefore stay within a few points' directories, which is what file
+        system read-ahead and the page cache need, while batches still mix several points.
+    '''
+    boundaries = np.asarray(boundaries, dtype=np.int64)
+    units = rng.permutation(len(boundaries) - 1)
+    lengths = np.diff(boundaries)[units]
+    # Rows of the shuffled units, back to back
+    unit_of_row = np.repeat(units, lengths)
+    rows = boundaries[unit_of_row] + (np.arange(len(unit_of_row)) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    if window > 1:
+        # Sorting by (window id, random key) permutes rows within each window
+        keys = rng.random_sample(len(rows))
+        rows = rows[np.lexsort((keys, np.arange(len(rows)) // window))]
+    return rows
+
+
+class MixtureSampler(Sampler):
+    '''
+        Samples indices into a ConcatDataset of datasets with the given sizes: each draw first picks
+        a dataset with probability proportional to ratios (default: all datasets equally often, what
+        WeightedRandomSampler with per-sample weights 1 / len(dataset) gives) and then a sample of it
+        uniformly, with replacement.
+
+        Nothing of size num_samples is allocated; draws are generated in chunks whose random state is
+        derived from (seed, epoch, rank, chunk). So an epoch is reproducible, can be resumed from
+        state_dict() at any position, and every DDP rank draws its own len(self) = num_samples / world_size
+        samples (use replace_sampler_ddp=False in Lightning).
+
+        `consumed` counts the indices handed to the DataLoader, which runs ahead of training by what
+        its workers prefetch. To resume from what was trained on, checkpoint
+        state_dict(consumed=sampler.start + batches_trained_this_iteration * batch_size).
+    '''
+    def __init__(self, sizes: Sequence[int], ratios: Optional[Sequence[float]] = None,
+                 num_samples: Optional[int] = None, seed: int = 0, chunk_size: int = 65536):
+        self.sizes = torch.as_tensor(list(sizes), dtype=torch.int64)
+        self.offsets = torch.cumsum(self.sizes, 0) - self.sizes
+        ratios = torch.ones(len(self.sizes), dtype=torch.float64) if ratios is None else torch.as_tensor(ratios, dtype=torch.float64)
+        ratios = ratios * (self.sizes > 0)
+        if ratios.sum() <= 0:
+            raise ValueError(f'MixtureSampler needs a non-empty dataset with a positive ratio (sizes {self.sizes.tolist()}).')
+        self.probs = ratios / ratios.sum()
+        self.num_samples = int(self.sizes.sum()) if num_samples is None else num_samples
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.epoch = 0
+        self.consumed = 0
+        self.start = 0  # Position the current iteration started from (> 0 in a resumed epoch)
+
+    def __len__(self):
+        _, world_size = get_rank_and_world_size()
+        return math.ceil(self.num_samples / world_size)
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.consumed = 0
+        self.epoch = epoch
+
+    def state_dict(self, consumed: Optional[int] = None):
+        ''' consumed: samples of this epoch to skip on resume, defaults to the ones handed out so far '''
+        return {'seed': self.seed, 'epoch': self.epoch, 'consumed': self.consumed if consumed is None else min(consumed, len(self))}
+
+    def load_state_dict(self, state):
+        self.seed, self.epoch, self.consumed = state['seed'], state['epoch'], state['consumed']
+
+    def _chunk(self, rank, chunk, n):
+        seed = np.random.SeedSequence([self.seed, self.epoch, rank, chunk]).generate_state(1, np.uint64)[0]
+        generator = torch.Generator().manual_seed(int(seed) & 0x7fff_ffff_ffff_ffff)
+        datasets = torch.multinomial(self.probs, n, replacement=True, generator=generator)
+        within = (torch.rand(n, dtype=torch.float64, generator=generator) * self.sizes[datasets]).long()
+        return (self.offsets[datasets] + within).tolist()
+
+    def __iter__(self):
+        rank, _ = get_rank_and_world_size()
+        n = len(self)
+        start = self.start = self.consumed
+        for chunk in range(start // self.chunk_size, math.ceil(n / self.chunk_size)):
+            chunk_start = chunk * self.chunk_size
+            indices = self._chunk(rank, chunk, min(self.chunk_size, n - chunk_start))
+            for i in indices[max(start - chunk_start, 0):]:
+                self.consumed += 1
+                yield i
+        self.consumed = 0
+
+
+class ShardedBuildingSampler(Sampler):
+    '''
+        DDP sampler for TaskonomyReplicaGsoDataset that gives every rank a contiguous range of the
+        sample index, cut at (building, point) boundaries (or building boundaries), so each rank only
+        reads the directories of its own buildings and keeps them in its page cache across epochs.
+
+        The assignment is fixed; each epoch the rows of a rank are shuffled with a generator seeded by
+        (seed, epoch, rank). So ranks agree on it without communicating and independently of how
+        dataset.sample_order was shuffled on each rank. All ranks return the same number of samples
+        (the largest shard, padded by repeating rows; or the smallest one with drop_last).
+        With block_window, rows are block shuffled (see block_shuffle) instead of fully shuffled.
+        With reshuffle=False the order does not depend on the epoch, e.g. for validation sets that
+        are truncated (limit_val_batches) to a random subset that stays the same throughout training.
+        The sampler decides the order, dataset.sample_order / randomize_order have no effect on it.
+        Use with shuffle=False and replace_sampler_ddp=False in Lightning.
+    '''
+    def __init__(self, dataset, shuffle: bool = True, seed: int = 0, drop_last: bool = False,
+                 granularity: str = 'point', block_window: Optional[int] = None, reshuffle: bool = True):
+        index = dataset.index
+        if granularity == 'point':
+            boundaries = np.asarray(index.group_offsets)
+        elif granularity == 'building':
+            building = np.asarray(index.building)
+            boundaries = np.concatenate([[0], np.flatnonzero(np.diff(building)) + 1, [len(building)]])
+        else:
+            raise ValueError(f'Unknown granularity {granularity}, use "point" or "building".')
+        self.boundaries = boundaries.astype(np.int64)
+        # dataset[i] returns row sample_order[i]; samplers yield i
+        self.row_to_index = np.empty(len(dataset.sample_order), dtype=np.int64)
+        self.row_to_index[dataset.sample_order] = np.arange(len(dataset.sample_order))
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.block_window = block_window
+        self.reshuffle = reshuffle
+        self.group_offsets = np.asarray(index.group_offsets, dtype=np.int64)
+        self.epoch = 0
+
+    def shard_rows(self, rank: int, world_size: int):
+        ''' [start, end) rows of rank: the units closest to an even split of the rows '''
+        num_rows = self.boundaries[-1]
+        targets = np.arange(world_size + 1) * num_rows / world_size
+        right = np.clip(np.searchsorted(self.boundaries, targets), 1, len(self.boundaries) - 1)
+        left, right = self.boundaries[right - 1], self.boundaries[right]
+        cuts = np.where(targets - left <= right - targets, left, right)
+        cuts[0], cuts[-1] = 0, num_rows
+        return int(cuts[rank]), int(cuts[rank + 1])
+
+    def _shard_sizes(self, world_size):
+        return [end - start for start, end in (self.shard_rows(r, world_size) for r in range(world_size))]
+
+    def __len__(self):
+        _, world_size = get_rank_and_world_size()
+        sizes = self._shard_sizes(world_size)
+        return min(sizes) if self.drop_last else max(sizes)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rank, world_size = get_rank_and_world_size()
+        start, end = self.shard_rows(rank, world_size)
+        if start == end:
+            raise ValueError(f'Rank {rank} got no samples: there are fewer units than ranks, use granularity="point".')
+        rows = np.arange(start, end)
+        rng = np.random.RandomState([self.seed, self.epoch if self.reshuffle else 0, rank])
+        if self.shuffle and self.block_window is not None:
+            groups = self.group_offsets[(self.group_offsets >= start) & (self.group_offsets <= end)]
+            rows = block_shuffle(groups, rng, self.block_window)
+        elif self.shuffle:
+            rows = rng.permutation(rows)
+        n = len(self)
+        if len(rows) and n > len(rows):
+            rows = np.resize(rows, n)
+        return iter(self.row_to_index[rows[:n]].tolist())
+
+
+class ReadAheadBatch(list):
+    ''' The indices of a batch, plus the indices of the batch the same DataLoader worker gets next '''
+    def __init__(self, indices, read_ahead=()):
+        super().__init__(indices)
+        self.read_ahead = list(read_ahead)
+
+
+class ReadAheadBatchSampler(Sampler):
+    '''
+        BatchSampler whose batches tell the dataset what to read next: batch i carries the indices
+        of batch i + num_workers as `read_ahead`, which is the next batch of the same worker (the
+        DataLoader hands batches to its workers round-robin). A dataset with __getitems__ (e.g.
+        TaskonomyReplicaGsoDataset with prefetch_threads) requests those files while it decodes the
+        current batch. Datasets without it just ignore the attribute.
+
+            DataLoader(dataset, batch_sampler=ReadAheadBatchSampler(sampler, batch_size, num_workers), ...)
+    '''
+    def __init__(self, sampler: Sampler, batch_size: int, num_workers: int = 0, drop_last: bool = False):
+        self.batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.step = max(num_workers, 1)
+
+    @property
+    def sampler(self):
+        return self.batch_sampler.sampler
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def set_epoch(self, epoch: int):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        upcoming = deque()
+        for batch in self.batch_sampler:
+            upcoming.append(batch)
+            if len(upcoming) > self.step:
+                yield ReadAheadBatch(upcoming.popleft(), upcoming[self.step - 1])
+        while upcoming:
+            current = upcoming.popleft()
+            yield ReadAheadBatch(current, upcoming[self.step - 1] if len(upcoming) >= self.step else ())
@@ -0,0 +1,61 @@
+import os
+import pickle
+import threading
+from   joblib import Parallel, delayed
+from   typing import Callable, Iterable, List, Optional
+
+
+class DirectoryScanner:
+    '''
+        Lists directories with os.scandir on a thread pool and remembers the mtime of every
+        directory it listed. A later scan (e.g. with force_refresh_tmp) only re-lists the
+        directories whose mtime changed; everything else costs a single stat.
+
+        The state is kept in memory and, if state_path is given, pickled there by save().
+    '''
+    def __init__(self, state_path: Optional[str] = None, n_jobs: int = 32):
+        self.state_path = state_path
+        self.n_jobs = n_jobs
+        self.listings = {}  # directory -> (mtime_ns, sorted file names)
+        self.num_listed = 0
+        self.num_reused = 0
+        self._lock = threading.Lock()
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path, 'rb') as f:
+                self.listings = pickle.load(f)
+
+    def listdir(self, path: str, missing_ok: bool = False) -> List[str]:
+        '''
+            Sorted entry names of path. A missing path raises FileNotFoundError, unless missing_ok
+            (only for directories that may legitimately be absent, e.g. a building without some task).
+        '''
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            if missing_ok:
+                return []
+            raise FileNotFoundError(f'Directory {path} does not exist (check the dataset paths and tasks).') from None
+        cached = self.listings.get(path)
+        if cached is not None and cached[0] == mtime:
+            with self._lock:
+                self.num_reused += 1
+            return cached[1]
+        with os.scandir(path) as it:
+            names = sorted(entry.name for entry in it)
+        with self._lock:
+            self.listings[path] = (mtime, names)
+            self.num_listed += 1
+        return names
+
+    def map(self, fn: Callable, items: Iterable) -> list:
+        ''' Runs fn over items (typically one building each) on the thread pool, keeping the order '''
+        return Parallel(n_jobs=self.n_jobs, prefer='threads')(delayed(fn)(item) for item in items)
+
+    def save(self):
+        if self.state_path is None:
+            return
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = f'{self.state_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.listings, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.state_path)
@@ -76,6 +76,24 @@ HYPERSIM_LABEL_TRANSFORM = [
 ]
 
 
+def make_label_lut(label_transform):
+    '''
+    Lookup table for remapping a label map with a single gather: lut[labels + 1].
+    Covers labels -1..255. -1 and 255 (undefined / background) and labels outside
+    label_transform are kept as they are.
+    '''
+    lut = torch.arange(-1, 256, dtype=torch.long)
+    lut[1:len(label_transform) + 1] = torch.tensor(label_transform, dtype=torch.long)
+    lut[255 + 1] = 255
+    return lut
+
+def remap_labels(labels, lut):
+    return lut[labels.long() + 1]
+
+REPLICA_LABEL_LUT = make_label_lut(REPLICA_LABEL_TRANSFORM)
+HYPERSIM_LABEL_LUT = make_label_lut(HYPERSIM_LABEL_TRANSFORM)
+
+
 NYU40_COLORS = [
     [ 0,    0,   0], [174, 199, 232], [152, 223, 138], [ 31, 119, 180], [255, 187, 120], [188, 189,  34],
     [140,  86,  75], [255, 152, 150], [214,  39,  40], [197, 176, 213], [148, 103, 189], [196, 156, 148],
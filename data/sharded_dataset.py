@@ -0,0 +1,224 @@
+from   dataclasses import dataclass, field
+import json
+import math
+import os
+import random
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.utils.data as data
+from   torchvision import transforms
+from   typing import Dict, List, Optional
+
+from .transforms import get_finalize_transform
+
+
+SHARD_FORMAT_VERSION = 1
+
+RGB_MEAN = torch.Tensor([0.55312, 0.52514, 0.49313]).reshape(3,1,1)
+RGB_STD =  torch.Tensor([0.20555, 0.21775, 0.24044]).reshape(3,1,1)
+
+
+def get_rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+class ShardWriter:
+    '''
+        Writes samples (dicts of raw task tensors, see transforms.get_raw_transform) into flat binary
+        shards. Every record has the same layout: the task payloads back to back, in the order of
+        `tasks`. The layout (dtype and shape per task) is taken from the first sample.
+
+            out_dir/
+                meta.json           tasks, layout, shard files, building names
+                index.npy           int64[N, 5]: shard, byte offset, building id, point, view
+                shard-00000.bin
+                ...
+    '''
+    def __init__(self, out_dir: str, tasks: List[str], samples_per_shard: int = 256):
+        self.out_dir = out_dir
+        self.tasks = tasks
+        self.samples_per_shard = samples_per_shard
+        self.layout = None
+        self.shards = []
+        self.index = []
+        self.building_ids = {}
+        self._file = None
+        self._offset = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self, sample: Dict[str, torch.Tensor], building: str, point: str, view: str):
+        layout = {task: (str(sample[task].numpy().dtype), list(sample[task].shape)) for task in self.tasks}
+        if self.layout is None:
+            self.layout = layout
+        elif layout != self.layout:
+            raise ValueError(f'Sample {building}/{point}/{view} has layout {layout}, expected {self.layout}. '
+                              'Shards need a fixed image_size.')
+
+        if self._file is None or len(self.index) % self.samples_per_shard == 0:
+            self._next_shard()
+        building_id = self.building_ids.setdefault(building, len(self.building_ids))
+        self.index.append((len(self.shards) - 1, self._offset, building_id, int(point), int(view)))
+        for task in self.tasks:
+            payload = np.ascontiguousarray(sample[task].numpy()).tobytes()
+            self._file.write(payload)
+            self._offset += len(payload)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = f'shard-{len(self.shards):05d}.bin'
+        self.shards.append(name)
+        self._file = open(os.path.join(self.out_dir, name), 'wb')
+        self._offset = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        np.save(os.path.join(self.out_dir, 'index.npy'), np.array(self.index, dtype=np.int64).reshape(-1, 5))
+        # Written last: marks the shards as complete
+        with open(os.path.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': SHARD_FORMAT_VERSION,
+                'tasks': self.tasks,
+                'layout': self.layout,
+                'shards': self.shards,
+                'buildings': sorted(self.building_ids, key=self.building_ids.get),
+                'num_samples': len(self.index),
+            }, f)
+
+
+class ShardedTaskonomyDataset(data.IterableDataset):
+    '''
+        Streams samples written by data/preprocess.py. Each DataLoader worker (of each DDP rank)
+        reads whole shards front to back, so the input pipeline only does sequential reads and the
+        float conversion; decoding, resizing and label remapping were done offline.
+
+        Yields the same structure as TaskonomyReplicaGsoDataset: {'positive': {task: tensor, 'building', 'point'}}.
+        Shards are dealt to ranks; every rank streams exactly len(self) samples (its shards' records,
+        cycled or cut to that length) so that DDP ranks run the same number of steps. The stream of a
+        rank is split into one contiguous part per worker. There should be many more shards than
+        world_size, or ranks repeat (or drop) a large part of their shards.
+    '''
+    @dataclass
+    class Options():
+        '''
+            shard_dir: Output directory of data/preprocess.py
+            tasks: Which of the stored tasks to return (default: all)
+            shuffle: Shuffle the shard order every epoch and samples within a buffer of shuffle_buffer
+        '''
+        shard_dir: str = '/scratch/shards'
+        tasks: Optional[List[str]] = None
+        shuffle: bool = True
+        shuffle_buffer: int = 256
+        normalize_rgb: bool = False
+        seed: int = 0
+
+    def __init__(self, options: Options):
+        self.shard_dir = options.shard_dir
+        with open(os.path.join(self.shard_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != SHARD_FORMAT_VERSION:
+            raise ValueError(f'Shards in {self.shard_dir} have version {meta["version"]}, expected {SHARD_FORMAT_VERSION}.')
+        self.stored_tasks = meta['tasks']
+        self.tasks = self.stored_tasks if options.tasks is None else options.tasks
+        missing = set(self.tasks) - set(self.stored_tasks)
+        if missing:
+            raise ValueError(f'Tasks {sorted(missing)} are not stored in {self.shard_dir}.')
+        self.shards = meta['shards']
+        self.buildings = meta['buildings']
+        self.num_samples = meta['num_samples']
+        self.index = np.load(os.path.join(self.shard_dir, 'index.npy'), mmap_mode='r')
+        # Records are stored in shard order: rows of shard s are shard_starts[s]:shard_starts[s+1]
+        self.shard_starts = np.searchsorted(self.index[:, 0], np.arange(len(self.shards) + 1))
+        self.shuffle = options.shuffle
+        self.shuffle_buffer = options.shuffle_buffer
+        self.normalize_rgb = options.normalize_rgb
+        self.seed = options.seed
+        self.epoch = 0
+
+        # Byte layout of one record
+        self.fields = {}
+        offset = 0
+        for task in self.stored_tasks:
+            dtype, shape = meta['layout'][task]
+            count = int(np.prod(shape))
+            self.fields[task] = (np.dtype(dtype), shape, offset, count)
+            offset += count * np.dtype(dtype).itemsize
+        self.record_bytes = offset
+
+        self.finalize = {task: get_finalize_transform(task) for task in self.tasks}
+        self.rgb_normalize = transforms.Normalize(mean=RGB_MEAN, std=RGB_STD)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        _, world_size = get_rank_and_world_size()
+        return math.ceil(self.num_samples / world_size)
+
+    def _my_rows(self):
+        ''' Records (rows of self.index) this worker of this rank streams, in order '''
+        rank, world_size = get_rank_and_world_size()
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        shard_ids = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shard_ids)
+        my_shards = shard_ids[rank::world_size]
+        rows = [np.arange(self.shard_starts[s], self.shard_starts[s + 1]) for s in my_shards]
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        if len(rows) == 0:
+            raise ValueError(f'Rank {rank} got no samples: {self.shard_dir} has {len(self.shards)} shards for {world_size} ranks.')
+        # Equal length on every rank: cycle through the shards of the rank, or cut them
+        num_rows = len(self)
+        rows = np.resize(rows, num_rows)
+        return rows[num_rows * worker_id // num_workers:num_rows * (worker_id + 1) // num_workers]
+
+    def _read_rows(self, rows):
+        ''' Reads records sequentially: runs of consecutive rows of a shard are one seek and sequential reads '''
+        shard_of_row = np.searchsorted(self.shard_starts, rows, side='right') - 1
+        breaks = np.flatnonzero((np.diff(rows) != 1) | (np.diff(shard_of_row) != 0)) + 1
+        for run in np.split(np.arange(len(rows)), breaks):
+            if len(run) == 0:
+                continue
+            shard_id = shard_of_row[run[0]]
+            with open(os.path.join(self.shard_dir, self.shards[shard_id]), 'rb') as f:
+                f.seek((rows[run[0]] - self.shard_starts[shard_id]) * self.record_bytes)
+                for row in rows[run]:
+                    record = bytearray(self.record_bytes)
+                    f.readinto(record)
+                    yield self._decode(record, self.index[row])
+
+    def _decode(self, record, index_row):
+        _, _, building_id, point, view = index_row
+        positive_samples = {}
+        for task in self.tasks:
+            dtype, shape, offset, count = self.fields[task]
+            raw = torch.from_numpy(np.frombuffer(record, dtype=dtype, count=count, offset=offset).reshape(shape))
+            res = self.finalize[task](raw)
+            if task == 'rgb' and self.normalize_rgb:
+                res = self.rgb_normalize(res)
+            positive_samples[task] = res
+        positive_samples['point'] = str(point)
+        positive_samples['building'] = self.buildings[building_id]
+        return {'positive': positive_samples}
+
+    def __iter__(self):
+        rank, _ = get_rank_and_world_size()
+        worker_info = data.get_worker_info()
+        rng = random.Random(hash((self.seed, self.epoch, rank, 0 if worker_info is None else worker_info.id)))
+        buffer = []
+        for sample in self._read_rows(self._my_rows()):
+            if not self.shuffle:
+                yield sample
+                continue
+            buffer.append(sample)
+            if len(buffer) >= self.shuffle_buffer:
+                i = rng.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
@@ -9,6 +9,9 @@ import torch.utils.data as data
 from   typing import Optional, List, Callable, Union, Dict, Any, Tuple
 import warnings
 
+from .manifest import ManifestStore, MANIFEST_VERSION, save_urls, load_urls
+from .sample_index import remove_unmatched_urls
+from .image_cache import DecodedImageCache
 from .masks import make_mask_from_data, DEFAULT_MASK_EXTRA_RADIUS
 from .splits import taskonomy_flat_split_to_buildings
 from .transforms import default_loader, get_transform
@@ -63,6 +66,8 @@ class TaskonomyDataset(data.Dataset):
         mask_extra_radius: int = DEFAULT_MASK_EXTRA_RADIUS
         image_size: Optional[int]=None
         force_refresh_tmp: bool = True
+        cache_dir: Optional[str] = None  # Manifest cache, defaults to $OMNIDATA_CACHE_DIR or ~/.cache/omnidata
+        image_cache_bytes: int = 0  # Per worker LRU cache of decoded images (see image_cache.py)
 
         
     def __init__(self, options: Options):
@@ -81,34 +86,30 @@ class TaskonomyDataset(data.Dataset):
         self.return_mask = options.return_mask
         self.tasks = options.tasks
         self.zip_file_name = options.zip_file_name
+        self.image_cache = DecodedImageCache(options.image_cache_bytes) if options.image_cache_bytes > 0 else None
 
         
         self.force_refresh_tmp = options.force_refresh_tmp
 
         # Load saved image locations if they exist, otherwise create and save them
-        tmp_path = './tmp/taskonomy_{}_{}.pkl'.format(
-            '-'.join(options.tasks), 
-            '-'.join(options.buildings) if isinstance(options.buildings, list) else options.buildings
-        )
-        tmp_exists = os.path.exists(tmp_path)
-        if tmp_exists and not self.force_refresh_tmp:
-            with open(tmp_path, 'rb') as f:
-                self.urls = pickle.load(f)
-            self.size = len(self.urls[self.tasks[0]])
-            print(f'Loaded TaskonomyDataset with {self.size} images from tmp.')
-        else:
+        def build_urls(path):
             self.urls = {task: make_dataset(os.path.join(self.data_path, task), self.buildings)
                         for task in options.tasks}
-          
-            
-        
-#         self.urls = {task: make_dataset(os.path.join(self.data_path, task), self.buildings)
             self.urls, self.size  = self._remove_unmatched_images()
-            
-            # Save extracted URLs
-            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-            with open(tmp_path, 'wb') as f:
-                pickle.dump(self.urls, f)
+            save_urls(path, self.urls, self.data_path)
+
+        manifest_key = {
+            'version': MANIFEST_VERSION,
+            'datasets': ['taskonomy'],
+            'roots': [os.path.abspath(os.path.expanduser(self.data_path))],
+            'tasks': sorted(self.tasks),
+            'buildings': sorted(self.buildings),
+        }
+        self.urls = ManifestStore(options.cache_dir).get_or_build(
+            'urls', manifest_key, build=build_urls, load=lambda path: load_urls(path, self.data_path),
+            refresh=self.force_refresh_tmp)
+        self.size = len(self.urls[self.tasks[0]])
+        print(f'Loaded TaskonomyDataset with {self.size} images.')
         
         self.transform = options.transform
         if isinstance(self.transform, str):
@@ -119,14 +120,16 @@ class TaskonomyDataset(data.Dataset):
         
 
         # Perhaps load some things into main memory
-        # Note (March 2020: This is likely broken due to the transforms not necessarily being a list)
         if self.load_to_mem: 
             print('Writing activations to memory')
-            for t, task in zip(self.transform, tasks):
+            transforms = self.transform if self.transform is not None else [None] * len(self.tasks)
+            for t, task in zip(transforms, self.tasks):
                 self.cached_data[task] = [None] * len(self)
                 for i, url in enumerate(self.urls[task]):
-                    self.cached_data[task][i] = t(default_loader(url))
-                self.cached_data[task] = torch.stack(self.cached_data[task])
+                    self.cached_data[task][i] = default_loader(url) if t is None else t(default_loader(url))
+                # Without a transform these are PIL images, kept as a list
+                if all(isinstance(x, torch.Tensor) for x in self.cached_data[task]):
+                    self.cached_data[task] = torch.stack(self.cached_data[task])
 #             self.cached_data = torch.stack(self.cached_data)
             print('Finished writing some activations to memory')
             
@@ -135,6 +138,11 @@ class TaskonomyDataset(data.Dataset):
     def __len__(self):
         return self.size
 
+    def load_image(self, path):
+        if self.image_cache is None:
+            return default_loader(path)
+        return self.image_cache.get(path, lambda: default_loader(path))
+
     def __getitem__(self, index):
         mask, mask_needed = None, self.return_mask
         fpaths = [self.urls[task][index] for task in self.tasks]
@@ -142,7 +150,7 @@ class TaskonomyDataset(data.Dataset):
         if self.load_to_mem:
             result = tuple([self.cached_data[task][index] for task in self.tasks])
         else:
-            result = [default_loader(path) for path in fpaths]
+            result = [self.load_image(path) for path in fpaths]
             if self.transform is not None:
                 # result = [transform(tensor) for transform, tensor in zip(self.transform, result)]
                 result_post = []
@@ -213,51 +221,7 @@ class TaskonomyDataset(data.Dataset):
                 filtered_urls: Filtered Dict
                 max_length: max([len(urls) for _, urls in filtered_urls.items()])
         '''
-        n_images_task = [(len(obs), task) for task, obs in self.urls.items()]
-        max_images = max(n_images_task)[0]
-        if max(n_images_task)[0] == min(n_images_task)[0]:
-            return self.urls, max_images
-        else:
-            print("Each task must have the same number of images. However, the max != min ({} != {}). Number of images per task is: \n\t{}".format(
-                max(n_images_task)[0], min(n_images_task)[0], "\n\t".join([str(t) for t in n_images_task])))
-            # Get views for each task
-            
-            
-            def _parse_fpath_for_view( path ):
-                building = os.path.basename(os.path.dirname(path))
-                file_name = os.path.basename(path) 
-                lf = parse_filename( file_name )
-                return View(view=lf.view, point=lf.point, building=building)
-
-            self.task_to_view = {}
-            for task, paths in self.urls.items():
-                self.task_to_view[task] = [_parse_fpath_for_view( path ) for path in paths]
-            
-            # Compute intersection
-            intersection = None
-            for task, uuids in self.task_to_view.items():
-                if intersection is None:
-                    intersection = set(uuids)
-                else:
-                    intersection = intersection.intersection(uuids)
-
-#             print(sorted(list(intersection)))
-            # Keep intersection
-            print('Keeping intersection: ({} images/task)...'.format(len(intersection)))
-            new_urls = {}
-            for task, paths in self.urls.items():
-                new_urls[task] = [path for path in paths if _parse_fpath_for_view( path ) in intersection]
-#                 for path in paths:
-#                     building = os.path.basename(os.path.dirname(path))
-#                     file_name = os.path.basename(path) 
-#                     lf = parse_filename( file_name )
-#                     view = str(View(view=lf.view, point=lf.point, building=building))
-#                     print(view)
-#                     if view in intersection:
-#                         paths_for_task.append(path)
-#                 new_urls[task] = paths_for_task
-            return new_urls, len(intersection)
-        raise NotImplementedError('Reached the end of this function. You should not be seeing this!')
+        return remove_unmatched_urls(self.urls, building_fn=lambda path: os.path.basename(os.path.dirname(path)))
 
     
     def _validate_images_per_building(self):
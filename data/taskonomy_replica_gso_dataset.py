@@ -1,7 +1,11 @@
+import bisect
 from   collections import namedtuple, Counter, defaultdict
+from   concurrent.futures import ThreadPoolExecutor
 from   dataclasses import dataclass, field
+from   functools import cached_property, lru_cache
 from   joblib import Parallel, delayed
 import logging
+import numpy as np
 import multiprocessing as mp
 import os
 import pickle
@@ -20,17 +24,34 @@ from   typing import Optional, List, Callable, Union, Dict, Any
 import warnings
 
 from .taskonomy_dataset import parse_filename, LabelFile, View
+from .manifest import ManifestStore, MANIFEST_VERSION, save_urls, load_urls
+from .sample_index import SampleIndex, INDEX_FORMAT_VERSION, building_from_url, remove_unmatched_urls
+from .scanner import DirectoryScanner
+from .memmap_store import MemmapTaskStore
+from .image_cache import DecodedImageCache, SharedImageCache
+from .decoders import HDF5LabelReader, decode_file
+from .prefetch import PrefetchingReader, read_bytes
+from .packed_views import PackedViewStore, unpack_view
+from .samplers import block_shuffle, ReadAheadBatch
 from .splits import taskonomy_flat_split_to_buildings, replica_flat_split_to_buildings, \
     gso_flat_split_to_buildings, hypersim_flat_split_to_buildings
-from .transforms import default_loader, get_transform, LocalContrastNormalization
+from .transforms import default_loader, get_transform, get_raw_transform, BatchedTransform, LocalContrastNormalization, \
+    RAW_LABEL_DTYPE
 from .task_configs import task_parameters, SINGLE_IMAGE_TASKS
-from .segment_instance import HYPERSIM_LABEL_TRANSFORM, REPLICA_LABEL_TRANSFORM, COMBINED_CLASS_LABELS
+from .segment_instance import HYPERSIM_LABEL_LUT, REPLICA_LABEL_LUT, COMBINED_CLASS_LABELS, remap_labels
 
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True # TODO Test this
 
 MAX_VIEWS = 45
 
+# Resolution of the taskonomy / replica / gso images. With batched_transform, hypersim frames are
+# resized to it on the CPU so that every sample of a batch has the same size before collation.
+RAW_IMAGE_SIZE = 512
+
+# Files the prefetcher reads ahead; hdf5 labels are read by h5py
+PREFETCHED_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
 RGB_MEAN = torch.Tensor([0.55312, 0.52514, 0.49313]).reshape(3,1,1)
 RGB_STD =  torch.Tensor([0.20555, 0.21775, 0.24044]).reshape(3,1,1)
 
@@ -69,6 +90,9 @@ class TaskonomyReplicaGsoDataset(data.Dataset):
         '''
             data_path: Path to data
             tasks: Which tasks to load. Any subfolder will work as long as data is named accordingly
+            active_tasks: Subset of tasks that is actually read and returned (default: all). The samples
+                are still those present for all tasks, so trimming the tasks a training step does not
+                use keeps the same dataset (and its manifests, index and stores) while reading less.
             buildings: Which models to include. See `splits.taskonomy` (can also be a string, e.g. 'fullplus-val')
             transform: one transform per task.
             
@@ -81,84 +105,83 @@ class TaskonomyReplicaGsoDataset(data.Dataset):
         split: str = 'train'
         taskonomy_variant: str = 'tiny'
         tasks: List[str] = field(default_factory=lambda: ['rgb'])
+        active_tasks: Optional[List[str]] = None
         datasets: List[str] = field(default_factory=lambda: ['taskonomy', 'replica', 'gso'])
         transform: Optional[Union[Dict[str, Callable], str]] = "DEFAULT"  # List[Transform], None, "DEFAULT"
         image_size: Optional[int] = None
         num_positive: Union[int, str] = 1 # Either int or 'all'
         normalize_rgb: bool = False
         force_refresh_tmp: bool = False
+        cache_dir: Optional[str] = None  # Manifest cache, defaults to $OMNIDATA_CACHE_DIR or ~/.cache/omnidata
+        memmap_store_dir: Optional[str] = None  # Read 16-bit tasks from a memmap store (see memmap_store.py)
+        packed_views_dir: Optional[str] = None  # Read the files of a view from one packed file (see packed_views.py)
+        batched_transform: bool = False  # Return raw tensors, transform batches with make_batched_transform()
+        image_cache_bytes: int = 0  # Per worker LRU cache of decoded images (see image_cache.py)
+        shared_image_cache_bytes: int = 0  # Cache of decoded images shared by all workers, never evicted
+        # 'shuffle': full permutation, 'block': see samplers.block_shuffle. Only for samplers that follow
+        # sample_order: under DDP, ShardedBuildingSampler decides the order (pass it block_window instead)
+        order: str = 'shuffle'
+        read_threads: int = 8  # Threads per worker reading the views of a sample when num_positive > 1
+        prefetch_threads: int = 0  # > 0: read the files of a whole batch asynchronously (see prefetch.py)
+        block_window: int = 256
         load_building_meshes: bool = False
         randomize_views: bool = True
 
     def load_datasets(self, options):
-        # Load saved image locations if they exist, otherwise create and save them
-        self.urls = defaultdict(list)
-        self.size = 0
-
+        ''' {task: urls of all datasets}; the url manifests of each dataset are loaded, or scanned and saved '''
+        all_urls = defaultdict(list)
         for dataset in self.datasets:
-            all_tasks = ['rgb', 'normal', 'segment_semantic', 'keypoints2d', 'keypoints3d', 'depth_zbuffer', 'edge_texture', 'edge_occlusion', 'mask_valid']
-            if dataset == 'taskonomy':
-                tmp_path = './tmp/{}_{}_{}.pkl'.format(
-                    dataset,
-                    '-'.join(all_tasks), 
-                    f'{options.taskonomy_variant}-{options.split}'
-                )
-            else:
-                tmp_path = './tmp/{}_{}_{}.pkl'.format(
-                    dataset,
-                    '-'.join(all_tasks), 
-                    options.split
-                )
-
-            tmp_exists = os.path.exists(tmp_path)
-
-            if tmp_exists and not self.force_refresh_tmp:
-                with open(tmp_path, 'rb') as f:
-                    dataset_urls = pickle.load(f)
-                    for task, urls in dataset_urls.items():
-                        if task not in options.tasks: continue
-                        # TODO remove later
-                        task2 = 'segment_semantic' if task == 'segment_panoptic' else task
-                        self.urls[task2] += urls
-                dataset_size = len(dataset_urls[self.tasks[0]])
-                self.size += dataset_size
-                print(f'Loaded {dataset} with {dataset_size} images from tmp.')
-
-            else:
-                # self.taskonomy_buildings = ["almena", "albertville"]
-                
-                if dataset == 'taskonomy':
-                    dataset_urls = {task: make_taskonomy_dataset(
-                                            os.path.join(self.taskonomy_data_path, task), task, self.taskonomy_buildings)
-                                        for task in options.tasks}
-                elif dataset == 'replica':
-                    dataset_urls = {task: make_replica_gso_dataset(
-                                            self.replica_data_path, task, self.replica_buildings)
-                                        for task in options.tasks}
-                elif dataset == 'gso':
-                    dataset_urls = {task: make_replica_gso_dataset(
-                                             self.gso_data_path, task, self.gso_buildings) 
-                                        for task in options.tasks}
-                elif dataset == 'hypersim':
-                    # dataset_urls = {task: make_hypersim_dataset(
-                    #                          self.hypersim_data_path, task, self.hypersim_buildings) 
-                    #                     for task in options.tasks}
-                    dataset_urls = {task: make_hypersim_dataset_orig_split(
-                                             self.hypersim_data_path, task, self.split) 
-                                        for task in options.tasks}
-
-                dataset_urls, dataset_size  = self._remove_unmatched_images(dataset_urls)
-
-                for task, urls in dataset_urls.items():
-                    self.urls[task] += urls
-                self.size += dataset_size
-
-                # Save extracted URLs
-                os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-                with open(tmp_path, 'wb') as f:
-                    pickle.dump(dataset_urls, f)
+            root = self._data_root(dataset)
+            dataset_urls = self.manifests.get_or_build(
+                'urls', self._manifest_key(options, [dataset]),
+                build=lambda path: save_urls(path, self._scan_dataset(options, dataset), root),
+                load=lambda path: load_urls(path, root),
+                refresh=self.force_refresh_tmp)
+
+            for task, urls in dataset_urls.items():
+                all_urls[task] += urls
+            print(f'Loaded {dataset} with {len(dataset_urls[self.tasks[0]])} images.')
+        return all_urls
+
+    def _scan_dataset(self, options, dataset):
+        # self.taskonomy_buildings = ["almena", "albertville"]
+
+        # Directory listings are cached by mtime, so only buildings that changed get rescanned
+        root = self._data_root(dataset)
+        scanner = DirectoryScanner(state_path=self.manifests.path('scan', {'root': root}) + '.pkl')
+        if dataset == 'taskonomy':
+            dataset_urls = scan_taskonomy_dataset(root, options.tasks, self.taskonomy_buildings, scanner)
+        elif dataset == 'replica':
+            dataset_urls = scan_replica_gso_dataset(root, options.tasks, self.replica_buildings, scanner)
+        elif dataset == 'gso':
+            dataset_urls = scan_replica_gso_dataset(root, options.tasks, self.gso_buildings, scanner)
+        elif dataset == 'hypersim':
+            # dataset_urls = scan_hypersim_dataset(root, options.tasks, self.hypersim_buildings, scanner)
+            dataset_urls = scan_hypersim_dataset_orig_split(root, options.tasks, self.split, scanner)
+        scanner.save()
+        print(f'Scanned {dataset}: listed {scanner.num_listed} directories, {scanner.num_reused} unchanged.')
+
+        dataset_urls, _ = self._remove_unmatched_images(dataset_urls)
+        return dataset_urls
+
+    def _data_root(self, dataset):
+        return {
+            'taskonomy': self.taskonomy_data_path,
+            'replica': self.replica_data_path,
+            'gso': self.gso_data_path,
+            'hypersim': self.hypersim_data_path,
+        }[dataset]
+
+    def _manifest_key(self, options, datasets):
+        return {
+            'version': MANIFEST_VERSION,
+            'datasets': datasets,
+            'roots': [os.path.abspath(os.path.expanduser(self._data_root(dataset))) for dataset in datasets],
+            'tasks': sorted(options.tasks),
+            'split': options.split,
+            'taskonomy_variant': options.taskonomy_variant if 'taskonomy' in datasets else None,
+        }
 
-        
     def __init__(self, options: Options):
         start_time = perf_counter()
         
@@ -174,133 +197,96 @@ class TaskonomyReplicaGsoDataset(data.Dataset):
         self.split = options.split
         self.image_size = options.image_size
         self.tasks = options.tasks
+        self.set_active_tasks(options.active_tasks)
         self.num_positive = MAX_VIEWS if options.num_positive == 'all' else options.num_positive
         self.normalize_rgb = options.normalize_rgb
         self.force_refresh_tmp = options.force_refresh_tmp
         self.randomize_views = options.randomize_views
+        self.order = options.order
+        self.read_threads = options.read_threads
+        self._read_pool, self._read_pool_pid = None, None
+        self.block_window = options.block_window
+        self.batched_transform = options.batched_transform
+        # Size hypersim frames are resized / cropped to on the CPU
+        self.load_size = RAW_IMAGE_SIZE if self.batched_transform else self.image_size
+        # One label dtype for every source, see RAW_LABEL_DTYPE
+        self.label_dtype = RAW_LABEL_DTYPE if self.batched_transform else torch.long
 
         self.taskonomy_buildings = taskonomy_flat_split_to_buildings[f'{options.taskonomy_variant}-{self.split}']
         self.replica_buildings = replica_flat_split_to_buildings[self.split]
         self.gso_buildings = gso_flat_split_to_buildings[self.split]
         self.hypersim_buildings = hypersim_flat_split_to_buildings[self.split]
 
-        self.load_datasets(options)
-
-        print("!!!!!!!!!!!! rgb : ", len(self.urls['rgb']))
-        print("!!!!!!!!!!!! semantic segmentation : ", len(self.urls['segment_semantic']))
+        def build_index(path):
+            urls = self.load_datasets(options)
+            index = SampleIndex.from_urls(urls, self.tasks, skip_buildings=['wiconisco']) # something wrong with edge texture
+            index.save(path)
+
+        # Only local rank 0 builds the index; all ranks memory-map the same files
+        self.manifests = ManifestStore(options.cache_dir)
+        index_key = dict(self._manifest_key(options, self.datasets), index_version=INDEX_FORMAT_VERSION)
+        self.index_path = self.manifests.path('index', index_key)
+        self.index = self.manifests.get_or_build(
+            'index', index_key, build=build_index, load=SampleIndex.load, refresh=self.force_refresh_tmp)
+
+        # Tasks read from the memmap store are returned raw and converted after collation
+        self.memmap_store = None
+        self.raw_tasks = []
+        self.memmap_tasks = []
+        if options.memmap_store_dir is not None:
+            self.memmap_store = MemmapTaskStore(options.memmap_store_dir)
+            self.memmap_store.check_index(self.index_path, len(self.index))
+            if self.memmap_store.image_size != self.image_size:
+                raise ValueError(f'Memmap store {options.memmap_store_dir} has image size {self.memmap_store.image_size}, '
+                                 f'dataset uses {self.image_size}.')
+            self.memmap_tasks = [task for task in self.tasks if task in self.memmap_store.tasks]
+            self.raw_tasks = list(self.memmap_tasks)
+
+        self.packed_views = None
+        self.packed_tasks = []
+        if options.packed_views_dir is not None:
+            self.packed_views = PackedViewStore(options.packed_views_dir)
+            self.packed_views.check_index(self.index_path, len(self.index))
+            self.packed_tasks = [task for task in self.tasks
+                                 if task in self.packed_views.tasks and task not in self.memmap_tasks]
 
         self.transform = options.transform
-        if isinstance(self.transform, str):
+        # Hypersim semantic labels skip the PIL round trip when the transforms are the dataset's own
+        self.read_labels_direct = self.batched_transform or self.transform == 'DEFAULT'
+        self.hdf5_reader = HDF5LabelReader()
+        if self.batched_transform:
+            # Resizing and normalization happen on whole batches, see make_batched_transform
+            self.transform = {task: get_raw_transform(task, None) for task in self.tasks}
+            self.raw_tasks = list(self.tasks)
+        elif isinstance(self.transform, str):
             if self.transform == 'DEFAULT':
                 self.transform = {task: get_transform(task, self.image_size) for task in self.tasks}
             else:
                 raise ValueError('TaskonomyDataset option transform must be a Dict[str, Callable], None, or "DEFAULT"')
                 
-        if self.normalize_rgb and 'rgb' in self.transform:
+        if self.normalize_rgb and 'rgb' in self.transform and not self.batched_transform:
             self.transform['rgb'] = transforms.Compose(
                 self.transform['rgb'].transforms +
                 [transforms.Normalize(mean=RGB_MEAN, std=RGB_STD)]
 
             )
 
-    
-        # Saving some lists and dictionaries for fast lookup
-
-        self.tbpv_dict = {} # Save task -> building -> point -> view dict
-        self.url_dict = {}  # Save (task, building, point, view) -> URL dict
-        self.bpv_count = {} # Dictionary to check if all (building, point, view) tuples have all tasks
-        
-        for task in self.tasks:
-            self.tbpv_dict[task] = {}
-            for url in self.urls[task]:
-                if url.__contains__('replica-taskonomized'):
-                    building = url.split('/')[-3]
-                elif url.__contains__('replica-google-objects'): # e.g apartment_0-3, apartment_0-6
-                    building = url.split('/')[-4] + '-' + url.split('/')[-3]
-                elif url.__contains__('hypersim'): # e.g ai_001_001-cam_00, ai_001_001-cam_01
-                    building = url.split('/')[-5] + '-' + url.split('/')[-3]
-                elif url.__contains__('taskonomy'):
-                    building = url.split('/')[-2]
-                else:
-                    raise NotImplementedError('Dataset path (url) not recognized!')
-
-                if building == 'wiconisco': continue # something wrong with edge texture
-                # if url.__contains__('wiconisco/point_452_view_8'): continue
-                
-
-                file_name = url.split('/')[-1].split('_')
-  
-                point, view = file_name[1], file_name[3]
-
-                # Populate url_dict
-                self.url_dict[(task, building, point, view)] = url
-
-                # Populate tbpv_dict
-                if building not in self.tbpv_dict[task]:
-                    self.tbpv_dict[task][building] = {}
-                if point not in self.tbpv_dict[task][building]:
-                    self.tbpv_dict[task][building][point] = []
-                self.tbpv_dict[task][building][point].append(view)
-
-                # Populate bpv_count
-                if (building, point, view) not in self.bpv_count:
-                    self.bpv_count[(building, point, view)] = 1
-                else:
-                    self.bpv_count[(building, point, view)] += 1
-
-
-        # Remove entries that don't have all tasks and create list of all (building, point, view) tuples that contain all tasks
-        self.bpv_list = [bpv_tuple for bpv_tuple, count in self.bpv_count.items() if count == len(self.tasks)]
-
-        self.views = {}    # Build dictionary that contains all the views from a certain (building, point) tuple
-        self.bpv_dict = {} # Save building -> point -> view dict
-        for building, point, view in self.bpv_list:
-            # Populate views
-            if (building, point) not in self.views:
-                self.views[(building, point)] = []
-            self.views[(building, point)].append(view)
-
-            # Populate bpv_dict
-            if building not in self.bpv_dict:
-                self.bpv_dict[building] = {}
-            if point not in self.bpv_dict[building]:
-                self.bpv_dict[building][point] = []
-            self.bpv_dict[building][point].append(view)
-
-            
-        # Building meshes
-        
-        # self.meshes = {}
-        
-        # def load_mesh(building):
-        #     pkl_path = os.path.join(self.data_path, 'mesh_pkl', f"{building}.pkl")
-        #     if os.path.exists(pkl_path):
-        #         with open(pkl_path, 'rb') as f:
-        #             mesh = pickle.load(f)
-        #     else:
-        #         obj_path = os.path.join(self.data_path, 'mesh', f"{building}.obj")
-        #         mesh = load_taskonomy_obj_to_mesh(obj_path)
-        #         os.makedirs(os.path.dirname(pkl_path), exist_ok=True)
-        #         with open(pkl_path, 'wb') as f:
-        #             pickle.dump(mesh, f)
-        #     return building, mesh
-    
-        
-        # if options.load_building_meshes:
-        #     print("Loading meshes...")
-        #     building_mesh_pairs = Parallel(n_jobs=mp.cpu_count(), prefer='threads')(
-        #         delayed(load_mesh)(building) for building in tqdm(self.bpv_dict)
-        #     )
-        #     self.meshes.update(dict(building_mesh_pairs))         
-        #     print("Done loading")
+        # Decoded images are cached by (task, row)
+        self.image_cache = DecodedImageCache(options.image_cache_bytes) if options.image_cache_bytes > 0 else None
+        self.shared_image_cache = None
+        if options.shared_image_cache_bytes > 0:
+            self.shared_image_cache = SharedImageCache(len(self.tasks) * len(self.index), options.shared_image_cache_bytes)
+        self.prefetcher = PrefetchingReader(options.prefetch_threads) if options.prefetch_threads > 0 else None
+        self._read_ahead = (Counter(), {})  # Paths requested for the next batch of this worker, and its jobs
 
+        # Rows of self.index in the order they are returned
         # if self.split == 'train':
-        random.shuffle(self.bpv_list)
+        self.sample_order = self._make_order(np.random)
         
         end_time = perf_counter()
-        self.num_points = len(self.views)
-        self.num_images = len(self.bpv_list)
-        self.num_buildings = len(self.bpv_dict)
+        self.num_points = self.index.num_groups
+        self.num_images = len(self.index)
+        self.num_buildings = self.index.num_buildings
         
         logger = logging.getLogger(__name__)
         logger.warning("Loaded {} images in {:0.2f} seconds".format(self.num_images, end_time - start_time))
@@ -308,53 +294,236 @@ class TaskonomyReplicaGsoDataset(data.Dataset):
 
 
     def __len__(self):
-        return len(self.bpv_list)
+        return len(self.sample_order)
+
+    # The dictionaries and lists this dataset used to build in __init__, now derived from self.index on
+    # first access (they hold a Python object per sample, so prefer self.index in new code)
+    @cached_property
+    def urls(self) -> Dict[str, List[str]]:
+        ''' {task: url of every index row} '''
+        return {task: [self.index.url(task, row) for row in range(len(self.index))] for task in self.tasks}
+
+    @property
+    def size(self) -> int:
+        return len(self.index)
+
+    @cached_property
+    def url_dict(self) -> Dict[tuple, str]:
+        ''' (task, building, point, view) -> url '''
+        return {(task,) + self.index.bpv(row): self.index.url(task, row)
+                for task in self.tasks for row in range(len(self.index))}
+
+    @property
+    def bpv_list(self) -> List[tuple]:
+        ''' (building, point, view) of every sample, in the current order they are returned in '''
+        return [self.index.bpv(row) for row in self.sample_order]
+
+    @cached_property
+    def views(self) -> Dict[tuple, List[str]]:
+        ''' (building, point) -> views '''
+        views = defaultdict(list)
+        for row in range(len(self.index)):
+            building, point, view = self.index.bpv(row)
+            views[(building, point)].append(view)
+        return dict(views)
+
+    @cached_property
+    def bpv_dict(self) -> Dict[str, Dict[str, List[str]]]:
+        ''' building -> point -> views '''
+        bpv_dict = defaultdict(dict)
+        for (building, point), views in self.views.items():
+            bpv_dict[building][point] = views
+        return dict(bpv_dict)
+
+    def set_active_tasks(self, tasks: Optional[List[str]]):
+        ''' Only reads and returns these tasks from now on (None: all tasks) '''
+        tasks = list(self.tasks) if tasks is None else list(tasks)
+        unknown = [task for task in tasks if task not in self.tasks]
+        if unknown or not tasks:
+            raise ValueError(f'Active tasks {tasks} have to be a non-empty subset of the dataset tasks {self.tasks}.')
+        self.active_tasks = tasks
+
+    def make_batched_transform(self):
+        '''
+            Module that turns a collated batch['positive'] of this dataset into what the default
+            transforms return. Only needed with batched_transform or memmap_store_dir.
+        '''
+        return BatchedTransform(self.raw_tasks, image_size=self.image_size,
+                                normalize_rgb=self.normalize_rgb and self.batched_transform)
+
+    def load_image(self, task, row, packed=None):
+        '''
+            packed: the files of the view from its packed view file, if the dataset has one.
+            Returns the decoded image and the path of the original file.
+        '''
+        path = self.index.url(task, row)
+        if packed is not None and task in packed:
+            read = lambda: packed[task]
+        elif self.prefetcher is not None and path.endswith(PREFETCHED_EXTENSIONS):
+            read = lambda: self.prefetcher.read(path)
+        else:
+            read = None
+        if self.read_labels_direct and task == 'segment_semantic' and path.endswith('.hdf5'):
+            load = lambda: self.hdf5_reader.read(path, self.load_size, data=read() if read else None)
+        elif read is not None:
+            load = lambda: decode_file(path, data=read())
+        else:
+            load = lambda: default_loader(path)
+        if self.shared_image_cache is not None:
+            slot = self.tasks.index(task) * len(self.index) + row
+            return self.shared_image_cache.get(slot, load), path
+        if self.image_cache is not None:
+            return self.image_cache.get((task, row), load), path
+        return load(), path
+
+    def is_cached(self, task, row):
+        if self.shared_image_cache is not None:
+            return self.tasks.index(task) * len(self.index) + row in self.shared_image_cache
+        return self.image_cache is not None and (task, row) in self.image_cache
+
+    def cache_stats(self):
+        return {
+            'image_cache': self.image_cache.stats() if self.image_cache is not None else None,
+            'shared_image_cache': self.shared_image_cache.stats() if self.shared_image_cache is not None else None,
+            'prefetcher': self.prefetcher.stats() if self.prefetcher is not None else None,
+        }
+
+    def load_task(self, task, row, packed=None):
+        res, path = self.load_image(task, row, packed)
+
+        if isinstance(res, np.ndarray) and path.endswith('.hdf5'):
+            # Hypersim labels from HDF5LabelReader, already resized and cropped. Channel 0 is all that
+            # is used; the other two are views, for the layout of the former RGB label images.
+            res = remap_labels(torch.from_numpy(res), HYPERSIM_LABEL_LUT).to(self.label_dtype)
+            return res.unsqueeze(-1).expand(-1, -1, 3)
+
+        # additional transform for hypersim dataset because img size is (768, 1024)
+        if path.__contains__('hypersim'):
+            resize_method = Image.BILINEAR if task in ['rgb'] else Image.NEAREST
+            # resize_method = Image.BILINEAR if task not in ['segment_instance', 'segment_semantic', 'mask_valid'] else Image.NEAREST
+            transform = transforms.Compose([
+                transforms.Resize(self.load_size, resize_method), 
+                transforms.CenterCrop(self.load_size)])
+            res = transform(res)
+
+        if self.transform is not None and self.transform[task] is not None:
+            res = self.transform[task](res)
+
+        # transforms for converting replica and hypersim labels to combined labels
+        if task == 'segment_semantic':
+            if path.__contains__('hypersim'):
+                res = remap_labels(res, HYPERSIM_LABEL_LUT)
+            if path.__contains__('replica-taskonomized'):
+                res = remap_labels(res, REPLICA_LABEL_LUT)
+            if torch.is_tensor(res):
+                res = res.to(self.label_dtype)
+
+        return res
+
+    def positive_rows(self, row):
+        '''
+            The anchor row followed by num_positive - 1 other views of the same (building, point),
+            random ones if randomize_views. Points with fewer views than num_positive repeat views.
+        '''
+        if self.num_positive == 1:
+            return [row]
+        group = self.index.group_rows(row)
+        others = [r for r in group if r > row] + [r for r in group if r < row]
+        if self.randomize_views:
+            random.shuffle(others)
+        rows = [row] + others
+        return [rows[i % len(rows)] for i in range(self.num_positive)]
+
+    def load_view(self, task, row, packed=None):
+        if task in self.memmap_tasks:
+            return self.memmap_store.get(task, row)
+        return self.load_task(task, row, packed)
+
+    def needs_packed_view(self, row):
+        return any(not self.is_cached(task, row) for task in self.packed_tasks if task in self.active_tasks)
+
+    def read_packed_view(self, row):
+        path = self.packed_views.path(*self.index.bpv(row))
+        return unpack_view(self.prefetcher.read(path) if self.prefetcher is not None else read_bytes(path))
+
+    def read_pool(self):
+        # Created lazily in every DataLoader worker
+        if self._read_pool is None or self._read_pool_pid != os.getpid():
+            self._read_pool = ThreadPoolExecutor(max_workers=self.read_threads)
+            self._read_pool_pid = os.getpid()
+        return self._read_pool
+
+    def sample_jobs(self, index):
+        ''' (task, row) of every view that dataset[index] loads '''
+        positive_rows = self.positive_rows(self.sample_order[index])
+        return [(task, r) for task in self.active_tasks for r in positive_rows]
+
+    def prefetch_paths(self, jobs):
+        ''' Files that load_sample(index, jobs) reads through the prefetcher '''
+        paths = [self.packed_views.path(*self.index.bpv(r)) for r in dict.fromkeys(r for _, r in jobs)
+                 if self.needs_packed_view(r)]
+        paths += [self.index.url(task, r) for task, r in jobs
+                  if task not in self.memmap_tasks and task not in self.packed_tasks and not self.is_cached(task, r)]
+        return [path for path in paths if path.endswith(PREFETCHED_EXTENSIONS + ('.pack',))]
+
+    def __getitems__(self, indices):
+        '''
+            Called by the DataLoader workers with the indices of a whole batch: with prefetch_threads,
+            the files of all samples are requested at once and decoded in order as they arrive.
+            With a ReadAheadBatch (see samplers.ReadAheadBatchSampler), the files of the worker's next
+            batch are requested too, and stay pending for the next call.
+        '''
+        if self.prefetcher is None:
+            return [self.load_sample(index, self.sample_jobs(index)) for index in indices]
+        # Jobs of the read-ahead samples are kept, as positive_rows may pick random views
+        ahead_paths, ahead_jobs = self._read_ahead
+        jobs = [ahead_jobs[index] if index in ahead_jobs else self.sample_jobs(index) for index in indices]
+        paths = Counter(path for sample_jobs in jobs for path in self.prefetch_paths(sample_jobs))
+        self.prefetcher.prefetch((paths - ahead_paths).elements())
+        ahead_jobs = {index: self.sample_jobs(index) for index in getattr(indices, 'read_ahead', ())}
+        ahead_paths = Counter(path for sample_jobs in ahead_jobs.values() for path in self.prefetch_paths(sample_jobs))
+        self.prefetcher.prefetch(ahead_paths.elements())
+        self._read_ahead = (ahead_paths, ahead_jobs)
+        try:
+            return [self.load_sample(index, sample_jobs) for index, sample_jobs in zip(indices, jobs)]
+        finally:
+            # Requests of this batch that were not read are cancelled, the read-ahead ones kept
+            self.prefetcher.retain(ahead_paths)
 
     def __getitem__(self, index):
+        return self.load_sample(index, self.sample_jobs(index))
+
+    def load_sample(self, index, jobs):
         
         result = {}
         
         # Anchor building / point / view
-        building, point, view = self.bpv_list[index]
+        row = self.sample_order[index]
+        building, point, view = self.index.bpv(row)
         
-        positive_views = [view]
+        positive_rows = [r for _, r in jobs[:len(jobs) // len(self.active_tasks)]]
         positive_samples = {}
-        
-        for task in self.tasks:
-            task_samples = []
-            for v in positive_views:
-                path = self.url_dict[(task, building, point, v)]
-                res = default_loader(path)
-
-                # additional transform for hypersim dataset because img size is (768, 1024)
-                if path.__contains__('hypersim'):
-                    resize_method = Image.BILINEAR if task in ['rgb'] else Image.NEAREST
-                    # resize_method = Image.BILINEAR if task not in ['segment_instance', 'segment_semantic', 'mask_valid'] else Image.NEAREST
-                    transform = transforms.Compose([
-                        transforms.Resize(self.image_size, resize_method), 
-                        transforms.CenterCrop(self.image_size)])
-                    res = transform(res)
-
-                if self.transform is not None and self.transform[task] is not None:
-                    res = self.transform[task](res)
-
-                # transforms for converting replica and hypersim labels to combined labels
-                if task == 'segment_semantic':
-                    res2 = res.clone()
-                    if path.__contains__('hypersim'):
-                        labels = torch.unique(res)
-                        for old_label in labels:
-                            if old_label == -1 or old_label == 255: continue
-                            res[res2 == old_label] = HYPERSIM_LABEL_TRANSFORM[old_label]
-                    if path.__contains__('replica-taskonomized'):
-                        labels = torch.unique(res)
-                        for old_label in labels:
-                            if old_label == -1 or old_label == 255: continue
-                            res[res2 == old_label] = REPLICA_LABEL_TRANSFORM[old_label]
-
-                task_samples.append(res)
-
-            task_samples = torch.stack(task_samples) if self.num_positive > 1 else task_samples[0]
+
+        # With a packed view store, one read per view gives the files of all packed tasks
+        packed = {}
+        if self.packed_views is not None:
+            packed = {r: self.read_packed_view(r) for r in dict.fromkeys(positive_rows) if self.needs_packed_view(r)}
+
+        # All files of the sample (num_positive views of the same point per task) are read together
+        if len(positive_rows) > 1 and self.read_threads > 1:
+            loaded = list(self.read_pool().map(lambda job: self.load_view(*job, packed.get(job[1])), jobs))
+        else:
+            loaded = [self.load_view(task, r, packed.get(r)) for task, r in jobs]
+
+        for i, task in enumerate(self.active_tasks):
+            task_samples = loaded[i * len(positive_rows):(i + 1) * len(positive_rows)]
+            if self.num_positive > 1:
+                stacked = torch.empty((len(task_samples),) + tuple(task_samples[0].shape), dtype=task_samples[0].dtype)
+                for j, sample in enumerate(task_samples):
+                    stacked[j] = sample
+                task_samples = stacked
+            else:
+                task_samples = task_samples[0]
 
             positive_samples[task] = task_samples
         
@@ -382,8 +551,14 @@ class TaskonomyReplicaGsoDataset(data.Dataset):
         #        result[i] = result[i][:num_channels,:,:]
 
     def randomize_order(self, seed=0):
-        random.seed(0)
-        random.shuffle(self.bpv_list)
+        self.sample_order = self._make_order(np.random.RandomState(seed))
+
+    def _make_order(self, rng):
+        if self.order == 'block':
+            return block_shuffle(self.index.group_offsets, rng, self.block_window)
+        elif self.order == 'shuffle':
+            return rng.permutation(len(self.index))
+        raise ValueError(f'Unknown sample order {self.order}, use "shuffle" or "block".')
     
     def task_config(self, task):
         return task_parameters[task]
@@ -396,154 +571,183 @@ class TaskonomyReplicaGsoDataset(data.Dataset):
                 filtered_urls: Filtered Dict
                 max_length: max([len(urls) for _, urls in filtered_urls.items()])
         '''
-        n_images_task = [(len(obs), task) for task, obs in dataset_urls.items()]
-        max_images = max(n_images_task)[0]
-        if max(n_images_task)[0] == min(n_images_task)[0]:
-            return dataset_urls, max_images
-        else:
-            print("Each task must have the same number of images. However, the max != min ({} != {}). Number of images per task is: \n\t{}".format(
-                max(n_images_task)[0], min(n_images_task)[0], "\n\t".join([str(t) for t in n_images_task])))
-            # Get views for each task
-            def _parse_fpath_for_view( path ):
-                url = path
-                if url.__contains__('replica-taskonomized'):
-                    building = url.split('/')[-3]
-                elif url.__contains__('replica-google-objects'): # e.g apartment_0-3, apartment_0-6
-                    building = url.split('/')[-4] + '-' + url.split('/')[-3]
-                elif url.__contains__('hypersim'): # e.g ai_001_001-cam_00, ai_001_001-cam_01
-                    building = url.split('/')[-5] + '-' + url.split('/')[-3]
-                elif url.__contains__('taskonomy'):
-                    building = url.split('/')[-2]
-                # building = os.path.basename(os.path.dirname(path))
-                file_name = os.path.basename(path) 
-                lf = parse_filename( file_name )
-                return View(view=lf.view, point=lf.point, building=building)
-
-            self.task_to_view = {}
-            for task, paths in dataset_urls.items():
-                self.task_to_view[task] = [_parse_fpath_for_view( path ) for path in paths]
-    
-            # Compute intersection
-            intersection = None
-            for task, uuids in self.task_to_view.items():
-                if intersection is None:
-                    intersection = set(uuids)
-                else:
-                    intersection = intersection.intersection(uuids)
-            # Keep intersection
-            print('Keeping intersection: ({} images/task)...'.format(len(intersection)))
-            new_urls = {}
-            for task, paths in dataset_urls.items():
-                new_urls[task] = [path for path in paths if _parse_fpath_for_view( path ) in intersection]
-            return new_urls, len(intersection)
-        raise NotImplementedError('Reached the end of this function. You should not be seeing this!')
+        return remove_unmatched_urls(dataset_urls, building_fn=building_from_url)
 
 
 
-def make_taskonomy_dataset(dir, task, folders=None):
-    # TODO remove later
-    if task == 'segment_semantic': dir = os.path.join(dir, '..', 'segment_panoptic')
-    #  folders are building names. If None, get all the images (from both building folders and dir)
-    images = []
-    dir = os.path.expanduser(dir)
-    if not os.path.isdir(dir):
-        assert "bad directory"
-
-    for subfolder in sorted(os.listdir(dir)):
-        subfolder_path = os.path.join(dir, subfolder)
-        if os.path.isdir(subfolder_path) and (folders is None or subfolder in folders):
-            for fname in sorted(os.listdir(subfolder_path)):
-                path = os.path.join(subfolder_path, fname)
-                images.append(path)
-
-        # If folders/buildings are not specified, use images in dir
-        if folders is None and os.path.isfile(subfolder_path):
-            images.append(subfolder_path)
+class BatchedConcatDataset(data.ConcatDataset):
+    '''
+        ConcatDataset that forwards __getitems__ to its datasets: the indices of a batch are split by
+        dataset (as is the read_ahead of a ReadAheadBatch) and each dataset gets its part at once,
+        so prefetch_threads and read-ahead also work for a mixture of TaskonomyReplicaGsoDatasets.
+        (torch's ConcatDataset has no __getitems__, so the DataLoader loads its samples one by one.)
+    '''
+    def _split(self, indices):
+        ''' {dataset: (positions in indices, indices within the dataset)} '''
+        parts = defaultdict(lambda: ([], []))
+        for position, index in enumerate(indices):
+            if index < 0:
+                index += len(self)
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, index)
+            parts[dataset_idx][0].append(position)
+            parts[dataset_idx][1].append(index - (self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0))
+        return parts
+
+    def __getitems__(self, indices):
+        parts = self._split(indices)
+        ahead = self._split(getattr(indices, 'read_ahead', ()))
+        samples = [None] * len(indices)
+        for dataset_idx in sorted(set(parts) | set(ahead)):
+            dataset = self.datasets[dataset_idx]
+            positions, batch = parts[dataset_idx] if dataset_idx in parts else ([], [])
+            if hasattr(dataset, '__getitems__'):
+                # Also called with an empty batch, to request the read-ahead of this dataset
+                loaded = dataset.__getitems__(ReadAheadBatch(batch, ahead[dataset_idx][1] if dataset_idx in ahead else ()))
+            else:
+                loaded = [dataset[i] for i in batch]
+            for position, sample in zip(positions, loaded):
+                samples[position] = sample
+        return samples
 
-    return images
 
-def make_replica_gso_dataset(dir, task, folders=None):
-    if task == 'segment_semantic': task = 'semantic'
-    #  folders are building names. 
-    images = []
+def scan_taskonomy_dataset(dir, tasks, folders=None, scanner=None):
+    #  folders are building names. If None, use all buildings found in any of the task folders.
+    #  Each building is scanned once for all tasks.
+    scanner = DirectoryScanner() if scanner is None else scanner
+    dir = os.path.expanduser(dir)
+    # TODO remove later
+    task_dirs = {task: os.path.join(dir, 'segment_panoptic' if task == 'segment_semantic' else task) for task in tasks}
+    # Task directories have to exist (raises otherwise)
+    buildings_per_task = [scanner.listdir(task_dir) for task_dir in task_dirs.values()]
+    if folders is None:
+        folders = set().union(*buildings_per_task)
+
+    def scan_building(building):
+        images = {}
+        for task, task_dir in task_dirs.items():
+            # A building may lack some tasks; its views are then dropped by _remove_unmatched_images
+            building_path = os.path.join(task_dir, building)
+            images[task] = [os.path.join(building_path, fname) for fname in scanner.listdir(building_path, missing_ok=True)]
+        return images
+
+    per_building = scanner.map(scan_building, sorted(folders))
+    return {task: [path for images in per_building for path in images[task]] for task in tasks}
+
+def scan_replica_gso_dataset(dir, tasks, folders=None, scanner=None):
+    #  folders are building names. Each building is scanned once for all tasks.
+    scanner = DirectoryScanner() if scanner is None else scanner
     dir = os.path.expanduser(dir)
-    if not os.path.isdir(dir):
-        assert "bad directory"
-    
     if folders is None:
-        folders = os.listdir(dir)
+        folders = scanner.listdir(dir)
 
-    for folder in folders:
+    def scan_building(folder):
         if folder not in REPLICA_BUILDINGS: # gso dataset e.g. apartment_0-3, apartment_0-6, apartment_0-15
-            folder_path = os.path.join(dir, folder.split('-')[0], folder.split('-')[1], task)
+            building_path = os.path.join(dir, folder.split('-')[0], folder.split('-')[1])
         else: # replica dataset
-            folder_path = os.path.join(dir, folder, task)
-        for fname in sorted(os.listdir(folder_path)):
-            path = os.path.join(folder_path, fname)
-            images.append(path)
-
-    return images
-
-def make_hypersim_dataset(dir, task, folders=None):
-    if task == 'segment_semantic': task = 'semantic_hdf5'
-    #  folders are building names. 
-    images = []
+            building_path = os.path.join(dir, folder)
+        images = {}
+        for task in tasks:
+            folder_path = os.path.join(building_path, 'semantic' if task == 'segment_semantic' else task)
+            images[task] = [os.path.join(folder_path, fname) for fname in scanner.listdir(folder_path)]
+        return images
+
+    per_building = scanner.map(scan_building, folders)
+    return {task: [path for images in per_building for path in images[task]] for task in tasks}
+
+def scan_hypersim_dataset(dir, tasks, folders=None, scanner=None):
+    #  folders are building names. Each scene is scanned once for all tasks.
+    scanner = DirectoryScanner() if scanner is None else scanner
     dir = os.path.expanduser(dir)
-    if not os.path.isdir(dir):
-        assert "bad directory"
+    if folders is None:
+        folders = scanner.listdir(dir)
 
-    for folder in folders:
+    def scan_scene(folder):
+        images = {task: [] for task in tasks}
         taskonomized_path = os.path.join(dir, folder, 'taskonomized')
-        for camera in os.listdir(taskonomized_path):
+        for camera in scanner.listdir(taskonomized_path):
             if not camera.startswith('cam'):
                 continue
             # filter out bad points from filtered_points.json
             with open(os.path.join(taskonomized_path, camera, 'filtered_points.json')) as json_file:
                 bad_points = json.load(json_file)
-            folder_path = os.path.join(taskonomized_path, camera, task)
-            for fname in sorted(os.listdir(folder_path)):
-                point = fname.split('_')[1]
-                if point not in bad_points:
-                    path = os.path.join(folder_path, fname)
-                    images.append(path)
-
-    return images
-
-def make_hypersim_dataset_orig_split(dir, task, split):
+            for task in tasks:
+                folder_path = os.path.join(taskonomized_path, camera, 'semantic_hdf5' if task == 'segment_semantic' else task)
+                for fname in scanner.listdir(folder_path):
+                    point = fname.split('_')[1]
+                    if point not in bad_points:
+                        images[task].append(os.path.join(folder_path, fname))
+        return images
+
+    per_scene = scanner.map(scan_scene, folders)
+    return {task: [path for images in per_scene for path in images[task]] for task in tasks}
+
+@lru_cache(maxsize=None)
+def hypersim_split_frames(split):
+    '''
+        {(scene, camera): sorted int64 array of frame ids} of the frames in the public release that
+        belong to split, from splits/{split}_hypersim_orig.csv. Computed once per split.
+    '''
     hypersim_orig_split_file = os.path.join(os.path.dirname(__file__), 'splits', f'{split}_hypersim_orig.csv')
     df = pd.read_csv(hypersim_orig_split_file)
+    df = df[df['included_in_public_release'].astype(bool) & (df['split_partition_name'] == split)]
+    return {key: np.unique(group['frame_id'].to_numpy(np.int64))
+            for key, group in df.groupby(['scene_name', 'camera_name'], sort=False)}
+
+
+@lru_cache(maxsize=None)
+def _load_filtered_points(path, mtime_ns):
+    with open(path) as json_file:
+        return frozenset(json.load(json_file))
 
-    if task == 'segment_semantic': task = 'semantic_hdf5'
-    #  folders are building names. 
-    images = []
+
+def load_filtered_points(path):
+    ''' Bad points listed in a hypersim camera's filtered_points.json, cached until the file changes '''
+    return _load_filtered_points(path, os.stat(path).st_mtime_ns)
+
+
+def scan_hypersim_dataset_orig_split(dir, tasks, split, scanner=None):
+    split_frames = hypersim_split_frames(split)
+    split_scenes = {scene for scene, _ in split_frames}
+
+    #  folders are building names. Each scene is scanned once for all tasks.
+    scanner = DirectoryScanner() if scanner is None else scanner
     dir = os.path.expanduser(dir)
-    if not os.path.isdir(dir):
-        assert "bad directory"
+    folders = [scene for scene in scanner.listdir(dir) if scene in split_scenes]
 
-    folders = [scene for scene in set(df['scene_name'].tolist()) if scene in os.listdir(dir)]
-    for folder in folders:
-        scene = df.loc[df['scene_name']==folder]
+    def scan_scene(folder):
+        images = {task: [] for task in tasks}
         taskonomized_path = os.path.join(dir, folder, 'taskonomized')
-        for camera in os.listdir(taskonomized_path):
+        for camera in scanner.listdir(taskonomized_path):
             if not camera.startswith('cam'):
                 continue
-            scene_cam = scene.loc[scene['camera_name']==camera]
+            frames = split_frames.get((folder, camera))
+            if frames is None:
+                continue
             # filter out bad points from filtered_points.json
-            with open(os.path.join(taskonomized_path, camera, 'filtered_points.json')) as json_file:
-                bad_points = json.load(json_file)
-            folder_path = os.path.join(taskonomized_path, camera, task)
-            for fname in sorted(os.listdir(folder_path)):
-                point = fname.split('_')[1]
-                if point in bad_points: continue
+            bad_points = load_filtered_points(os.path.join(taskonomized_path, camera, 'filtered_points.json'))
+            for task in tasks:
+                folder_path = os.path.join(taskonomized_path, camera, 'semantic_hdf5' if task == 'segment_semantic' else task)
+                fnames = [fname for fname in scanner.listdir(folder_path) if fname.split('_')[1] not in bad_points]
+                points = np.array([int(fname.split('_')[1]) for fname in fnames], dtype=np.int64)
+                keep = np.isin(points, frames)
+                images[task] += [os.path.join(folder_path, fname) for fname, k in zip(fnames, keep) if k]
+        return images
 
-                row = scene_cam.loc[scene_cam['frame_id']==int(point)]
-                if not row.empty and row.iloc[0]['included_in_public_release'] and row.iloc[0]['split_partition_name'] == split:
-                    path = os.path.join(folder_path, fname)
-                    images.append(path)
+    per_scene = scanner.map(scan_scene, folders)
+    return {task: [path for images in per_scene for path in images[task]] for task in tasks}
 
-        print(len(images))
 
-    return images
+def make_taskonomy_dataset(dir, task, folders=None):
+    return scan_taskonomy_dataset(os.path.dirname(os.path.normpath(dir)), [task], folders)[task]
+
+def make_replica_gso_dataset(dir, task, folders=None):
+    return scan_replica_gso_dataset(dir, [task], folders)[task]
+
+def make_hypersim_dataset(dir, task, folders=None):
+    return scan_hypersim_dataset(dir, [task], folders)[task]
+
+def make_hypersim_dataset_orig_split(dir, task, split):
+    return scan_hypersim_dataset_orig_split(dir, [task], split)[task]
 
 
 def make_empty_like(data_dict):
@@ -12,6 +12,7 @@ import torch.nn.functional as F
 from   typing import Optional
 
 from . import task_configs
+from .decoders import decode_file
 
 try:
     import accimage
@@ -120,12 +121,125 @@ def transform_16bit_n_channel(n_channel=1):
 
 
 
+# Raw pipeline: the same decoding and resizing as get_transform, but the result keeps the integer
+# values of the image (uint8 / int16 / ...) so it can be stored compactly or shipped to the GPU.
+# get_finalize_transform(task)(get_raw_transform(task, size)(img)) == get_transform(task, size)(img)
+RAW_8BIT_TASKS = ['rgb', 'normal', 'reshading', 'mask_valid', 'principal_curvature', 'curvature']
+RAW_16BIT_TASKS = ['keypoints2d', 'keypoints3d', 'depth_euclidean', 'depth_zbuffer', 'edge_texture', 'edge_occlusion']
+RAW_LABEL_TASKS = ['segment_semantic', 'segment_instance', 'segment_panoptic']
+# Raw labels of every source (taskonomy images, remapped replica / hypersim labels) share one dtype
+# that holds -1..255, so default_collate never truncates a mixed batch to the first sample's dtype
+RAW_LABEL_DTYPE = torch.int16
+
+def get_raw_transform(task: str, image_size=Optional[int]):
+    if task in RAW_8BIT_TASKS or task in RAW_16BIT_TASKS:
+        transform = pil_to_raw_tensor
+    elif task in RAW_LABEL_TASKS:
+        transform = transform_dense_labels_raw
+    else:
+        raise NotImplementedError("Unknown raw transform for task {}".format(task))
+
+    if image_size is not None:
+        resize_method = Image.BILINEAR if task in ['rgb'] else Image.NEAREST
+        transform = transforms.Compose([
+            transforms.Resize(image_size, resize_method),
+            transform])
+    return transform
+
+def get_finalize_transform(task: str):
+    ''' Converts the output of get_raw_transform (or a batch of them) to what get_transform returns '''
+    if task in RAW_LABEL_TASKS:
+        return lambda x: x.long()
+    if task not in RAW_8BIT_TASKS and task not in RAW_16BIT_TASKS:
+        raise NotImplementedError("Unknown finalize transform for task {}".format(task))
+
+    scale = 1.0
+    if task in RAW_16BIT_TASKS:
+        scale *= (2 ** 16 - 1.0)
+    if 'clamp_to' in task_configs.task_parameters[task]:
+        minn, maxx = task_configs.task_parameters[task]['clamp_to']
+        if minn > 0:
+            raise NotImplementedError("Rescaling (min1, max1) -> (min2, max2) not implemented for min1, min2 != 0 (task {})".format(task))
+        return lambda x: raw_to_float(x) / scale / maxx
+    if scale == 1.0:
+        return raw_to_float
+    return lambda x: raw_to_float(x) / scale
+
+class BatchedTransform(nn.Module):
+    '''
+        Applies the per-sample part of get_transform (resize, rescale / clamp, rgb normalization) to a
+        collated batch of raw tensors (see get_raw_transform with image_size=None), e.g. after it was
+        moved to the GPU:
+
+            batched_transform = BatchedTransform(tasks, image_size=256, normalize_rgb=True).to(device)
+            batch['positive'] = batched_transform(batch['positive'])
+
+        Image tasks are (..., C, H, W). Label tasks are (..., H, W) or channels last (..., H, W, C)
+        and are resized with nearest neighbour sampling. Bilinear (rgb) resizing is antialiased like
+        PIL's, but not bit-exact with it.
+    '''
+    def __init__(self, tasks, image_size: Optional[int] = None, normalize_rgb: bool = False,
+                 rgb_mean=(0.55312, 0.52514, 0.49313), rgb_std=(0.20555, 0.21775, 0.24044)):
+        super().__init__()
+        self.tasks = list(tasks)
+        self.image_size = image_size
+        self.normalize_rgb = normalize_rgb
+        self.finalize = {task: get_finalize_transform(task) for task in self.tasks}
+        self.register_buffer('rgb_mean', torch.tensor(rgb_mean).reshape(3, 1, 1), persistent=False)
+        self.register_buffer('rgb_std', torch.tensor(rgb_std).reshape(3, 1, 1), persistent=False)
+
+    def _resize(self, x, task):
+        if self.image_size is None or x.shape[-2:] == (self.image_size, self.image_size):
+            return x
+        shape = x.shape
+        x = x.reshape(-1, *shape[-3:])
+        if task == 'rgb':
+            x = F.interpolate(x, self.image_size, mode='bilinear', align_corners=False, antialias=True)
+        else:
+            x = F.interpolate(x, self.image_size, mode='nearest-exact')
+        return x.reshape(*shape[:-2], *x.shape[-2:])
+
+    def _resize_labels(self, x, task):
+        channels_last = x.shape[-1] < 5
+        if channels_last:
+            x = x.movedim(-1, -3)
+        else:
+            x = x.unsqueeze(-3)
+        # Labels are small integers, so nearest resizing in float is exact
+        x = self._resize(x.float(), task)
+        x = x.movedim(-3, -1) if channels_last else x.squeeze(-3)
+        return self.finalize[task](x)
+
+    def forward(self, batch):
+        for task in self.tasks:
+            if task not in batch:
+                continue
+            if task in RAW_LABEL_TASKS:
+                batch[task] = self._resize_labels(batch[task], task)
+                continue
+            x = self._resize(self.finalize[task](batch[task]), task)
+            if task == 'rgb' and self.normalize_rgb:
+                x = (x - self.rgb_mean) / self.rgb_std
+            batch[task] = x
+        return batch
+
+def pil_to_raw_tensor(img):
+    ''' Like ToTensor, but keeps the integer values. 16-bit images are read as int16, as ToTensor does '''
+    if img.mode == 'I;16':
+        return torch.from_numpy(np.array(img).view(np.int16)).unsqueeze(0)
+    return transforms.functional.pil_to_tensor(img)
+
+transform_dense_labels_raw = lambda img: torch.from_numpy(np.array(img).astype(np.int16))
+
+def raw_to_float(x):
+    ''' ToTensor's conversion: 8-bit values are scaled to [0, 1], anything else is only cast '''
+    return x.float() / 255 if x.dtype == torch.uint8 else x.float()
+
+
+
 def default_loader(path):
     if '.hdf5' in path:  # semantic labels for hypersim
-        with h5py.File(path, "r") as f:
-            data=f['dataset'][:]
-            data_arr = np.repeat(np.expand_dims(data, axis=2), 3, axis=2)
-            return Image.fromarray(np.uint8(data_arr))
+        return decode_file(path)
     elif '.npy' in path:
         return np.load(path)
     elif '.json' in path:
@@ -144,15 +258,15 @@ def default_loader(path):
         if get_image_backend() == 'accimage':
             im = accimage_loader(path)
         else:
-            im = pil_loader(path)
+            im = decode_file(path)
         return im
 
 def pil_loader(path):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
         img = Image.open(f)
-        return img.convert(img.mode)
-        return img.convert('RGB')
+        img.load()
+        return img
 
 # Faster than pil_loader, if accimage is available
 def accimage_loader(path):
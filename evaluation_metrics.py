@@ -104,4 +104,235 @@ def get_metrics(pred, target, task=None, masks=None):
         })
 
     
-    return return_dict
\ No newline at end of file
+    return return_dict
+
+METRIC_NAMES = {
+    'normal': ['eval_mse', 'eval_L1', 'percentage_within_11.25_degrees', 'percentage_within_22.5_degrees',
+               'percentage_within_30_degrees', 'ang_error_without_masking', 'ang_error_mean', 'ang_error_median'],
+    'depth_zbuffer': ['eval_mse', 'eval_L1', 'log10_diff', 'log10', 'rel_error', 'irmse', 'si_log'],
+}
+
+# Per-pixel errors whose dataset-level quantiles are reported: {task: {error: (max_value, num_bins)}}.
+# Angles in degrees (0.01 degree bins), depth errors of depths in [0, 1] (1e-4 bins)
+PIXEL_ERRORS = {
+    'normal': {'ang_error': (180.0, 18000)},
+    'depth_zbuffer': {'abs_error': (1.0, 10000)},
+}
+PIXEL_QUANTILES = (0.5, 0.75, 0.9, 0.95)
+
+
+def _all_reduce(tensor):
+    ''' Sum of tensor over all DDP ranks (a copy), or tensor itself outside of DDP '''
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return tensor
+    if torch.distributed.get_backend() == 'nccl':
+        tensor = tensor.to(torch.device('cuda', torch.cuda.current_device()))
+    tensor = tensor.clone()
+    torch.distributed.all_reduce(tensor)
+    return tensor
+
+
+class ErrorHistogram:
+    '''
+        Fixed-bin histogram of non-negative per-pixel errors, a quantile sketch in constant memory:
+        num_bins counts of [0, max_value), values >= max_value go into the last bin. quantile()
+        interpolates linearly within a bin, so it is off by at most max_value / num_bins (below
+        max_value). Histograms with the same bins merge by adding their counts: merge() (e.g. the
+        histograms of different workers) or all_reduce() across DDP ranks.
+    '''
+    def __init__(self, max_value: float, num_bins: int, device=None):
+        self.max_value = max_value
+        self.num_bins = num_bins
+        self.counts = torch.zeros(num_bins, dtype=torch.int64, device=device)
+
+    @property
+    def bin_width(self):
+        return self.max_value / self.num_bins
+
+    def update(self, errors, masks=None):
+        ''' Counts errors[masks] (nan / inf are skipped) '''
+        errors = errors.detach()
+        valid = torch.isfinite(errors)
+        if masks is not None:
+            valid &= masks.to(device=errors.device, dtype=torch.bool)
+        bins = (errors[valid] / self.bin_width).long().clamp_(0, self.num_bins - 1)
+        counts = torch.bincount(bins, minlength=self.num_bins)
+        self.counts = self.counts.to(counts.device)
+        self.counts += counts
+
+    def merge(self, other: 'ErrorHistogram'):
+        if (other.max_value, other.num_bins) != (self.max_value, self.num_bins):
+            raise ValueError(f'Cannot merge histograms with different bins: {other.num_bins} bins up to {other.max_value} '
+                             f'and {self.num_bins} bins up to {self.max_value}.')
+        self.counts += other.counts.to(self.counts.device)
+        return self
+
+    def all_reduce(self):
+        ''' A histogram of the counts of all DDP ranks; every rank has to call it '''
+        reduced = ErrorHistogram(self.max_value, self.num_bins)
+        reduced.counts = _all_reduce(self.counts)
+        return reduced
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        ''' The q-quantile (or a list of them, for a sequence q) of the counted errors; nan if there are none '''
+        qs = torch.as_tensor(q, dtype=torch.float64).reshape(-1)
+        counts = self.counts.cpu().double()
+        cdf = counts.cumsum(0)
+        if cdf[-1] == 0:
+            values = torch.full_like(qs, float('nan'))
+        else:
+            # At least a tiny positive rank, so that q = 0 is the start of the first non-empty bin
+            rank = (qs.clamp(0, 1) * cdf[-1]).clamp(min=torch.finfo(torch.float64).tiny)
+            bins = torch.searchsorted(cdf, rank).clamp_(max=self.num_bins - 1)
+            below = torch.where(bins > 0, cdf[(bins - 1).clamp(min=0)], torch.zeros_like(rank))
+            within = ((rank - below) / counts[bins]).clamp(0, 1).nan_to_num(0)
+            values = (bins + within) * self.bin_width
+        return values.tolist() if isinstance(q, (list, tuple)) else values.item()
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def _masked_median(values, masks, num_valid):
+    ''' np.median of values[i][masks[i]] for every row i (the mean of the two middle values for even counts) '''
+    # nan sorts last, so the valid values of a row come first
+    values = values.masked_fill(~masks, float('nan')).sort(dim=1).values
+    num_valid = num_valid.long()
+    lower = ((num_valid - 1) // 2).clamp(min=0)
+    upper = num_valid // 2
+    return (values.gather(1, lower[:, None]) + values.gather(1, upper[:, None]))[:, 0] / 2
+
+
+def get_batch_metrics(pred, target, task=None, masks=None):
+    '''
+        get_metrics for every image of a batch at once, on the device of pred: {metric: tensor [B]}.
+        The values are the ones get_metrics returns for pred[i:i+1], target[i:i+1], masks[i:i+1];
+        images without valid pixels get nan or inf (get_metrics returns None for them).
+    '''
+    return _batch_metrics(pred, target, task=task, masks=masks)[0]
+
+
+def _batch_metrics(pred, target, task=None, masks=None):
+    ''' get_batch_metrics, and the per-pixel errors of PIXEL_ERRORS[task] ([B, H, W]) '''
+    pred = pred.detach().double()
+    target = target.detach().double()
+    masks = masks.detach()[:, 0].to(device=pred.device, dtype=torch.bool)
+    num_pixels = masks[0].numel()
+    num_valid_pixels = masks.sum((1, 2)).double()
+    ratio_inverse_valid = num_pixels / num_valid_pixels
+    # [B, 1, H, W], broadcasts over channels
+    flat_masks = masks.unsqueeze(1)
+    per_image = lambda x: x.flatten(1).mean(1)
+
+    return_dict, pixel_errors = {}, {}
+    if task == 'normal':
+        norm = lambda a: torch.sqrt((a * a).sum(1))
+        w12 = (pred * target).sum(1)
+        cosine_similarity = (w12 / (norm(pred) * norm(target)).clamp(min=1e-8)).clamp(min=-1.0, max=1.0)
+        ang_errors_per_pixel = torch.acos(cosine_similarity) * 180 / math.pi
+        pixel_errors['ang_error'] = ang_errors_per_pixel
+
+        for threshold, name in [(11.25, '11.25'), (22.5, '22.5'), (30, '30')]:
+            within = ((ang_errors_per_pixel <= threshold) & masks).sum((1, 2))
+            return_dict[f'percentage_within_{name}_degrees'] = within / num_valid_pixels
+        return_dict.update({
+            'ang_error_without_masking': per_image(ang_errors_per_pixel),
+            'ang_error_mean': (ang_errors_per_pixel * masks).sum((1, 2)) / num_valid_pixels,
+            'ang_error_median': _masked_median(ang_errors_per_pixel.flatten(1), masks.flatten(1), num_valid_pixels),
+        })
+
+        normed_pred = pred / (norm(pred)[:, None] + 2e-2)
+        normed_target = target / (norm(target)[:, None] + 2e-2)
+        diff = (normed_pred - normed_target).abs() * flat_masks
+    else:
+        diff = (pred - target).abs() * flat_masks
+
+    if task == 'depth_zbuffer':
+        pixel_errors['abs_error'] = diff[:, 0]
+        log10_diff = (torch.log(1 + 64 * diff) * flat_masks).masked_fill(~flat_masks, 0)
+        log_diff = (torch.log(1 + 64 * pred) - torch.log(1 + 64 * target)) * flat_masks
+        si_log = log_diff.abs()
+        return_dict.update({
+            'log10_diff': per_image(log10_diff) * ratio_inverse_valid,
+            'log10': per_image(log_diff.abs()) * ratio_inverse_valid,
+            'rel_error': per_image((diff / target) * flat_masks) * ratio_inverse_valid,
+            'irmse': per_image(((1. / (1. + 64. * pred) - 1. / (1. + 64. * target)) ** 2) * flat_masks) * ratio_inverse_valid,
+            'si_log': (si_log ** 2).flatten(1).sum(1) / num_valid_pixels - si_log.flatten(1).sum(1) ** 2 / num_valid_pixels ** 2,
+        })
+
+    return_dict['eval_mse'] = per_image(diff ** 2) * ratio_inverse_valid * 100
+    return_dict['eval_L1'] = per_image(diff) * ratio_inverse_valid * 100
+    return return_dict, pixel_errors
+
+
+class MetricAccumulator:
+    '''
+        Mean and standard deviation over images of every get_batch_metrics value, accumulated on the
+        device in one [3, num_metrics] tensor (number of images, sum, sum of squares). Replaces pushing
+        the get_metrics values of each image into runstats.Statistics:
+
+            __init__:           self.metrics = MetricAccumulator('normal')
+            test_step:          self.metrics.update(preds, target, mask_valid)
+            test_epoch_end:     self.results = self.metrics.compute()
+
+        Images without valid pixels are skipped, as before. compute() sums the accumulators of all DDP
+        ranks (one all_reduce) and returns {metric: mean, metric_std: std}, the std with ddof=1 like
+        Statistics.variance().
+
+        The per-pixel errors of PIXEL_ERRORS[task] also go into an ErrorHistogram each, for quantiles
+        over all valid pixels of the dataset: {error}_pixel_median and {error}_pixel_p75 etc. in
+        compute() (e.g. ang_error_pixel_median, unlike ang_error_median, the mean of per-image medians).
+    '''
+    def __init__(self, task: str, quantiles=PIXEL_QUANTILES):
+        if task not in METRIC_NAMES:
+            raise ValueError(f'No metrics for task {task}, choose from {list(METRIC_NAMES)}.')
+        self.task = task
+        self.names = METRIC_NAMES[task]
+        self.quantiles = quantiles
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.histograms = {name: ErrorHistogram(*bins) for name, bins in PIXEL_ERRORS[self.task].items()}
+
+    def update(self, pred, target, masks):
+        metrics, pixel_errors = _batch_metrics(pred, target, task=self.task, masks=masks)
+        for name, errors in pixel_errors.items():
+            self.histograms[name].update(errors, masks[:, 0])
+        values = torch.stack([metrics[name] for name in self.names], dim=1)
+        valid_images = masks[:, 0].to(values.device).flatten(1).any(1)
+        values = values[valid_images]
+        update = torch.stack([
+            values.new_full((len(self.names),), len(values)),
+            values.sum(0),
+            (values ** 2).sum(0),
+        ])
+        if self.state is None:
+            self.state = update
+        else:
+            self.state += update
+
+    def _reduced_state(self):
+        state = self.state
+        if state is None:
+            # Every rank has to take part in the all_reduce, even without test batches
+            state = torch.zeros(3, len(self.names), dtype=torch.float64)
+        return _all_reduce(state)
+
+    def compute(self):
+        state = self._reduced_state()
+        count, total, total_squares = state.cpu().tolist()
+        results = {}
+        for name, n, s, s2 in zip(self.names, count, total, total_squares):
+            mean = s / n if n > 0 else float('nan')
+            variance = (s2 - n * mean ** 2) / (n - 1) if n > 1 else float('nan')
+            results[name] = mean
+            results[name + '_std'] = math.sqrt(max(variance, 0.0))
+        for name, histogram in self.histograms.items():
+            values = histogram.all_reduce().quantile(list(self.quantiles))
+            for q, value in zip(self.quantiles, values):
+                results[f'{name}_pixel_median' if q == 0.5 else f'{name}_pixel_p{100 * q:g}'] = value
+        return results
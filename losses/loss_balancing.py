@@ -1,24 +1,32 @@
+import torch
+import torch.nn as nn
 
 
-def compute_grad_norm_losses(losses, model):
+def compute_grad_norm_losses(losses, shared):
     '''
     Balances multiple losses by weighting them inversly proportional
     to their overall gradient contribution.
-    
+
+    The contribution of a loss is its mean absolute gradient w.r.t. the parameters of `shared`,
+    a layer all losses go through (e.g. the last backbone stage). Gradients are taken with
+    torch.autograd.grad, which only runs the part of the backward pass between the losses and that
+    layer and leaves the .grad of the parameters untouched. Nothing is synchronized with the GPU.
+
     Args:
         losses: A dictionary of losses.
-        model: A PyTorch model.
+        shared: A PyTorch module (or an iterable of its parameters) shared by all losses.
     Returns:
-        A dictionary of loss weights.
+        A dictionary of loss weights (detached scalar tensors).
     '''
+    params = shared.parameters() if isinstance(shared, nn.Module) else shared
+    params = [w for w in params if w.requires_grad]
+
     grad_norms = {}
-    model.zero_grad()
     for loss_name, loss in losses.items():
-        loss.backward(retain_graph=True)
-        grad_sum = sum([w.grad.abs().sum().item() for w in model.parameters() if w.grad is not None])
-        num_elem = sum([w.numel() for w in model.parameters() if w.grad is not None])
-        grad_norms[loss_name] = grad_sum / num_elem
-        model.zero_grad()
+        grads = torch.autograd.grad(loss, params, retain_graph=True, allow_unused=True)
+        grads = [g for g in grads if g is not None]
+        num_elem = sum([g.numel() for g in grads])
+        grad_norms[loss_name] = torch.stack([g.detach().norm(p=1, dtype=torch.float32) for g in grads]).sum() / num_elem
 
     grad_norms_total = sum(grad_norms.values())
 
@@ -26,5 +34,5 @@ def compute_grad_norm_losses(losses, model):
     for loss_name, loss in losses.items():
         weight = (grad_norms_total - grad_norms[loss_name]) / ((len(losses) - 1) * grad_norms_total)
         loss_weights[loss_name] = weight
-        
-    return loss_weights
\ No newline at end of file
+
+    return loss_weights
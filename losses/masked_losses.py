@@ -1,17 +1,79 @@
 import torch
 
-def masked_l1_loss(preds, target, mask_valid):
-    element_wise_loss = abs(preds - target)
-    element_wise_loss[~mask_valid] = 0
-    return element_wise_loss.sum() / mask_valid.sum()
 
-def masked_mse_loss(preds, target, mask_valid):
-    element_wise_loss = (preds - target)**2
-    element_wise_loss[~mask_valid] = 0
-    return element_wise_loss.sum() / mask_valid.sum()
+_REDUCTIONS = {'mean': (), 'sample': (0,), 'channel': (1,)}
+
+
+class _MaskedDistance(torch.autograd.Function):
+    '''
+        Sum of |preds - target| (or (preds - target)**2) over the valid pixels, reduced over all
+        dimensions but keep_dims. The element-wise loss only exists as one temporary during forward:
+        backward recomputes the difference from preds and target instead of keeping it alive
+        (abs / pow save it for backward, which for a 512x512 multi-task batch is the size of every
+        prediction again).
+    '''
+    @staticmethod
+    def forward(ctx, preds, target, mask_valid, keep_dims, squared):
+        loss = preds - target
+        if squared:
+            loss.mul_(loss)
+        else:
+            loss.abs_()
+        # Zeroed rather than multiplied, so that inf / nan in invalid pixels do not leak into the sum
+        loss.masked_fill_(mask_valid.logical_not(), 0)
+        ctx.save_for_backward(preds, target, mask_valid)
+        ctx.keep_dims, ctx.squared = keep_dims, squared
+        sum_dims = [d for d in range(loss.dim()) if d not in keep_dims]
+        return loss.sum(sum_dims) if keep_dims else loss.sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        preds, target, mask_valid = ctx.saved_tensors
+        grad = preds - target
+        if ctx.squared:
+            grad.mul_(2)
+        else:
+            grad.sign_()
+        grad.masked_fill_(mask_valid.logical_not(), 0)
+        if ctx.keep_dims:
+            shape = [preds.shape[d] if d in ctx.keep_dims else 1 for d in range(preds.dim())]
+            grad.mul_(grad_output.reshape(shape))
+        else:
+            grad.mul_(grad_output)
+        grad_preds = grad if ctx.needs_input_grad[0] else None
+        grad_target = -grad if ctx.needs_input_grad[1] else None
+        return grad_preds, grad_target, None, None, None
+
+
+def _masked_distance(preds, target, mask_valid, reduction, squared):
+    '''
+        reduction:
+            'mean':     sum over all valid elements / number of valid elements (a scalar)
+            'sample':   the same per sample, [B]
+            'channel':  the same per channel, [C]
+        mask_valid has to broadcast to preds (e.g. [B, 1, H, W] for [B, 3, H, W] normals); valid
+        elements are counted after broadcasting.
+    '''
+    if reduction not in _REDUCTIONS:
+        raise ValueError(f'Unknown reduction {reduction}, choose from {list(_REDUCTIONS)}.')
+    keep_dims = _REDUCTIONS[reduction]
+    total = _MaskedDistance.apply(preds, target, mask_valid, keep_dims, squared)
+    mask_valid = mask_valid.expand_as(preds)
+    if keep_dims:
+        num_valid = mask_valid.sum([d for d in range(preds.dim()) if d not in keep_dims])
+    else:
+        num_valid = mask_valid.sum()
+    return total / num_valid
+
+
+def masked_l1_loss(preds, target, mask_valid, reduction='mean'):
+    return _masked_distance(preds, target, mask_valid, reduction, squared=False)
+
+def masked_mse_loss(preds, target, mask_valid, reduction='mean'):
+    return _masked_distance(preds, target, mask_valid, reduction, squared=True)
 
 def masked_loss(element_wise_loss, mask_valid):
-    element_wise_loss[~mask_valid] = 0
-    if mask_valid.sum() == 0:
+    num_valid = mask_valid.sum()
+    if num_valid == 0:
         return torch.tensor(0.0).to(element_wise_loss.device)
-    return element_wise_loss.sum() / mask_valid.sum()
\ No newline at end of file
+    return element_wise_loss.masked_fill(mask_valid.logical_not(), 0).sum() / num_valid
@@ -4,8 +4,6 @@ import numpy as np
 import random
 import json
 import math
-from collections import defaultdict
-from runstats import Statistics
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
@@ -24,10 +22,11 @@ from matplotlib import cm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset
+from data.masks import make_valid_mask
 # from data.nyu_dataset import NYUDataset
 from models.unet import UNet
 from losses import masked_l1_loss, compute_grad_norm_losses
-from evaluation_metrics import get_metrics
+from evaluation_metrics import MetricAccumulator
 
 
 class DepthTest(pl.LightningModule):
@@ -92,7 +91,8 @@ class DepthTest(pl.LightningModule):
                 state_dict = checkpoint
             self.model.load_state_dict(state_dict)
 
-        self.metrics = defaultdict(Statistics)
+        self.metrics = MetricAccumulator('depth_zbuffer')
+        self.results = {}
 
     @staticmethod
     def add_model_specific_args(parent_parser):
@@ -223,40 +223,13 @@ class DepthTest(pl.LightningModule):
 
 
         # Mask out invalid pixels and compute loss
-        mask_valid = self.make_valid_mask(batch['positive']['mask_valid'])
-        for pred, target, mask in zip(depth_preds, depth_gt, mask_valid):
-            # print("******** ", pred.max(), pred.min(), target.max(), target.min(), mask.max())
-            metrics = get_metrics(pred.cpu().unsqueeze(0), target.cpu().unsqueeze(0), \
-                masks=mask.cpu().unsqueeze(0), task='depth_zbuffer')
-            for metric_name, metric_val in metrics.items(): 
-                self.metrics[metric_name].push(metric_val)
-    
-
-    def make_valid_mask(self, mask_float, max_pool_size=4, return_small_mask=False):
-        '''
-            Creates a mask indicating the valid parts of the image(s).
-            Enlargens masked area using a max pooling operation.
-
-            Args:
-                mask_float: A mask as loaded from the Taskonomy loader.
-                max_pool_size: Parameter to choose how much to enlarge masked area.
-                return_small_mask: Set to true to return mask for aggregated image
-        '''
-        if len(mask_float.shape) == 3:
-            mask_float = mask_float.unsqueeze(axis=0)
-        reshape_temp = len(mask_float.shape) == 5
-        if reshape_temp:
-            mask_float = rearrange(mask_float, 'b p c h w -> (b p) c h w')
-        mask_float = 1 - mask_float
-        mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
-        mask_float = F.interpolate(mask_float, (self.image_size, self.image_size), mode='nearest')
-        mask_valid = mask_float == 0
-        if reshape_temp:
-            mask_valid = rearrange(mask_valid, '(b p) c h w -> b p c h w', p=self.num_positive)
-
-        return mask_valid
-
+        mask_valid = make_valid_mask(batch['positive']['mask_valid'], self.image_size)
+        self.metrics.update(depth_preds, depth_gt, mask_valid)
 
+    def test_epoch_end(self, outputs):
+        # Reduced over all ranks; every rank has to call compute()
+        self.results = self.metrics.compute()
+    
 
 if __name__ == '__main__':
     # Experimental setup
@@ -289,11 +262,13 @@ if __name__ == '__main__':
     result =trainer.test(verbose=True, model=model)
     print(result)
 
-    metrics = {}
-    for metric_name, metric_val in model.metrics.items(): 
-        print(f"\t{metric_name}: {metric_val.mean()} ({math.sqrt(metric_val.variance())})")
-        metrics[metric_name] = metric_val.mean()
-        metrics[metric_name + "_std"] = math.sqrt(metric_val.variance())
+    metrics = model.results
+    for metric_name in model.metrics.names: 
+        print(f"\t{metric_name}: {metrics[metric_name]} ({metrics[metric_name + '_std']})")
+    print("quantiles over all valid pixels:")
+    for metric_name, metric_val in metrics.items():
+        if '_pixel_' in metric_name:
+            print(f"\t{metric_name}: {metric_val}")
 
     print("metrics : ", metrics)
 
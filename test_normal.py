@@ -4,8 +4,6 @@ import numpy as np
 import random
 import json
 import math
-from collections import defaultdict
-from runstats import Statistics
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
@@ -24,12 +22,13 @@ from matplotlib import cm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset
+from data.masks import make_valid_mask
 from data.nyu_dataset import NYUDataset, build_mask_for_eval, mask_val
 from data.OASIS_dataset import OASISDataset
 from models.unet import UNet
 from models.multi_task_model import MultiTaskModel
 from losses import masked_l1_loss, compute_grad_norm_losses
-from evaluation_metrics import get_metrics
+from evaluation_metrics import MetricAccumulator
 
 
 class NormalTest(pl.LightningModule):
@@ -101,7 +100,8 @@ class NormalTest(pl.LightningModule):
                 state_dict = checkpoint
             self.model.load_state_dict(state_dict)
 
-        self.metrics = defaultdict(Statistics)
+        self.metrics = MetricAccumulator('normal')
+        self.results = {}
 
     @staticmethod
     def add_model_specific_args(parent_parser):
@@ -252,7 +252,7 @@ class NormalTest(pl.LightningModule):
             normal_gt = torch.clamp(normal_gt, 0, 1)
 
             # Mask out invalid pixels and compute loss
-            mask_valid = self.make_valid_mask(batch['positive']['mask_valid']).repeat_interleave(3,1)
+            mask_valid = make_valid_mask(batch['positive']['mask_valid'], self.image_size).repeat_interleave(3,1)
 
         # save samples
         if batch_idx % 4 == 0:
@@ -272,38 +272,12 @@ class NormalTest(pl.LightningModule):
             transform(im).save(os.path.join('test_images', 'normal', self.test_datasets[0], f'{batch_idx}_mask.png'))
 
 
-        for pred, target, mask in zip(normal_preds, normal_gt, mask_valid):
-            metrics = get_metrics(pred.cpu().unsqueeze(0), target.cpu().unsqueeze(0), \
-                masks=mask.cpu().unsqueeze(0), task='normal')
-            for metric_name, metric_val in metrics.items(): 
-                self.metrics[metric_name].push(metric_val)
-    
-
-    def make_valid_mask(self, mask_float, max_pool_size=4, return_small_mask=False):
-        '''
-            Creates a mask indicating the valid parts of the image(s).
-            Enlargens masked area using a max pooling operation.
-
-            Args:
-                mask_float: A mask as loaded from the Taskonomy loader.
-                max_pool_size: Parameter to choose how much to enlarge masked area.
-                return_small_mask: Set to true to return mask for aggregated image
-        '''
-        if len(mask_float.shape) == 3:
-            mask_float = mask_float.unsqueeze(axis=0)
-        reshape_temp = len(mask_float.shape) == 5
-        if reshape_temp:
-            mask_float = rearrange(mask_float, 'b p c h w -> (b p) c h w')
-        mask_float = 1 - mask_float
-        mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
-        mask_float = F.interpolate(mask_float, (self.image_size, self.image_size), mode='nearest')
-        mask_valid = mask_float == 0
-        if reshape_temp:
-            mask_valid = rearrange(mask_valid, '(b p) c h w -> b p c h w', p=self.num_positive)
-
-        return mask_valid
-
+        self.metrics.update(normal_preds, normal_gt, mask_valid)
 
+    def test_epoch_end(self, outputs):
+        # Reduced over all ranks; every rank has to call compute()
+        self.results = self.metrics.compute()
+    
 
 if __name__ == '__main__':
     # Experimental setup
@@ -336,11 +310,13 @@ if __name__ == '__main__':
     result =trainer.test(verbose=True, model=model)
     print(result)
 
-    metrics = {}
-    for metric_name, metric_val in model.metrics.items(): 
-        print(f"\t{metric_name}: {metric_val.mean()} ({math.sqrt(metric_val.variance())})")
-        metrics[metric_name] = metric_val.mean()
-        metrics[metric_name + "_std"] = math.sqrt(metric_val.variance())
+    metrics = model.results
+    for metric_name in model.metrics.names: 
+        print(f"\t{metric_name}: {metrics[metric_name]} ({metrics[metric_name + '_std']})")
+    print("quantiles over all valid pixels:")
+    for metric_name, metric_val in metrics.items():
+        if '_pixel_' in metric_name:
+            print(f"\t{metric_name}: {metric_val}")
 
     print("metrics : ", metrics)
 
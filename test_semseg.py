@@ -30,6 +30,7 @@ from detectron2.utils.visualizer import Visualizer
 import wandb
 
 from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset, REPLICA_BUILDINGS
+from data.masks import make_valid_mask
 from data.segment_instance import extract_instances, TASKONOMY_CLASS_LABELS, TASKONOMY_CLASS_COLORS, \
     REPLICA_CLASS_LABELS, REPLICA_CLASS_COLORS, HYPERSIM_CLASS_COLORS, NYU40_COLORS, \
         GSO_NUM_CLASSES, GSO_CLASS_COLORS, COMBINED_CLASS_LABELS, COMBINED_CLASS_COLORS, plot_instances, apply_mask
@@ -208,36 +209,13 @@ class SemSegTest(pl.LightningModule):
         return self.model(x)   #['segment_semantic']
     
 
-    def make_valid_mask(self, mask_float, max_pool_size=4, return_small_mask=False):
-        '''
-            Creates a mask indicating the valid parts of the image(s).
-            Enlargens masked area using a max pooling operation.
-
-            Args:
-                mask_float: A mask as loaded from the Taskonomy loader.
-                max_pool_size: Parameter to choose how much to enlarge masked area.
-                return_small_mask: Set to true to return mask for aggregated image
-        '''
-        if len(mask_float.shape) == 3:
-            mask_float = mask_float.unsqueeze(axis=0)
-        reshape_temp = len(mask_float.shape) == 5
-        if reshape_temp:
-            mask_float = rearrange(mask_float, 'b p c h w -> (b p) c h w')
-        mask_float = 1 - mask_float
-        mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
-        mask_float = F.interpolate(mask_float, (self.image_size, self.image_size), mode='nearest')
-        mask_valid = mask_float == 0
-        if reshape_temp:
-            mask_valid = rearrange(mask_valid, '(b p) c h w -> b p c h w', p=self.num_positive)
-
-        return mask_valid
         
 
     def test_step(self, batch, batch_idx):
         
         rgb = batch['positive']['rgb']
         semantic = batch['positive']['segment_semantic']
-        mask_valid = self.make_valid_mask(batch['positive']['mask_valid']).squeeze(1)
+        mask_valid = make_valid_mask(batch['positive']['mask_valid'], self.image_size).squeeze(1)
 
         labels_gt = semantic[:,:,:,0]
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The repository is not a package: make `data`, `losses`, ... importable as in the training scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
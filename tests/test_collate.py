@@ -0,0 +1,33 @@
+import torch
+import torch.utils.data as data
+from   torch.utils.data.dataloader import default_collate
+
+from data.collate import RingCollate
+
+
+class MixedLabels(data.Dataset):
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, i):
+        label = torch.tensor([300, -1]) if i % 2 else torch.tensor([1, 2], dtype=torch.uint8)
+        return {'positive': {'rgb': torch.full((3, 4, 4), float(i)), 'label': label, 'building': f'b{i}'}}
+
+
+def test_ring_collate_is_default_collate_without_pin_memory():
+    assert not RingCollate().use_ring
+    assert not RingCollate(pin_memory=True).use_ring or torch.cuda.is_available()
+
+
+def test_ring_collate_matches_default_collate_in_workers():
+    collate = RingCollate(pin_memory=True, num_slots=3)
+    # Exercise the ring even on machines without CUDA
+    collate.use_ring = True
+    dataset = MixedLabels()
+    loader = data.DataLoader(dataset, batch_size=2, num_workers=2, collate_fn=collate)
+    for i, batch in enumerate(loader):
+        expected = default_collate([dataset[2 * i], dataset[2 * i + 1]])['positive']
+        assert batch['positive']['label'].dtype == expected['label'].dtype == torch.int64
+        assert torch.equal(batch['positive']['label'], expected['label'])
+        assert torch.equal(batch['positive']['rgb'], expected['rgb'])
+        assert batch['positive']['building'] == expected['building']
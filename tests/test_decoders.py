@@ -0,0 +1,59 @@
+import io
+import numpy as np
+import pytest
+from   PIL import Image
+
+from data.decoders import decode_file, decode_pil, file_kind
+
+cv2 = pytest.importorskip('cv2')
+
+
+def png_bytes(mode):
+    rng = np.random.RandomState(0)
+    if mode == 'I;16':
+        img = Image.fromarray(rng.randint(0, 2 ** 16, (12, 16)).astype(np.uint16))
+    elif mode == 'P':
+        img = Image.fromarray(rng.randint(0, 255, (12, 16, 3)).astype(np.uint8)).quantize(colors=16)
+    else:
+        shape = {'L': (12, 16), 'RGB': (12, 16, 3), 'RGBA': (12, 16, 4)}[mode]
+        img = Image.fromarray(rng.randint(0, 255, shape).astype(np.uint8))
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA', 'P', 'I;16'])
+def test_cv2_matches_pil(mode):
+    data = png_bytes(mode)
+    expected = decode_pil('x.png', data)
+    actual = decode_file('x.png', backend='cv2', data=data)
+    assert actual.mode == expected.mode
+    assert np.array_equal(np.asarray(actual), np.asarray(expected))
+
+
+def test_cv2_16bit_color_matches_pil():
+    data = cv2.imencode('.png', np.random.RandomState(0).randint(0, 2 ** 16, (12, 16, 3)).astype(np.uint16))[1].tobytes()
+    assert file_kind('x.png', data) == 'other'
+    expected = decode_pil('x.png', data)
+    actual = decode_file('x.png', backend='cv2', data=data)
+    assert actual.mode == expected.mode
+    assert np.array_equal(np.asarray(actual), np.asarray(expected))
+
+
+def decode_or_error(decode, data):
+    try:
+        return np.asarray(decode('x.png', data))
+    except OSError as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('keep', [0.5, 0.9])
+def test_cv2_falls_back_to_pil_on_truncated_data(keep):
+    data = png_bytes('RGB')
+    data = data[:int(len(data) * keep)]
+    expected = decode_or_error(decode_pil, data)
+    actual = decode_or_error(lambda path, data: decode_file(path, backend='cv2', data=data), data)
+    if isinstance(expected, np.ndarray):
+        assert np.array_equal(actual, expected)
+    else:
+        assert actual is expected
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import torch
+
+from evaluation_metrics import get_metrics, get_batch_metrics, _batch_metrics, MetricAccumulator, ErrorHistogram
+
+
+def make_batch(task, batch_size=5, size=16, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    channels = 3 if task == 'normal' else 1
+    pred = torch.rand(batch_size, channels, size, size, generator=generator)
+    target = torch.rand(batch_size, channels, size, size, generator=generator) + 0.01
+    masks = (torch.rand(batch_size, 1, size, size, generator=generator) > 0.3).expand(-1, channels, -1, -1).clone()
+    masks[1] = False                # no valid pixels
+    masks[2, :, :, :size // 2] = False
+    masks[3] = False
+    masks[3, :, 0, :3] = True       # an odd number of valid pixels (median of one middle value)
+    return pred, target, masks
+
+
+def per_image_metrics(pred, target, masks, task):
+    return [get_metrics(pred[i:i + 1], target[i:i + 1], task=task, masks=masks[i:i + 1]) for i in range(len(pred))]
+
+
+@pytest.mark.parametrize('task', ['normal', 'depth_zbuffer'])
+def test_batch_metrics_match_per_image_metrics(task):
+    pred, target, masks = make_batch(task)
+    batch_metrics = get_batch_metrics(pred, target, task=task, masks=masks)
+    for i, metrics in enumerate(per_image_metrics(pred, target, masks, task)):
+        if metrics is None:
+            continue
+        for name, value in metrics.items():
+            # get_metrics computes the valid pixel ratio in float32
+            assert float(batch_metrics[name][i]) == pytest.approx(float(value), rel=1e-6), name
+
+
+@pytest.mark.parametrize('task', ['normal', 'depth_zbuffer'])
+def test_metric_accumulator_matches_statistics_over_images(task):
+    pred, target, masks = make_batch(task, batch_size=7)
+    accumulator = MetricAccumulator(task)
+    accumulator.update(pred[:3], target[:3], masks[:3])
+    accumulator.update(pred[3:], target[3:], masks[3:])
+    results = accumulator.compute()
+
+    per_image = [m for m in per_image_metrics(pred, target, masks, task) if m is not None]
+    for name in accumulator.names:
+        values = [float(m[name]) for m in per_image]
+        assert results[name] == pytest.approx(np.mean(values), rel=1e-6), name
+        assert results[name + '_std'] == pytest.approx(np.std(values, ddof=1), rel=1e-5), name
+
+
+def assert_close_to_quantile(value, values, q, bin_width):
+    ''' value lies within a bin of the order statistics around rank q * len(values) '''
+    values = values.double().sort().values
+    upper = min(int(np.ceil(q * len(values))), len(values) - 1)
+    lower = max(upper - 1, 0)
+    assert values[lower].item() - bin_width - 1e-9 <= value <= values[upper].item() + bin_width + 1e-9
+
+
+def test_error_histogram_quantiles_are_within_a_bin():
+    errors = torch.rand(20000, generator=torch.Generator().manual_seed(3)) * 180
+    histogram = ErrorHistogram(180.0, 18000)
+    histogram.update(errors)
+    qs = [0.0, 0.1, 0.5, 0.9, 0.99, 1.0]
+    for q, value in zip(qs, histogram.quantile(qs)):
+        assert_close_to_quantile(value, errors, q, histogram.bin_width)
+    assert histogram.median() == pytest.approx(histogram.quantile(0.5))
+    assert len(histogram) == len(errors)
+
+
+def test_error_histogram_merges_and_skips_invalid_values():
+    errors = torch.tensor([0.05, 0.15, 0.15, 2.0, float('nan'), 0.55])
+    masks = torch.tensor([True, True, True, True, True, False])
+    first, second = ErrorHistogram(1.0, 10), ErrorHistogram(1.0, 10)
+    first.update(errors[:3], masks[:3])
+    second.update(errors[3:], masks[3:])
+    merged = first.merge(second)
+    # nan and masked values are skipped, values above max_value go into the last bin
+    assert merged.counts.tolist() == [1, 2, 0, 0, 0, 0, 0, 0, 0, 1]
+    assert merged.median() == pytest.approx(0.15)
+    assert np.isnan(ErrorHistogram(1.0, 10).median())
+    with pytest.raises(ValueError):
+        merged.merge(ErrorHistogram(2.0, 10))
+
+
+@pytest.mark.parametrize('task, error', [('normal', 'ang_error'), ('depth_zbuffer', 'abs_error')])
+def test_metric_accumulator_reports_pixel_quantiles(task, error):
+    pred, target, masks = make_batch(task, batch_size=6, size=32)
+    accumulator = MetricAccumulator(task)
+    accumulator.update(pred[:2], target[:2], masks[:2])
+    accumulator.update(pred[2:], target[2:], masks[2:])
+    results = accumulator.compute()
+
+    _, pixel_errors = _batch_metrics(pred, target, task=task, masks=masks)
+    valid = pixel_errors[error][masks[:, 0]]
+    bin_width = accumulator.histograms[error].bin_width
+    for q, name in [(0.5, 'median'), (0.75, 'p75'), (0.9, 'p90'), (0.95, 'p95')]:
+        assert_close_to_quantile(results[f'{error}_pixel_{name}'], valid, q, bin_width)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from data.image_cache import SharedImageCache
+
+
+def test_shared_image_cache_fills_slots_once():
+    cache = SharedImageCache(num_slots=4, max_bytes=64)
+    assert cache.stats()['filled_slots'] == 0
+    array = np.arange(16, dtype=np.uint8).reshape(4, 4)
+    assert cache.get(1, lambda: array) is array
+    assert 1 in cache and 0 not in cache
+    assert np.array_equal(cache.get(1, lambda: None), array)
+    # A second miss of the slot neither overwrites it nor takes more of the budget
+    cache._slots[2, cache._STATE] = cache._RESERVED
+    cache.get(2, lambda: array)
+    assert 2 not in cache and cache.num_bytes == array.nbytes
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['filled_slots']) == (1, 2, 1)
+
+
+def test_shared_image_cache_respects_budget():
+    cache = SharedImageCache(num_slots=4, max_bytes=20)
+    array = np.zeros(16, dtype=np.uint8)
+    cache.get(0, lambda: array)
+    cache.get(1, lambda: array)
+    assert 0 in cache and 1 not in cache
+    assert cache.stats()['uncached'] == 1
@@ -0,0 +1,81 @@
+import pytest
+import torch
+
+from losses import masked_l1_loss, masked_mse_loss, masked_loss
+
+
+def legacy_masked_l1_loss(preds, target, mask_valid):
+    element_wise_loss = abs(preds - target)
+    element_wise_loss[~mask_valid] = 0
+    return element_wise_loss.sum() / mask_valid.sum()
+
+
+def legacy_masked_mse_loss(preds, target, mask_valid):
+    element_wise_loss = (preds - target)**2
+    element_wise_loss[~mask_valid] = 0
+    return element_wise_loss.sum() / mask_valid.sum()
+
+
+def make_inputs(shape=(2, 3, 8, 8), dtype=torch.float64, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    preds = torch.rand(shape, generator=generator, dtype=dtype).requires_grad_()
+    target = torch.rand(shape, generator=generator, dtype=dtype).requires_grad_()
+    mask = torch.rand((shape[0], 1) + shape[2:], generator=generator) > 0.3
+    return preds, target, mask
+
+
+@pytest.mark.parametrize('loss_fn, legacy_fn', [(masked_l1_loss, legacy_masked_l1_loss),
+                                                (masked_mse_loss, legacy_masked_mse_loss)])
+def test_masked_losses_match_legacy_values_and_gradients(loss_fn, legacy_fn):
+    preds, target, mask = make_inputs()
+    full_mask = mask.expand_as(preds)
+    loss = loss_fn(preds, target, mask)
+    grads = torch.autograd.grad(loss, (preds, target))
+    legacy = legacy_fn(preds, target, full_mask)
+    legacy_grads = torch.autograd.grad(legacy, (preds, target))
+    assert torch.allclose(loss, legacy)
+    for grad, legacy_grad in zip(grads, legacy_grads):
+        assert torch.allclose(grad, legacy_grad)
+    # A mask that already has the channels of preds gives the same result
+    assert torch.allclose(loss_fn(preds, target, full_mask), loss)
+
+
+@pytest.mark.parametrize('loss_fn', [masked_l1_loss, masked_mse_loss])
+@pytest.mark.parametrize('reduction', ['mean', 'sample', 'channel'])
+def test_masked_losses_gradcheck(loss_fn, reduction):
+    preds, target, mask = make_inputs(shape=(2, 2, 4, 4))
+    # Keep |preds - target| away from 0, where the l1 gradient is not defined
+    with torch.no_grad():
+        preds += 0.05 * torch.sign(preds - target)
+    assert torch.autograd.gradcheck(lambda p, t: loss_fn(p, t, mask, reduction=reduction), (preds, target))
+
+
+def test_masked_loss_reductions():
+    preds, target, mask = make_inputs()
+    full_mask = mask.expand_as(preds)
+    diff = (preds - target).abs().detach() * full_mask
+    per_sample = masked_l1_loss(preds, target, mask, reduction='sample')
+    per_channel = masked_l1_loss(preds, target, mask, reduction='channel')
+    assert torch.allclose(per_sample, diff.sum((1, 2, 3)) / full_mask.sum((1, 2, 3)))
+    assert torch.allclose(per_channel, diff.sum((0, 2, 3)) / full_mask.sum((0, 2, 3)))
+    with pytest.raises(ValueError):
+        masked_l1_loss(preds, target, mask, reduction='sum')
+
+
+def test_invalid_pixels_do_not_leak():
+    preds, target, mask = make_inputs()
+    with torch.no_grad():
+        target[~mask.expand_as(target)] = float('nan')
+    loss = masked_mse_loss(preds, target, mask)
+    loss.backward()
+    assert torch.isfinite(loss) and torch.isfinite(preds.grad).all()
+
+
+def test_masked_loss_does_not_modify_its_input():
+    element_wise_loss = torch.rand(2, 1, 4, 4)
+    original = element_wise_loss.clone()
+    mask = element_wise_loss > 0.5
+    expected = (original * mask).sum() / mask.sum()
+    assert torch.allclose(masked_loss(element_wise_loss, mask), expected)
+    assert torch.equal(element_wise_loss, original)
+    assert masked_loss(element_wise_loss, torch.zeros_like(mask)) == 0
@@ -0,0 +1,50 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from data.masks import build_mask, make_valid_mask
+
+
+def legacy_make_valid_mask(mask_float, image_size, max_pool_size=4):
+    ''' The make_valid_mask the LightningModules used to define '''
+    if len(mask_float.shape) == 3:
+        mask_float = mask_float.unsqueeze(0)
+    reshape_temp = len(mask_float.shape) == 5
+    if reshape_temp:
+        num_positive = mask_float.shape[1]
+        mask_float = mask_float.flatten(0, 1)
+    mask_float = 1 - mask_float
+    mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
+    mask_float = F.interpolate(mask_float, (image_size, image_size), mode='nearest')
+    mask_valid = mask_float == 0
+    if reshape_temp:
+        mask_valid = mask_valid.unflatten(0, (-1, num_positive))
+    return mask_valid
+
+
+@pytest.mark.parametrize('shape, image_size', [
+    ((1, 32, 32), 32),
+    ((4, 1, 32, 32), 32),
+    ((4, 1, 34, 30), 32),   # not a multiple of the block size
+    ((2, 3, 1, 16, 16), 16),  # num_positive views
+    ((4, 1, 16, 16), 48),   # upsampled
+])
+def test_make_valid_mask_matches_legacy(shape, image_size):
+    mask = (torch.rand(shape, generator=torch.Generator().manual_seed(0)) > 0.02).float()
+    expected = legacy_make_valid_mask(mask, image_size)
+    assert torch.equal(make_valid_mask(mask, image_size), expected)
+    assert torch.equal(make_valid_mask(mask, image_size, dtype=torch.uint8).bool(), expected)
+
+
+def test_build_mask_matches_a_fresh_kernel():
+    depth = torch.rand(3, 1, 24, 24, generator=torch.Generator().manual_seed(1))
+    depth[depth < 0.05] = 0
+    mask = (depth >= -1e-3) & (depth <= 1e-3)
+    expected = ~(F.conv2d(mask.float(), torch.ones(1, 1, 5, 5), padding=2) != 0)
+    assert torch.equal(build_mask(depth), expected)
+    assert torch.equal(build_mask(depth), expected)
+
+
+def test_compiled_make_valid_mask_matches_eager():
+    mask = (torch.rand((4, 1, 32, 32), generator=torch.Generator().manual_seed(2)) > 0.02).float()
+    assert torch.equal(make_valid_mask(mask, 32, compiled=True), make_valid_mask(mask, 32))
@@ -0,0 +1,180 @@
+import itertools
+import numpy as np
+import pytest
+import torch
+
+from data.samplers import MixtureSampler, ReadAheadBatchSampler, ShardedBuildingSampler
+
+
+def set_rank(monkeypatch, rank, world_size):
+    monkeypatch.setenv('RANK', str(rank))
+    monkeypatch.setenv('WORLD_SIZE', str(world_size))
+
+
+def draw(monkeypatch, sampler, rank, world_size):
+    set_rank(monkeypatch, rank, world_size)
+    return list(sampler)
+
+
+def test_mixture_sampler_draws_datasets_by_ratio(monkeypatch):
+    sizes = [1000, 10, 100]
+    sampler = MixtureSampler(sizes, num_samples=30000, chunk_size=4096)
+    indices = np.array(draw(monkeypatch, sampler, 0, 1))
+    assert len(indices) == len(sampler) == 30000
+    assert indices.min() >= 0 and indices.max() < sum(sizes)
+    per_dataset = np.bincount(np.searchsorted(np.cumsum(sizes), indices, side='right'), minlength=3)
+    assert np.allclose(per_dataset / len(indices), 1 / 3, atol=0.02)
+
+    weighted = MixtureSampler(sizes, ratios=[1, 0, 3], num_samples=20000)
+    indices = np.array(draw(monkeypatch, weighted, 0, 1))
+    per_dataset = np.bincount(np.searchsorted(np.cumsum(sizes), indices, side='right'), minlength=3)
+    assert per_dataset[1] == 0
+    assert np.isclose(per_dataset[2] / len(indices), 0.75, atol=0.02)
+
+
+def test_mixture_sampler_ranks_get_equal_lengths_and_different_draws(monkeypatch):
+    sampler = MixtureSampler([50, 70], num_samples=1001, seed=3, chunk_size=64)
+    draws = [draw(monkeypatch, sampler, rank, 4) for rank in range(4)]
+    assert [len(d) for d in draws] == [251] * 4
+    set_rank(monkeypatch, 0, 4)
+    assert len(sampler) == 251
+    assert all(a != b for a, b in itertools.combinations(draws, 2))
+    # Reproducible for a (seed, epoch, rank), different across epochs
+    assert draw(monkeypatch, sampler, 2, 4) == draws[2]
+    sampler.set_epoch(1)
+    assert draw(monkeypatch, sampler, 2, 4) != draws[2]
+
+
+def test_mixture_sampler_resumes_from_state_dict(monkeypatch):
+    set_rank(monkeypatch, 1, 2)
+    sampler = MixtureSampler([30, 40, 5], num_samples=500, seed=7, chunk_size=32)
+    sampler.set_epoch(2)
+    full = list(sampler)
+    it = iter(sampler)
+    consumed = [next(it) for _ in range(77)]
+    state = sampler.state_dict()
+
+    resumed = MixtureSampler([30, 40, 5], num_samples=500, chunk_size=32)
+    resumed.load_state_dict(state)
+    assert consumed + list(resumed) == full
+    # A finished epoch starts over
+    assert list(resumed) == full
+
+
+def test_mixture_sampler_resumes_from_trained_batches(monkeypatch):
+    set_rank(monkeypatch, 0, 1)
+    batch_size = 8
+    full = list(MixtureSampler([30, 40, 5], num_samples=200, seed=3))
+    sampler = MixtureSampler([30, 40, 5], num_samples=200, seed=3)
+    trained = []
+    for resume in range(3):
+        loader = torch.utils.data.DataLoader(range(75), batch_size=batch_size, sampler=sampler, num_workers=2)
+        for batches, batch in enumerate(loader, 1):
+            trained += batch.tolist()
+            if batches == 5:
+                break
+        # The workers have prefetched more than was trained on
+        assert sampler.consumed > sampler.start + batches * batch_size
+        state = sampler.state_dict(consumed=sampler.start + batches * batch_size)
+        sampler = MixtureSampler([30, 40, 5], num_samples=200)
+        sampler.load_state_dict(state)
+    assert trained + list(sampler) == full
+
+
+def test_mixture_sampler_rejects_empty_mixtures():
+    with pytest.raises(ValueError):
+        MixtureSampler([0, 10], ratios=[1, 0])
+
+
+class FakeIndex:
+    ''' The columns of a SampleIndex ShardedBuildingSampler uses: 5 buildings of 1-4 points of 1-3 views '''
+    def __init__(self, seed=0):
+        rng = np.random.RandomState(seed)
+        buildings, group_sizes = [], []
+        for building in range(5):
+            for _ in range(rng.randint(1, 5)):
+                group_sizes.append(rng.randint(1, 4))
+                buildings += [building] * group_sizes[-1]
+        self.building = np.array(buildings, dtype=np.int32)
+        self.group_offsets = np.concatenate([[0], np.cumsum(group_sizes)]).astype(np.int64)
+
+
+class FakeDataset:
+    def __init__(self, seed=0):
+        self.index = FakeIndex(seed)
+        self.sample_order = np.random.RandomState(seed + 1).permutation(len(self.index.building))
+
+
+@pytest.mark.parametrize('granularity', ['point', 'building'])
+@pytest.mark.parametrize('block_window', [None, 4])
+def test_sharded_building_sampler_gives_ranks_disjoint_shards_of_equal_length(monkeypatch, granularity, block_window):
+    dataset = FakeDataset()
+    num_rows = len(dataset.index.building)
+    sampler = ShardedBuildingSampler(dataset, granularity=granularity, block_window=block_window)
+    boundaries = set(sampler.boundaries.tolist())
+    world_size = 3
+    shards = []
+    for rank in range(world_size):
+        indices = draw(monkeypatch, sampler, rank, world_size)
+        assert len(indices) == len(sampler)
+        rows = set(dataset.sample_order[indices].tolist())
+        start, end = sampler.shard_rows(rank, world_size)
+        assert rows == set(range(start, end))
+        assert start in boundaries and end in boundaries
+        shards.append(rows)
+    assert all(not (a & b) for a, b in itertools.combinations(shards, 2))
+    assert set().union(*shards) == set(range(num_rows))
+
+
+def test_sharded_building_sampler_shuffles_per_epoch(monkeypatch):
+    sampler = ShardedBuildingSampler(FakeDataset())
+    first = draw(monkeypatch, sampler, 1, 2)
+    assert draw(monkeypatch, sampler, 1, 2) == first
+    sampler.set_epoch(1)
+    second = draw(monkeypatch, sampler, 1, 2)
+    assert second != first and set(second) == set(first)
+
+
+def test_sharded_building_sampler_without_shuffle_is_in_index_order(monkeypatch):
+    dataset = FakeDataset()
+    sampler = ShardedBuildingSampler(dataset, shuffle=False, drop_last=True)
+    for rank in range(2):
+        rows = dataset.sample_order[draw(monkeypatch, sampler, rank, 2)]
+        assert len(rows) == len(sampler) and np.all(np.diff(rows) == 1)
+
+
+def test_sharded_building_sampler_without_reshuffle_keeps_its_order(monkeypatch):
+    sampler = ShardedBuildingSampler(FakeDataset(), seed=99, reshuffle=False)
+    first = draw(monkeypatch, sampler, 1, 2)
+    sampler.set_epoch(3)
+    assert draw(monkeypatch, sampler, 1, 2) == first
+    # The order does not depend on how the dataset's sample_order was shuffled
+    other = FakeDataset()
+    other.sample_order = np.random.RandomState(5).permutation(len(other.sample_order))
+    rows = other.sample_order[draw(monkeypatch, ShardedBuildingSampler(other, seed=99, reshuffle=False), 1, 2)]
+    assert rows.tolist() == FakeDataset().sample_order[first].tolist()
+
+
+class WorkerBatches(torch.utils.data.Dataset):
+    def __len__(self):
+        return 23
+
+    def __getitems__(self, indices):
+        worker = torch.utils.data.get_worker_info().id
+        return [(worker, list(indices), indices.read_ahead)]
+
+    def __getitem__(self, index):
+        raise AssertionError('__getitems__ is used')
+
+
+def test_read_ahead_is_the_next_batch_of_the_same_worker():
+    num_workers = 3
+    sampler = ReadAheadBatchSampler(range(23), batch_size=2, num_workers=num_workers)
+    loader = torch.utils.data.DataLoader(WorkerBatches(), batch_sampler=sampler, num_workers=num_workers,
+                                         collate_fn=lambda batch: batch[0])
+    batches = list(loader)
+    assert len(batches) == len(sampler) == 12
+    assert [i for _, batch, _ in batches for i in batch] == list(range(23))
+    for worker in range(num_workers):
+        own = [(batch, ahead) for w, batch, ahead in batches if w == worker]
+        assert [ahead for _, ahead in own] == [batch for batch, _ in own[1:]] + [[]]
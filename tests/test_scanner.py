@@ -0,0 +1,19 @@
+import pytest
+
+from data.scanner import DirectoryScanner
+
+
+def test_listdir_raises_for_missing_directories(tmp_path):
+    scanner = DirectoryScanner()
+    with pytest.raises(FileNotFoundError):
+        scanner.listdir(str(tmp_path / 'missing'))
+    assert scanner.listdir(str(tmp_path / 'missing'), missing_ok=True) == []
+
+
+def test_listdir_reuses_unchanged_listings(tmp_path):
+    (tmp_path / 'b.png').touch()
+    (tmp_path / 'a.png').touch()
+    scanner = DirectoryScanner()
+    assert scanner.listdir(str(tmp_path)) == ['a.png', 'b.png']
+    assert scanner.listdir(str(tmp_path)) == ['a.png', 'b.png']
+    assert (scanner.num_listed, scanner.num_reused) == (1, 1)
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+import torch
+from   PIL import Image
+
+from data.taskonomy_dataset import TaskonomyDataset
+
+
+@pytest.fixture
+def taskonomy_root(tmp_path):
+    rng = np.random.RandomState(0)
+    for building in ['b1', 'b2']:
+        directory = tmp_path / 'rgb' / building
+        directory.mkdir(parents=True)
+        for point in range(3):
+            image = rng.randint(0, 255, (16, 16, 3)).astype(np.uint8)
+            Image.fromarray(image).save(directory / f'point_{point}_view_0_domain_rgb.png')
+    return tmp_path
+
+
+def make_dataset(root, **kwargs):
+    options = TaskonomyDataset.Options(data_path=str(root), tasks=['rgb'], buildings=['b1', 'b2'],
+                                       cache_dir=str(root / 'cache'), **kwargs)
+    return TaskonomyDataset(options)
+
+
+@pytest.mark.parametrize('transform', [None, 'DEFAULT'])
+def test_load_to_mem_matches_loading_from_disk(taskonomy_root, transform):
+    from_disk = make_dataset(taskonomy_root, transform=transform, image_size=16)
+    in_mem = make_dataset(taskonomy_root, transform=transform, image_size=16, load_to_mem=True)
+    assert len(in_mem) == len(from_disk) == 6
+    if transform is None:
+        assert isinstance(in_mem.cached_data['rgb'], list)
+    else:
+        assert in_mem.cached_data['rgb'].shape == (6, 3, 16, 16)
+    for i in range(len(in_mem)):
+        expected, actual = from_disk[i]['rgb'], in_mem[i]['rgb']
+        if transform is None:
+            assert isinstance(actual, Image.Image)
+            expected, actual = np.asarray(expected), np.asarray(actual)
+            assert np.array_equal(expected, actual)
+        else:
+            assert torch.equal(expected, actual)
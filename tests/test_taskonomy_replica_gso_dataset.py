@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import torch
+import torch.utils.data as data
+from   PIL import Image
+
+from data.segment_instance import REPLICA_LABEL_LUT
+from data.samplers import ReadAheadBatch, ReadAheadBatchSampler
+from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset, BatchedConcatDataset
+from data.transforms import get_raw_transform, get_transform, RAW_LABEL_DTYPE
+
+
+class LabelDataset(data.Dataset):
+    ''' Runs TaskonomyReplicaGsoDataset.load_task on in-memory label images, without an index '''
+    def __init__(self, images, batched_transform):
+        self.dataset = TaskonomyReplicaGsoDataset.__new__(TaskonomyReplicaGsoDataset)
+        transform = get_raw_transform if batched_transform else get_transform
+        self.dataset.transform = {'segment_semantic': transform('segment_semantic', 8)}
+        self.dataset.load_size = 8
+        self.dataset.label_dtype = RAW_LABEL_DTYPE if batched_transform else torch.long
+        self.dataset.load_image = lambda task, row, packed=None: images[row]
+        self.images = images
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, row):
+        return self.dataset.load_task('segment_semantic', row)
+
+
+def label_images():
+    taskonomy = np.full((8, 8, 3), 200, dtype=np.uint8)
+    replica = np.full((8, 8, 3), 3, dtype=np.uint8)
+    # Hypersim labels read directly from HDF5, -1 is undefined
+    hypersim = np.full((8, 8), -1, dtype=np.int16)
+    return [
+        (Image.fromarray(taskonomy), '/datasets/taskonomy/segment_semantic/b/point_0_view_0_domain_segmentsemantic.png'),
+        (Image.fromarray(replica), '/scratch/replica-taskonomized/segment_semantic/b/point_0_view_0_domain_segmentsemantic.png'),
+        (hypersim, '/scratch/hypersim/ai_001_001/images/scene_cam_00_geometry_hdf5/frame.0000.semantic.hdf5'),
+    ]
+
+
+def test_mixed_label_sources_collate_in_workers():
+    for batched_transform in [True, False]:
+        dataset = LabelDataset(label_images(), batched_transform)
+        # The first sample (a taskonomy label) decides the dtype of the collated batch
+        loader = data.DataLoader(dataset, batch_size=3, num_workers=1)
+        batch = next(iter(loader))
+        assert batch.dtype == (RAW_LABEL_DTYPE if batched_transform else torch.long)
+        assert (batch[0] == 200).all()
+        assert (batch[1] == REPLICA_LABEL_LUT[3 + 1]).all()
+        assert (batch[2] == -1).all()
+
+
+@pytest.fixture
+def taskonomy_root(tmp_path):
+    # building_from_url recognizes taskonomy urls by the directory name
+    root = tmp_path / 'taskonomy'
+    rng = np.random.RandomState(0)
+    for building in ['allensville', 'benevolence']:
+        directory = root / 'rgb' / building
+        directory.mkdir(parents=True)
+        for point in range(4):
+            for view in range(2):
+                image = rng.randint(0, 255, (8, 8, 3)).astype(np.uint8)
+                Image.fromarray(image).save(directory / f'point_{point}_view_{view}_domain_rgb.png')
+    return root
+
+
+def make_dataset(root, **kwargs):
+    options = TaskonomyReplicaGsoDataset.Options(
+        taskonomy_data_path=str(root), tasks=['rgb'], datasets=['taskonomy'], split='train', image_size=8,
+        cache_dir=str(root / 'cache'), **kwargs)
+    return TaskonomyReplicaGsoDataset(options)
+
+
+def test_read_ahead_batches_match_getitem(taskonomy_root):
+    dataset = make_dataset(taskonomy_root, prefetch_threads=2)
+    assert len(dataset) == 16
+    sampler = ReadAheadBatchSampler(data.SequentialSampler(dataset), batch_size=3, num_workers=2)
+    loader = data.DataLoader(dataset, batch_sampler=sampler, num_workers=2)
+    rgb = torch.cat([batch['positive']['rgb'] for batch in loader])
+    stats = dataset.prefetcher.stats()
+    # Every file was read through a request, either of its own batch or of the read-ahead
+    assert stats['direct'] == 0 and stats['prefetched'] + stats['waited'] == len(dataset)
+    assert torch.equal(rgb, torch.stack([dataset[i]['positive']['rgb'] for i in range(len(dataset))]))
+
+
+def test_batched_concat_dataset_forwards_getitems(taskonomy_root):
+    dataset = make_dataset(taskonomy_root, prefetch_threads=2)
+    calls = []
+    getitems = dataset.__getitems__
+    dataset.__getitems__ = lambda indices: calls.append((list(indices), indices.read_ahead)) or getitems(indices)
+    concat = BatchedConcatDataset([list(range(100, 105)), dataset])
+    batch = ReadAheadBatch([17, 0, 5, 4], read_ahead=[3, 20])
+    samples = concat.__getitems__(batch)
+    assert samples[1] == 100 and samples[3] == 104
+    assert torch.equal(samples[0]['positive']['rgb'], dataset[12]['positive']['rgb'])
+    assert torch.equal(samples[2]['positive']['rgb'], dataset[0]['positive']['rgb'])
+    assert calls == [([12, 0], [15])]
+
+
+def test_read_ahead_stays_pending_for_the_next_batch(taskonomy_root):
+    dataset = make_dataset(taskonomy_root, prefetch_threads=2)
+    url = lambda i: dataset.index.url('rgb', dataset.sample_order[i])
+    dataset.__getitems__(ReadAheadBatch([0, 1], read_ahead=[2, 3]))
+    assert list(dataset.prefetcher._pending) == [url(2), url(3)]
+    dataset.__getitems__(ReadAheadBatch([2, 3]))
+    assert not dataset.prefetcher._pending
+    assert dataset.prefetcher.stats()['direct'] == 0
@@ -21,6 +21,9 @@ from matplotlib import cm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset, REPLICA_BUILDINGS
+from data.samplers import ShardedBuildingSampler
+from data.collate import RingCollate, SideStreamTransfer
+from data.masks import make_valid_mask
 from models.unet import UNet
 from models.multi_task_model import MultiTaskModel
 from losses import masked_l1_loss, compute_grad_norm_losses
@@ -45,6 +48,7 @@ class ConsistentDepth(pl.LightningModule):
                  image_size,
                  batch_size,
                  num_workers,
+                 block_window,
                  lr,
                  lr_step,
                  taskonomy_variant,
@@ -58,9 +62,10 @@ class ConsistentDepth(pl.LightningModule):
                  use_hypersim,
                  **kwargs):
         super().__init__()
+        self.batch_transfer = SideStreamTransfer()
 
         self.save_hyperparameters(
-            'num_positive', 'image_size', 'batch_size', 'num_workers', 'lr', 'lr_step',
+            'num_positive', 'image_size', 'batch_size', 'num_workers', 'block_window', 'lr', 'lr_step',
             'taskonomy_variant', 'taskonomy_root', 'replica_root', 'gso_root', 'use_taskonomy', 'use_replica', 'use_gso',
             'pretrained_weights_path', 'experiment_name', 'restore', 'gpus', 'distributed_backend', 
             'precision', 'val_check_interval', 'max_epochs'
@@ -72,6 +77,7 @@ class ConsistentDepth(pl.LightningModule):
         self.gpus = kwargs['gpus']
 
         self.num_workers = num_workers
+        self.block_window = block_window
         self.learning_rate = lr
         self.lr_step = lr_step
 
@@ -128,6 +134,11 @@ class ConsistentDepth(pl.LightningModule):
         parser.add_argument(
             '--num_workers', type=int, default=16,
             help='Number of workers for DataLoader. (default: 16)')
+        parser.add_argument(
+            '--block_window', type=int, default=None,
+            help='Block shuffle the training samples of each rank within windows of this many samples '
+                 '(see samplers.block_shuffle) instead of fully shuffling them. The sampler decides the '
+                 'order, not the order option of the dataset. (default: None)')
         parser.add_argument(
             '--taskonomy_variant', type=str, default='tiny',
             choices=['full', 'fullplus', 'medium', 'tiny', 'debug'],
@@ -162,6 +173,8 @@ class ConsistentDepth(pl.LightningModule):
         self.num_positive = 1 
 
         tasks = ['rgb', 'normal', 'segment_semantic', 'depth_zbuffer', 'mask_valid']
+        # Samples have all of tasks, but only the ones the training step uses are read
+        active_tasks = ['rgb', 'depth_zbuffer', 'mask_valid']
 
         self.train_datasets = []
         if self.use_taskonomy: self.train_datasets.append('taskonomy')
@@ -177,6 +190,7 @@ class ConsistentDepth(pl.LightningModule):
             gso_data_path=self.gso_root,
             hypersim_data_path=self.hypersim_root,
             tasks=tasks,
+            active_tasks=active_tasks,
             datasets=self.train_datasets,
             split='train',
             taskonomy_variant=self.taskonomy_variant,
@@ -196,6 +210,7 @@ class ConsistentDepth(pl.LightningModule):
             split='val',
             taskonomy_variant=self.taskonomy_variant,
             tasks=tasks,
+            active_tasks=active_tasks,
             datasets=self.val_datasets,
             transform='DEFAULT',
             image_size=self.image_size,
@@ -204,9 +219,6 @@ class ConsistentDepth(pl.LightningModule):
             randomize_views=False
         )
         self.valset = TaskonomyReplicaGsoDataset(options=opt_val)
-        
-        # Shuffle, so that truncated validation sets are randomly sampled, but the same throughout training
-        self.valset.randomize_order(seed=99)
 
         print('Loaded training and validation sets:')
         print(f'Train set contains {len(self.trainset)} samples.')
@@ -214,16 +226,21 @@ class ConsistentDepth(pl.LightningModule):
 
     def train_dataloader(self):
         return DataLoader(
-            self.trainset, batch_size=self.batch_size, shuffle=True,
-            num_workers=self.num_workers, pin_memory=False,
+            self.trainset, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.trainset, block_window=self.block_window),
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True),
         )
 
     def val_dataloader(self):
+        # Shuffled, so that truncated validation sets are randomly sampled, but the same throughout training
         return DataLoader(
-            self.valset, batch_size=self.batch_size, shuffle=False,
-            num_workers=self.num_workers, pin_memory=False
+            self.valset, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset, seed=99, reshuffle=False),
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx=0):
+        # Copies the next batch while the GPU still runs the current step
+        return self.batch_transfer(batch, device)
+
     def forward(self, x):
         return self.model(x)['depth_zbuffer']
 
@@ -257,29 +274,6 @@ class ConsistentDepth(pl.LightningModule):
                 self.on_error_callback(batch)
             raise
 
-    def make_valid_mask(self, mask_float, max_pool_size=4, return_small_mask=False):
-        '''
-            Creates a mask indicating the valid parts of the image(s).
-            Enlargens masked area using a max pooling operation.
-
-            Args:
-                mask_float: A mask as loaded from the Taskonomy loader.
-                max_pool_size: Parameter to choose how much to enlarge masked area.
-                return_small_mask: Set to true to return mask for aggregated image
-        '''
-        if len(mask_float.shape) == 3:
-            mask_float = mask_float.unsqueeze(axis=0)
-        reshape_temp = len(mask_float.shape) == 5
-        if reshape_temp:
-            mask_float = rearrange(mask_float, 'b p c h w -> (b p) c h w')
-        mask_float = 1 - mask_float
-        mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
-        mask_float = F.interpolate(mask_float, (self.image_size, self.image_size), mode='nearest')
-        mask_valid = mask_float == 0
-        if reshape_temp:
-            mask_valid = rearrange(mask_valid, '(b p) c h w -> b p c h w', p=self.num_positive)
-
-        return mask_valid
     
     def _shared_step(self, batch, train=True):
         step_results = {}
@@ -291,7 +285,7 @@ class ConsistentDepth(pl.LightningModule):
         depth_preds = self(rgb)
 
         # Mask out invalid pixels and compute loss
-        mask_valid = self.make_valid_mask(batch['positive']['mask_valid'])
+        mask_valid = make_valid_mask(batch['positive']['mask_valid'], self.image_size)
         loss = masked_l1_loss(depth_preds, depth_gt, mask_valid)
         
         step_results.update({
@@ -351,7 +345,7 @@ class ConsistentDepth(pl.LightningModule):
                 rgb_pos = example['positive']['rgb'].to(self.device)
                 depth_gt_pos = example['positive']['depth_zbuffer']
 
-                mask_valid = self.make_valid_mask(example['positive']['mask_valid']).squeeze(axis=0)
+                mask_valid = make_valid_mask(example['positive']['mask_valid'], self.image_size).squeeze(axis=0)
 
                 depth_gt_pos[~mask_valid] = 0
 
@@ -462,13 +456,13 @@ if __name__ == '__main__':
     if args.restore is None:
         trainer = Trainer.from_argparse_args(args, logger=wandb_logger, \
             checkpoint_callback=checkpoint_callback, gpus=-1, auto_lr_find=False, \
-                accelerator='ddp')
+                accelerator='ddp', replace_sampler_ddp=False)
     else:
         trainer = Trainer(
             resume_from_checkpoint=os.path.join(
                 os.path.join(checkpoint_dir, 'last.ckpt')
             ),
-            logger=wandb_logger, checkpoint_callback=checkpoint_callback, accelerator='ddp'
+            logger=wandb_logger, checkpoint_callback=checkpoint_callback, accelerator='ddp', replace_sampler_ddp=False
         )
     
 
@@ -10,8 +10,7 @@ from collections import defaultdict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, ConcatDataset
-from torch.utils.data.sampler import WeightedRandomSampler
+from torch.utils.data import DataLoader
 import torchvision
 from torchvision import transforms
 from torchvision.models.segmentation import deeplabv3_resnet101
@@ -23,7 +22,10 @@ from detectron2.data.detection_utils import convert_image_to_rgb
 from detectron2.utils.visualizer import Visualizer
 import wandb
 
-from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset, REPLICA_BUILDINGS
+from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset, BatchedConcatDataset, REPLICA_BUILDINGS
+from data.samplers import MixtureSampler, ReadAheadBatchSampler, ShardedBuildingSampler
+from data.collate import RingCollate, SideStreamTransfer
+from data.masks import make_valid_mask
 from data.segment_instance import extract_instances, TASKONOMY_CLASS_LABELS, TASKONOMY_CLASS_COLORS, \
     REPLICA_CLASS_LABELS, REPLICA_CLASS_COLORS, HYPERSIM_CLASS_COLORS, NYU40_COLORS, \
         GSO_NUM_CLASSES, GSO_CLASS_COLORS, COMBINED_CLASS_LABELS, COMBINED_CLASS_COLORS, plot_instances, apply_mask
@@ -64,6 +66,7 @@ class MuliTask(pl.LightningModule):
                  use_hypersim,
                  **kwargs):
         super().__init__()
+        self.batch_transfer = SideStreamTransfer()
         self.save_hyperparameters(
             'image_size', 'model_name', 'batch_size', 'num_workers', 'lr', 'lr_step', 'loss_balancing',
             'taskonomy_variant', 'taskonomy_root',
@@ -91,6 +94,9 @@ class MuliTask(pl.LightningModule):
         self.setup_datasets()
         self.val_samples = self.select_val_samples_for_datasets()
         self.log_val_imgs_step = 0
+        self.train_sampler = None
+        self.train_sampler_state = None  # From a checkpoint, loaded into the sampler once it exists
+        self.train_batches_done = 0
 
         # self.model = MultiTaskModel(tasks=['normal', 'segment_semantic', 'depth_zbuffer'], n_channels=3, \
         #     backbone='hrnet_w18', head='hrnet', pretrained=True, dilated=False)
@@ -234,7 +240,6 @@ class MuliTask(pl.LightningModule):
         )
 
         self.valset_taskonomy = TaskonomyReplicaGsoDataset(options=opt_val_taskonomy)
-        self.valset_taskonomy.randomize_order(seed=99)
 
         opt_val_replica = TaskonomyReplicaGsoDataset.Options(
             split='val',
@@ -248,7 +253,6 @@ class MuliTask(pl.LightningModule):
         )
 
         self.valset_replica = TaskonomyReplicaGsoDataset(options=opt_val_replica)
-        self.valset_replica.randomize_order(seed=99)
 
         opt_val_hypersim = TaskonomyReplicaGsoDataset.Options(
             split='val',
@@ -262,7 +266,6 @@ class MuliTask(pl.LightningModule):
         )
 
         self.valset_hypersim = TaskonomyReplicaGsoDataset(options=opt_val_hypersim)
-        self.valset_hypersim.randomize_order(seed=99)
 
         print('Loaded training and validation sets:')
         # print(f'Train set contains {len(self.trainset)} samples.')
@@ -286,32 +289,58 @@ class MuliTask(pl.LightningModule):
         taskonomy_count = len(self.trainset_taskonomy)
         replica_count = len(self.trainset_replica)
         hypersim_count = len(self.trainset_hypersim)
-        dataset_sample_count = torch.tensor([taskonomy_count, replica_count, hypersim_count])
-        weight = 1. / dataset_sample_count.float()
-        print("!!!!!!!!!!! ", weight, dataset_sample_count)
-        samples_weight = torch.tensor([weight[0]] * taskonomy_count + [weight[1]] * replica_count + [weight[2]] * hypersim_count)
-        sampler = WeightedRandomSampler(samples_weight, len(samples_weight))
-        trainset = ConcatDataset([self.trainset_taskonomy, self.trainset_replica, self.trainset_hypersim])
+        # Each dataset is drawn equally often, whatever its size
+        sampler = MixtureSampler([taskonomy_count, replica_count, hypersim_count])
+        print("!!!!!!!!!!! ", sampler.probs, sampler.sizes)
+        if self.train_sampler_state is not None:
+            sampler.load_state_dict(self.train_sampler_state)
+        self.train_sampler = sampler
+        # Forwards __getitems__, so each worker requests the files of its batch and of its next one at once
+        trainset = BatchedConcatDataset([self.trainset_taskonomy, self.trainset_replica, self.trainset_hypersim])
         return DataLoader(
-            trainset, batch_size=self.batch_size, sampler=sampler, 
-            num_workers=self.num_workers, pin_memory=False
+            trainset, batch_sampler=ReadAheadBatchSampler(sampler, self.batch_size, self.num_workers), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         
+    def on_train_epoch_start(self):
+        # Lightning only sets the epoch of DataLoader.sampler, not of the one inside batch_sampler
+        self.train_sampler.set_epoch(self.current_epoch)
+        self.train_batches_done = 0
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, dataloader_idx=0):
+        self.train_batches_done = batch_idx + 1
+
+    def on_save_checkpoint(self, checkpoint):
+        # Resume from the batches trained on, not from what the sampler handed to prefetching workers
+        if self.train_sampler is not None:
+            consumed = self.train_sampler.start + self.train_batches_done * self.batch_size
+            checkpoint['train_sampler'] = self.train_sampler.state_dict(consumed=consumed)
+
+    def on_load_checkpoint(self, checkpoint):
+        self.train_sampler_state = checkpoint.get('train_sampler')
+        if self.train_sampler is not None and self.train_sampler_state is not None:
+            self.train_sampler.load_state_dict(self.train_sampler_state)
+
     def val_dataloader(self):
+        # Shuffled, so that truncated validation sets are randomly sampled, but the same throughout training
         taskonomy_dl = DataLoader(
-            self.valset_taskonomy, batch_size=self.batch_size, shuffle=False, 
-            num_workers=self.num_workers, pin_memory=False
+            self.valset_taskonomy, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset_taskonomy, seed=99, reshuffle=False), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         replica_dl = DataLoader(
-            self.valset_replica, batch_size=self.batch_size, shuffle=False, 
-            num_workers=self.num_workers, pin_memory=False
+            self.valset_replica, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset_replica, seed=99, reshuffle=False), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         hypersim_dl = DataLoader(
-            self.valset_hypersim, batch_size=self.batch_size, shuffle=False, 
-            num_workers=self.num_workers, pin_memory=False
+            self.valset_hypersim, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset_hypersim, seed=99, reshuffle=False), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         return [taskonomy_dl, replica_dl, hypersim_dl]
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx=0):
+        # Copies the next batch while the GPU still runs the current step
+        return self.batch_transfer(batch, device)
+
     def forward(self, x):
         return self.model(x)
     
@@ -340,35 +369,12 @@ class MuliTask(pl.LightningModule):
         return res
 
 
-    def make_valid_mask(self, mask_float, max_pool_size=4, return_small_mask=False):
-        '''
-            Creates a mask indicating the valid parts of the image(s).
-            Enlargens masked area using a max pooling operation.
-
-            Args:
-                mask_float: A mask as loaded from the Taskonomy loader.
-                max_pool_size: Parameter to choose how much to enlarge masked area.
-                return_small_mask: Set to true to return mask for aggregated image
-        '''
-        if len(mask_float.shape) == 3:
-            mask_float = mask_float.unsqueeze(axis=0)
-        reshape_temp = len(mask_float.shape) == 5
-        if reshape_temp:
-            mask_float = rearrange(mask_float, 'b p c h w -> (b p) c h w')
-        mask_float = 1 - mask_float
-        mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
-        mask_float = F.interpolate(mask_float, (self.image_size, self.image_size), mode='nearest')
-        mask_valid = mask_float == 0
-        if reshape_temp:
-            mask_valid = rearrange(mask_valid, '(b p) c h w -> b p c h w', p=self.num_positive)
-
-        return mask_valid
         
 
     def shared_step(self, batch, train=True):
         step_results = {}
         criterion = nn.CrossEntropyLoss(ignore_index=-1)
-        mask_valid = self.make_valid_mask(batch['positive']['mask_valid'])
+        mask_valid = make_valid_mask(batch['positive']['mask_valid'], self.image_size)
         mask_valid_semantic = mask_valid.squeeze(1)
         mask_valid_normal = mask_valid.repeat_interleave(3,1)
         mask_valid_edge = mask_valid.clone()
@@ -387,12 +393,6 @@ class MuliTask(pl.LightningModule):
         semantic_gt *= mask_valid_semantic # invalid parts of the mesh also have undefined label (0)
         semantic_gt -= 1  # the model should not predict undefined and background classes
 
-        # Compute loss weights
-        if self.loss_balancing == 'grad_norm' and train and len(losses) > 1:
-            loss_weights = compute_grad_norm_losses(losses, self.model.backbone.layer4)
-        else:
-            loss_weights = {'semantic': 1, 'normal_initial':10, 'edge3d_initial':100, 'semantic_initial':1}
-
         # Forward pass MultiTaskModel
         # preds = self(rgb)
         # normal_preds = preds['normal']
@@ -429,6 +429,15 @@ class MuliTask(pl.LightningModule):
             'normal_initial':loss_normal_initial, 
             'edge3d_initial':loss_edge_initial, 
             'semantic_initial':loss_semantic_initial}
+
+        # Compute loss weights (w.r.t. the last backbone layer, which all losses go through)
+        if self.loss_balancing == 'grad_norm' and train and len(losses) > 1:
+            backbone = self.model.backbone
+            # HRNet backbones end with the fusion of their multi-scale outputs, resnets with layer4
+            last_stage = backbone[-1] if isinstance(backbone, nn.Sequential) else backbone.layer4
+            loss_weights = compute_grad_norm_losses(losses, last_stage)
+        else:
+            loss_weights = {'semantic': 1, 'normal_initial':10, 'edge3d_initial':100, 'semantic_initial':1}
         total_loss = sum([losses[loss_name] * loss_weights[loss_name] for loss_name in losses.keys()])
 
 
@@ -510,7 +519,7 @@ class MuliTask(pl.LightningModule):
                 semantic = example['positive']['segment_semantic']
                 # normal_gt = example['positive']['normal']
                 # depth_gt = example['positive']['depth_zbuffer']
-                mask_valid = self.make_valid_mask(example['positive']['mask_valid'])
+                mask_valid = make_valid_mask(example['positive']['mask_valid'], self.image_size)
                 mask_valid_semantic = mask_valid.squeeze()
                 # mask_valid_normal = mask_valid.squeeze(0).repeat_interleave(3,0)
                 # mask_valid_depth = mask_valid.squeeze(0)
@@ -683,7 +692,7 @@ if __name__ == '__main__':
     else:
         trainer = pl.Trainer(
             resume_from_checkpoint=os.path.join(f'{args.save_dir}/checkpoints/{wandb_logger.name}/{args.restore}/last.ckpt'), 
-            logger=wandb_logger, checkpoint_callback=checkpoint_callback, gpus=[0, 1], accelerator='ddp'
+            logger=wandb_logger, checkpoint_callback=checkpoint_callback, gpus=[0, 1], accelerator='ddp', replace_sampler_ddp=False
         )
 
     # trainer.tune(model)
@@ -25,6 +25,9 @@ from detectron2.utils.visualizer import Visualizer
 import wandb
 
 from data.taskonomy_replica_gso_dataset import TaskonomyReplicaGsoDataset, REPLICA_BUILDINGS
+from data.samplers import ShardedBuildingSampler
+from data.collate import RingCollate, SideStreamTransfer
+from data.masks import make_valid_mask
 from data.segment_instance import extract_instances, TASKONOMY_CLASS_LABELS, TASKONOMY_CLASS_COLORS, \
     REPLICA_CLASS_LABELS, REPLICA_CLASS_COLORS, HYPERSIM_CLASS_COLORS, NYU40_COLORS, \
         GSO_NUM_CLASSES, GSO_CLASS_COLORS, COMBINED_CLASS_LABELS, COMBINED_CLASS_COLORS, plot_instances, apply_mask
@@ -53,7 +56,7 @@ def building_in_taskonomy(building):
 class SemanticSegmentation(pl.LightningModule):
     def __init__(self, 
                  pretrained_weights_path,
-                 image_size, model_name, batch_size, num_workers, lr, lr_step, loss_balancing,
+                 image_size, model_name, batch_size, num_workers, block_window, lr, lr_step, loss_balancing,
                  taskonomy_variant,
                  taskonomy_root,
                  replica_root,
@@ -65,8 +68,9 @@ class SemanticSegmentation(pl.LightningModule):
                  use_hypersim,
                  **kwargs):
         super().__init__()
+        self.batch_transfer = SideStreamTransfer()
         self.save_hyperparameters(
-            'image_size', 'model_name', 'batch_size', 'num_workers', 'lr', 'lr_step', 'loss_balancing',
+            'image_size', 'model_name', 'batch_size', 'num_workers', 'block_window', 'lr', 'lr_step', 'loss_balancing',
             'taskonomy_variant', 'taskonomy_root',
             'experiment_name', 'restore', 'gpus', 'distributed_backend', 'precision', 'val_check_interval', 'max_epochs',
         )
@@ -76,6 +80,7 @@ class SemanticSegmentation(pl.LightningModule):
         self.batch_size = batch_size
         self.gpus = kwargs['gpus']
         self.num_workers = num_workers
+        self.block_window = block_window
         self.lr = lr
         self.lr_step = lr_step
         self.loss_balancing = loss_balancing
@@ -138,6 +143,11 @@ class SemanticSegmentation(pl.LightningModule):
         parser.add_argument(
             '--num_workers', type=int, default=16,
             help='Number of workers for DataLoader. (default: 16)')
+        parser.add_argument(
+            '--block_window', type=int, default=None,
+            help='Block shuffle the training samples of each rank within windows of this many samples '
+                 '(see samplers.block_shuffle) instead of fully shuffling them. The sampler decides the '
+                 'order, not the order option of the dataset. (default: None)')
         parser.add_argument(
             '--taskonomy_variant', type=str, default='tiny',
             choices=['full', 'fullplus', 'medium', 'tiny'],
@@ -181,9 +191,12 @@ class SemanticSegmentation(pl.LightningModule):
 
         self.val_datasets = ['taskonomy', 'replica', 'hypersim']
         tasks = ['rgb', 'normal', 'segment_semantic', 'depth_zbuffer', 'mask_valid']
+        # Samples have all of tasks, but only the ones the training step uses are read
+        active_tasks = ['rgb', 'segment_semantic', 'mask_valid']
 
         opt_train = TaskonomyReplicaGsoDataset.Options(
             tasks=tasks,
+            active_tasks=active_tasks,
             datasets=self.train_datasets,
             split='train',
             taskonomy_variant=self.taskonomy_variant,
@@ -213,6 +226,7 @@ class SemanticSegmentation(pl.LightningModule):
             split='val',
             taskonomy_variant=self.taskonomy_variant,
             tasks=tasks,
+            active_tasks=active_tasks,
             datasets=['taskonomy'],
             transform='DEFAULT',
             image_size=self.image_size,
@@ -221,12 +235,12 @@ class SemanticSegmentation(pl.LightningModule):
         )
 
         self.valset_taskonomy = TaskonomyReplicaGsoDataset(options=opt_val_taskonomy)
-        self.valset_taskonomy.randomize_order(seed=99)
 
         opt_val_replica = TaskonomyReplicaGsoDataset.Options(
             split='val',
             taskonomy_variant=self.taskonomy_variant,
             tasks=tasks,
+            active_tasks=active_tasks,
             datasets=['replica'],
             transform='DEFAULT',
             image_size=self.image_size,
@@ -235,12 +249,12 @@ class SemanticSegmentation(pl.LightningModule):
         )
 
         self.valset_replica = TaskonomyReplicaGsoDataset(options=opt_val_replica)
-        self.valset_replica.randomize_order(seed=99)
 
         opt_val_hypersim = TaskonomyReplicaGsoDataset.Options(
             split='val',
             taskonomy_variant=self.taskonomy_variant,
             tasks=tasks,
+            active_tasks=active_tasks,
             datasets=['hypersim'],
             transform='DEFAULT',
             image_size=self.image_size,
@@ -249,7 +263,6 @@ class SemanticSegmentation(pl.LightningModule):
         )
 
         self.valset_hypersim = TaskonomyReplicaGsoDataset(options=opt_val_hypersim)
-        self.valset_hypersim.randomize_order(seed=99)
 
         print('Loaded training and validation sets:')
         print(f'Train set contains {len(self.trainset)} samples.')
@@ -260,26 +273,31 @@ class SemanticSegmentation(pl.LightningModule):
     
     def train_dataloader(self):
         return DataLoader(
-            self.trainset, batch_size=self.batch_size, shuffle=True, 
-            num_workers=self.num_workers, pin_memory=False
+            self.trainset, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.trainset, block_window=self.block_window), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         
     def val_dataloader(self):
+        # Shuffled, so that truncated validation sets are randomly sampled, but the same throughout training
         taskonomy_dl = DataLoader(
-            self.valset_taskonomy, batch_size=self.batch_size, shuffle=False, 
-            num_workers=self.num_workers, pin_memory=False
+            self.valset_taskonomy, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset_taskonomy, seed=99, reshuffle=False), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         replica_dl = DataLoader(
-            self.valset_replica, batch_size=self.batch_size, shuffle=False, 
-            num_workers=self.num_workers, pin_memory=False
+            self.valset_replica, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset_replica, seed=99, reshuffle=False), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         hypersim_dl = DataLoader(
-            self.valset_hypersim, batch_size=self.batch_size, shuffle=False, 
-            num_workers=self.num_workers, pin_memory=False
+            self.valset_hypersim, batch_size=self.batch_size, sampler=ShardedBuildingSampler(self.valset_hypersim, seed=99, reshuffle=False), 
+            num_workers=self.num_workers, pin_memory=True, collate_fn=RingCollate(pin_memory=True)
         )
         return [taskonomy_dl, replica_dl, hypersim_dl]
 
     
+    def transfer_batch_to_device(self, batch, device, dataloader_idx=0):
+        # Copies the next batch while the GPU still runs the current step
+        return self.batch_transfer(batch, device)
+
     def forward(self, x):
         return self.model(x)['segment_semantic']
     
@@ -309,29 +327,6 @@ class SemanticSegmentation(pl.LightningModule):
         res['dataset'] = dataset
         return res
 
-    def make_valid_mask(self, mask_float, max_pool_size=4, return_small_mask=False):
-        '''
-            Creates a mask indicating the valid parts of the image(s).
-            Enlargens masked area using a max pooling operation.
-
-            Args:
-                mask_float: A mask as loaded from the Taskonomy loader.
-                max_pool_size: Parameter to choose how much to enlarge masked area.
-                return_small_mask: Set to true to return mask for aggregated image
-        '''
-        if len(mask_float.shape) == 3:
-            mask_float = mask_float.unsqueeze(axis=0)
-        reshape_temp = len(mask_float.shape) == 5
-        if reshape_temp:
-            mask_float = rearrange(mask_float, 'b p c h w -> (b p) c h w')
-        mask_float = 1 - mask_float
-        mask_float = F.max_pool2d(mask_float, kernel_size=max_pool_size)
-        mask_float = F.interpolate(mask_float, (self.image_size, self.image_size), mode='nearest')
-        mask_valid = mask_float == 0
-        if reshape_temp:
-            mask_valid = rearrange(mask_valid, '(b p) c h w -> b p c h w', p=self.num_positive)
-
-        return mask_valid
         
 
     def shared_step(self, batch, train=True):
@@ -339,7 +334,7 @@ class SemanticSegmentation(pl.LightningModule):
         criterion = nn.CrossEntropyLoss(ignore_index=-1)
         rgb = batch['positive']['rgb']
         semantic = batch['positive']['segment_semantic']
-        mask_valid = self.make_valid_mask(batch['positive']['mask_valid']).squeeze(1)
+        mask_valid = make_valid_mask(batch['positive']['mask_valid'], self.image_size).squeeze(1)
 
         ##### GSO classes : 2**8 * r + g
         # building_in_gso_vectorized = np.vectorize(building_in_gso)
@@ -464,7 +459,7 @@ class SemanticSegmentation(pl.LightningModule):
                 labels_gt[(semantic[:,:,0]==255) * (semantic[:,:,1]==255) * (semantic[:,:,2]==255)] = 0
                 labels_gt[labels_gt==-1] = 0
 
-                mask_valid = self.make_valid_mask(example['positive']['mask_valid']).squeeze()
+                mask_valid = make_valid_mask(example['positive']['mask_valid'], self.image_size).squeeze()
                 labels_gt *= mask_valid.cpu()  # final labels
                 mask_valid = labels_gt != 0
                 if mask_valid.sum() == 0: continue
@@ -547,7 +542,7 @@ class SemanticSegmentation(pl.LightningModule):
                 labels_gt[(semantic[:,:,0]==255) * (semantic[:,:,1]==255) * (semantic[:,:,2]==255)] = 0
                 labels_gt[labels_gt==-1] = 0
 
-                mask_valid = self.make_valid_mask(example['positive']['mask_valid']).squeeze()
+                mask_valid = make_valid_mask(example['positive']['mask_valid'], self.image_size).squeeze()
                 labels_gt *= mask_valid.cpu()  # final labels
                 mask_valid = labels_gt != 0
                 if mask_valid.sum() == 0: continue
@@ -697,11 +692,11 @@ if __name__ == '__main__':
     
     if args.restore is None:
         trainer = pl.Trainer.from_argparse_args(args, logger=wandb_logger, \
-            checkpoint_callback=checkpoint_callback, gpus=[0,1], auto_lr_find=False, accelerator='ddp')
+            checkpoint_callback=checkpoint_callback, gpus=[0,1], auto_lr_find=False, accelerator='ddp', replace_sampler_ddp=False)
     else:
         trainer = pl.Trainer(
             resume_from_checkpoint=os.path.join(f'./checkpoints/{wandb_logger.name}/{args.restore}/last.ckpt'), 
-            logger=wandb_logger, checkpoint_callback=checkpoint_callback
+            logger=wandb_logger, checkpoint_callback=checkpoint_callback, replace_sampler_ddp=False
         )
 
     # trainer.tune(model)